@@ -0,0 +1,172 @@
+"""
+/ask 的并发控制：
+
+- ThreadSerializer：同一 thread_id（用户）的对话轮次串行执行，避免两个标签页同时写同一线程的 checkpoint；
+  可选地把排队期间到达的多条消息合并为一轮。
+- AdmissionController：全局并发上限 + 按用户公平轮转的等待队列，队列满时立即拒绝（429 + Retry-After）。
+"""
+import math
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+
+class AdmissionRejected(Exception):
+    """等待队列已满"""
+    def __init__(self, retry_after: int):
+        super().__init__(f"队列已满，请 {retry_after} 秒后重试")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent: int, max_queue: int):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max_queue
+        self.active = 0
+        self.queued = 0
+        # user_id -> 等待中的 future 队列；按用户轮转出队，单个用户的突发请求不会饿死其他用户
+        self._waiters: "OrderedDict[str, deque]" = OrderedDict()
+        # 单轮耗时的指数滑动平均，用于估算 Retry-After
+        self._avg_seconds = 10.0
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self._avg_seconds * (self.queued + 1) / self.max_concurrent))
+
+    def check(self):
+        """快速检查：队列已满时直接拒绝，不进入等待"""
+        if self.active >= self.max_concurrent and self.queued >= self.max_queue:
+            raise AdmissionRejected(self.retry_after())
+
+    async def acquire(self, user_id: str):
+        if self.active < self.max_concurrent and not self.queued:
+            self.active += 1
+            return
+        self.check()
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(user_id, deque()).append(fut)
+        self.queued += 1
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # 名额已经转交给我们但调用方被取消：归还名额
+                self.release()
+            else:
+                self._remove_waiter(user_id, fut)
+            raise
+
+    def _remove_waiter(self, user_id: str, fut):
+        q = self._waiters.get(user_id)
+        if q is not None and fut in q:
+            q.remove(fut)
+            self.queued -= 1
+            if not q:
+                del self._waiters[user_id]
+
+    def release(self):
+        """释放名额：若有等待者，按用户轮转直接转交"""
+        while self._waiters:
+            user_id, q = next(iter(self._waiters.items()))
+            fut = q.popleft()
+            self.queued -= 1
+            if q:
+                self._waiters.move_to_end(user_id)
+            else:
+                del self._waiters[user_id]
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+    def record(self, seconds: float):
+        self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * seconds
+
+    def slot(self, user_id: str):
+        return _Slot(self, user_id)
+
+
+class _Slot:
+    def __init__(self, controller: AdmissionController, user_id: str):
+        self.controller = controller
+        self.user_id = user_id
+
+    async def __aenter__(self):
+        await self.controller.acquire(self.user_id)
+        self.start = time.monotonic()
+
+    async def __aexit__(self, *exc):
+        self.controller.record(time.monotonic() - self.start)
+        self.controller.release()
+
+
+class _Batch:
+    def __init__(self, text: str):
+        self.texts = [text]
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class ThreadSerializer:
+    """
+    每个 thread_id 一把锁。merge=True 时，锁被占用期间到达的消息合并为同一批：
+    第一条消息的请求负责执行这一轮（所有消息依次作为用户输入），其余请求等待并共享结果。
+    """
+    def __init__(self, merge: bool = False):
+        self.merge = merge
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._refs: dict[str, int] = {}
+        self._pending: dict[str, _Batch] = {}
+
+    def _lock(self, thread_id: str) -> asyncio.Lock:
+        self._refs[thread_id] = self._refs.get(thread_id, 0) + 1
+        return self._locks.setdefault(thread_id, asyncio.Lock())
+
+    def _unref(self, thread_id: str):
+        self._refs[thread_id] -= 1
+        if not self._refs[thread_id]:
+            del self._refs[thread_id]
+            del self._locks[thread_id]
+
+    @asynccontextmanager
+    async def hold(self, thread_id: str):
+        """独占该线程（不参与合并，用于流式接口）"""
+        lock = self._lock(thread_id)
+        try:
+            async with lock:
+                yield
+        finally:
+            self._unref(thread_id)
+
+    async def run(self, thread_id: str, text: str, turn):
+        """串行执行一轮对话：turn(texts) 为实际执行的协程函数，texts 为本轮的全部用户消息"""
+        merge = self.merge
+        if merge:
+            batch = self._pending.get(thread_id)
+            if batch is not None:
+                batch.texts.append(text)
+                return await asyncio.shield(batch.future)
+        lock = self._lock(thread_id)
+        batch = None
+        if merge and lock.locked():
+            batch = self._pending[thread_id] = _Batch(text)
+        try:
+            async with lock:
+                if batch is not None:
+                    self._pending.pop(thread_id, None)
+                result = await turn(batch.texts if batch is not None else [text])
+            if batch is not None:
+                batch.future.set_result(result)
+            return result
+        except BaseException as e:
+            if batch is not None:
+                if self._pending.get(thread_id) is batch:
+                    self._pending.pop(thread_id)
+                if not batch.future.done():
+                    if isinstance(e, asyncio.CancelledError):
+                        batch.future.cancel()
+                    else:
+                        batch.future.set_exception(e)
+                        batch.future.exception()  # 标记为已读取，避免无人等待时告警
+            raise
+        finally:
+            self._unref(thread_id)
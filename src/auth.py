@@ -0,0 +1,207 @@
+"""
+认证相关：用户注册表（config/users.json 的内存缓存）与签名会话令牌。
+
+用户表常驻内存，按用户名字典查找；仅当文件的 mtime / inode / 大小变化、
+或收到显式重载（SIGHUP / /reload_users 接口）时才重新解析文件。
+
+登录成功后签发 HMAC-SHA256 签名的短期令牌（携带用户 ID 与过期时间），
+后续请求只校验签名与过期时间，不再访问用户表；多个 Agent 进程共享同一密钥即可互认。
+吊销记录保存在共享文件中，同样按文件变化重载。
+"""
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+import secrets
+from typing import Optional
+
+
+def hash_password(password: str) -> str:
+    return hashlib.sha256(password.encode("utf-8")).hexdigest()
+
+
+# 用户不存在时仍做一次比较，避免通过响应时间探测用户名是否存在
+_DUMMY_HASH = hash_password("")
+
+
+class UserRegistry:
+    def __init__(self, path: str, check_interval: float = 1.0):
+        self.path = path
+        # 两次 stat 检查之间的最小间隔（秒），0 表示每次请求都检查
+        self.check_interval = check_interval
+        self.users: dict[str, str] = {}
+        self._stat_key = None
+        self._last_check = 0.0
+        self._loaded = False
+
+    def _current_stat_key(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def reload(self) -> int:
+        """强制重新加载用户文件，返回用户数"""
+        key = self._current_stat_key()
+        if key is None:
+            print(f"⚠️ 未找到用户配置文件 {self.path}，请先运行 python tools/gen_password.py 创建用户")
+            users = {}
+        else:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    users = json.load(f)
+            except (OSError, ValueError) as e:
+                # 文件写到一半或格式错误：保留旧的用户表，等待下次变化再加载
+                print(f"⚠️ 加载用户配置失败，沿用已加载的 {len(self.users)} 个用户: {e}")
+                self._stat_key = key
+                self._loaded = True
+                return len(self.users)
+        self.users = users
+        self._stat_key = key
+        self._loaded = True
+        self._last_check = time.monotonic()
+        print(f"👥 已加载 {len(users)} 个用户")
+        return len(users)
+
+    def maybe_reload(self):
+        """文件发生变化时才重新加载"""
+        now = time.monotonic()
+        if self._loaded and now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        if not self._loaded or self._current_stat_key() != self._stat_key:
+            self.reload()
+
+    def verify(self, username: str, password: str) -> bool:
+        """验证用户密码：对输入密码做 sha256 后与注册表中的哈希做常量时间比对"""
+        self.maybe_reload()
+        expected = self.users.get(username)
+        pw_hash = hash_password(password)
+        if expected is None:
+            hmac.compare_digest(pw_hash, _DUMMY_HASH)
+            return False
+        return hmac.compare_digest(pw_hash, expected)
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class RevocationList:
+    """
+    令牌吊销记录：jti 黑名单 + 按用户的“此时间之前签发的令牌全部失效”。
+    记录只需保留到对应令牌过期为止，写入时顺带清理。
+    """
+    def __init__(self, path: str, check_interval: float = 1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.jtis: dict[str, float] = {}            # jti -> 令牌过期时间
+        self.users_before: dict[str, float] = {}    # user_id -> 吊销时间点
+        self._stat_key = None
+        self._last_check = 0.0
+
+    def _load(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self.jtis, self.users_before, self._stat_key = {}, {}, None
+            return
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if key == self._stat_key:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 加载令牌吊销记录失败: {e}")
+            return
+        self.jtis = data.get("jtis", {})
+        self.users_before = data.get("users_before", {})
+        self._stat_key = key
+
+    def _save(self, max_ttl: float):
+        now = time.time()
+        self.jtis = {j: exp for j, exp in self.jtis.items() if exp > now}
+        self.users_before = {u: t for u, t in self.users_before.items() if t + max_ttl > now}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"jtis": self.jtis, "users_before": self.users_before}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def refresh(self):
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        self._load()
+
+    def is_revoked(self, payload: dict) -> bool:
+        self.refresh()
+        if payload["jti"] in self.jtis:
+            return True
+        return payload["iat"] <= self.users_before.get(payload["uid"], 0)
+
+    def revoke(self, payload: dict, max_ttl: float):
+        self._load()
+        self.jtis[payload["jti"]] = payload["exp"]
+        self._save(max_ttl)
+
+    def revoke_user(self, user_id: str, max_ttl: float):
+        self._load()
+        self.users_before[user_id] = time.time()
+        self._save(max_ttl)
+
+
+class TokenManager:
+    """签发与校验令牌：<base64url(payload)>.<base64url(hmac)>"""
+    def __init__(self, secret: Optional[str], ttl: int, revocation_path: str):
+        if not secret:
+            print("⚠️ 未设置 AUTH_TOKEN_SECRET，使用随机密钥：重启后令牌失效，且多进程之间无法互认")
+            secret = secrets.token_hex(32)
+        self._key = secret.encode("utf-8")
+        self.ttl = ttl
+        self.revoked = RevocationList(revocation_path)
+
+    def _sign(self, body: str) -> str:
+        return _b64encode(hmac.new(self._key, body.encode("ascii"), hashlib.sha256).digest())
+
+    def issue(self, user_id: str) -> tuple[str, int]:
+        """签发令牌，返回 (token, 过期时间戳)"""
+        now = time.time()
+        exp = int(now) + self.ttl
+        payload = {"uid": user_id, "iat": now, "exp": exp, "jti": secrets.token_hex(8)}
+        body = _b64encode(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+        return f"{body}.{self._sign(body)}", exp
+
+    def decode(self, token: str) -> Optional[dict]:
+        """校验签名、过期时间与吊销记录，通过则返回 payload，否则返回 None"""
+        try:
+            body, sig = token.split(".", 1)
+            # 含非 ASCII 字符的令牌：encode 抛 UnicodeEncodeError（ValueError 子类），compare_digest 抛 TypeError
+            if not hmac.compare_digest(sig, self._sign(body)):
+                return None
+        except (ValueError, TypeError):
+            return None
+        try:
+            payload = json.loads(_b64decode(body))
+        except ValueError:
+            return None
+        if payload.get("exp", 0) < time.time():
+            return None
+        if self.revoked.is_revoked(payload):
+            return None
+        return payload
+
+    def revoke(self, payload: dict):
+        self.revoked.revoke(payload, self.ttl)
+
+    def revoke_user(self, user_id: str):
+        self.revoked.revoke_user(user_id, self.ttl)
@@ -0,0 +1,177 @@
+"""
+agent_memory.db 的 checkpoint 保留策略与空间回收。
+
+AsyncSqliteSaver 每个图步骤都会写入一个完整的 checkpoint 且从不删除旧的。本模块按线程
+保留最新的 N 个 checkpoint（以及/或 T 时间内的全部 checkpoint），分批删除其余的 checkpoint
+与对应的 writes，再做增量 VACUUM 并报告回收的字节数。每个线程至少保留最新的 1 个 checkpoint。
+
+Agent 内作为后台任务定期执行（见 mainagent.py），也可独立运行：
+用法: python src/checkpoint_retention.py [--keep-last N] [--max-age-days D] [--dry-run] [--full-vacuum]
+"""
+import os
+import time
+import uuid
+import sqlite3
+import argparse
+from typing import Optional
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(current_dir)
+DEFAULT_DB_PATH = os.path.join(root_dir, "data", "agent_memory.db")
+
+# UUID v1/v6 时间戳起点（1582-10-15）与 Unix 纪元之间的 100ns 间隔数
+_GREGORIAN_OFFSET = 0x01B21DD213814000
+
+
+def checkpoint_time(checkpoint_id: str) -> float:
+    """从 checkpoint_id（uuid6）中解析写入时间（Unix 时间戳）"""
+    h = uuid.UUID(checkpoint_id).hex
+    return (int(h[:12] + h[13:16], 16) - _GREGORIAN_OFFSET) / 1e7
+
+
+def _file_bytes(db_path: str) -> int:
+    return sum(os.path.getsize(p) for p in (db_path, db_path + "-wal") if os.path.exists(p))
+
+
+def _chunks(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def select_expired(checkpoint_ids: list[str], keep_last: Optional[int], max_age: Optional[float], now: float) -> list[str]:
+    """
+    给定某线程按时间倒序排列的 checkpoint_id，返回应删除的部分。
+    保留条件（满足任一即保留）：位于最新 keep_last 个之内；写入时间在 max_age 秒以内。
+    """
+    if keep_last is None and max_age is None:
+        return []
+    keep = max(1, keep_last or 1)
+    return [
+        cid for cid in checkpoint_ids[keep:]
+        if max_age is None or now - checkpoint_time(cid) >= max_age
+    ]
+
+
+def init_database(db_path: str = DEFAULT_DB_PATH):
+    """新建数据库时先开启 auto_vacuum=INCREMENTAL（必须在建表之前设置），之后无需完整 VACUUM"""
+    if os.path.exists(db_path):
+        return
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+def prune_checkpoints(
+    db_path: str = DEFAULT_DB_PATH,
+    keep_last: Optional[int] = None,
+    max_age: Optional[float] = None,
+    batch_size: int = 500,
+    vacuum_pages: int = 0,
+    dry_run: bool = False,
+    full_vacuum: bool = False,
+) -> dict:
+    """
+    执行一次清理，返回统计信息。
+    vacuum_pages：增量 VACUUM 每次最多回收的页数，0 表示回收全部空闲页。
+    full_vacuum：数据库尚未开启 auto_vacuum=INCREMENTAL 时，执行一次完整 VACUUM 完成切换（会锁库）。
+    """
+    stats = {"threads": 0, "checkpoints_deleted": 0, "writes_deleted": 0, "bytes_reclaimed": 0}
+    if not os.path.exists(db_path):
+        return stats
+
+    bytes_before = _file_bytes(db_path)
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        now = time.time()
+        threads = conn.execute("SELECT DISTINCT thread_id, checkpoint_ns FROM checkpoints").fetchall()
+        stats["threads"] = len(threads)
+        for thread_id, ns in threads:
+            ids = [row[0] for row in conn.execute(
+                "SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+                "ORDER BY checkpoint_id DESC",
+                (thread_id, ns),
+            )]
+            expired = select_expired(ids, keep_last, max_age, now)
+            if dry_run:
+                stats["checkpoints_deleted"] += len(expired)
+                continue
+            # 分批提交，避免长时间持有写锁阻塞 Agent 写入新的 checkpoint
+            for batch in _chunks(expired, batch_size):
+                marks = ",".join("?" * len(batch))
+                params = (thread_id, ns, *batch)
+                with conn:
+                    cur = conn.execute(
+                        f"DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id IN ({marks})",
+                        params,
+                    )
+                    stats["writes_deleted"] += cur.rowcount
+                    cur = conn.execute(
+                        f"DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id IN ({marks})",
+                        params,
+                    )
+                    stats["checkpoints_deleted"] += cur.rowcount
+
+        if dry_run:
+            return stats
+
+        auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if auto_vacuum != 2:
+            if full_vacuum:
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.execute("VACUUM")
+            else:
+                stats["hint"] = "数据库未开启增量 VACUUM，请停止 Agent 后执行一次 --full-vacuum"
+        else:
+            # 用 executescript 在自动提交模式下执行，sqlite3 模块的隐式事务会让该 PRAGMA 不生效
+            conn.executescript(f"PRAGMA incremental_vacuum({vacuum_pages});")
+        # 把 WAL 中的内容写回主库并截断 WAL，文件大小才会真正变小
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+
+    stats["bytes_reclaimed"] = bytes_before - _file_bytes(db_path)
+    return stats
+
+
+def format_stats(stats: dict) -> str:
+    text = (
+        f"线程 {stats['threads']} 个，删除 checkpoint {stats['checkpoints_deleted']} 个、"
+        f"writes {stats['writes_deleted']} 条，回收 {stats['bytes_reclaimed'] / 1024 / 1024:.2f} MB"
+    )
+    if stats.get("hint"):
+        text += f"（{stats['hint']}）"
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description="清理 agent_memory.db 中的旧 checkpoint 并回收空间")
+    parser.add_argument("--db", type=str, default=DEFAULT_DB_PATH, help="数据库路径")
+    parser.add_argument("--keep-last", type=int, default=None, help="每个线程保留最新的 N 个 checkpoint")
+    parser.add_argument("--max-age-days", type=float, default=None, help="保留最近 D 天内的全部 checkpoint")
+    parser.add_argument("--batch-size", type=int, default=500, help="每批删除的 checkpoint 数（默认 500）")
+    parser.add_argument("--dry-run", action="store_true", help="只统计将删除的数量，不实际删除")
+    parser.add_argument("--full-vacuum", action="store_true", help="首次使用时切换为增量 VACUUM 模式（需停止 Agent）")
+    args = parser.parse_args()
+
+    if args.keep_last is None and args.max_age_days is None:
+        parser.error("请至少指定 --keep-last 或 --max-age-days")
+
+    start = time.perf_counter()
+    stats = prune_checkpoints(
+        args.db,
+        keep_last=args.keep_last,
+        max_age=args.max_age_days * 86400 if args.max_age_days is not None else None,
+        batch_size=args.batch_size,
+        dry_run=args.dry_run,
+        full_vacuum=args.full_vacuum,
+    )
+    prefix = "[dry-run] " if args.dry_run else ""
+    print(f"🧹 {prefix}{format_stats(stats)}，耗时 {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+对话上下文预算：在 call_model 调用 LLM 之前把上下文控制在 token 预算内。
+
+超出预算时保留最近的若干轮原文，更早的消息折叠进滚动摘要（保存在图状态 summary 字段中），
+并通过 RemoveMessage 从 checkpoint 中删除，避免历史无限增长。
+切分点只落在每轮对话开头的用户消息处，保证工具调用与其结果不会被拆开。
+"""
+import json
+import re
+
+from langchain_core.messages import SystemMessage, HumanMessage, RemoveMessage
+
+# 中日韩字符大致 1 字 ≈ 0.6 token，其余按 4 字符 ≈ 1 token 估算
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+_PER_MESSAGE_TOKENS = 4
+
+SUMMARY_PROMPT = (
+    "请把下面的对话记录压缩成一段简洁的中文摘要，供后续对话参考。"
+    "保留：用户的身份与偏好、提到的重要事实和数字、已设置的定时任务和保存的文件、尚未完成的事项。"
+    "省略寒暄和工具输出的原始细节。如果已有旧摘要，请将其与新内容合并为一份摘要。"
+)
+
+
+def _text_of(content) -> str:
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(p.get("text", "") if isinstance(p, dict) else str(p) for p in content)
+    return str(content)
+
+
+def estimate_tokens(text: str) -> int:
+    cjk = len(_CJK_RE.findall(text))
+    return int(cjk * 0.6 + (len(text) - cjk) / 4) + 1
+
+
+def message_tokens(message) -> int:
+    tokens = _PER_MESSAGE_TOKENS + estimate_tokens(_text_of(message.content))
+    for tc in getattr(message, "tool_calls", None) or []:
+        tokens += estimate_tokens(tc["name"] + json.dumps(tc.get("args", {}), ensure_ascii=False))
+    return tokens
+
+
+def find_cut(messages: list, keep_tokens: int) -> int:
+    """
+    从末尾向前按整轮累计，返回保留区的起始下标：messages[cut:] 原文保留，messages[:cut] 待折叠。
+    切分点只落在用户消息（一轮对话的开头）上，因此工具调用与其结果不会被拆开；
+    最近一轮无论多长都完整保留。没有可用切分点时返回 0（不折叠）。
+    """
+    total = 0
+    cut = len(messages)
+    for i in range(len(messages) - 1, -1, -1):
+        total += message_tokens(messages[i])
+        if total > keep_tokens and cut < len(messages):
+            break
+        if isinstance(messages[i], HumanMessage):
+            cut = i
+    return 0 if cut == len(messages) else cut
+
+
+def format_transcript(messages: list) -> str:
+    """把待折叠的消息整理为纯文本记录，交给摘要模型"""
+    role_map = {"human": "用户", "ai": "助手", "tool": "工具", "system": "系统"}
+    lines = []
+    for m in messages:
+        text = _text_of(m.content)
+        for tc in getattr(m, "tool_calls", None) or []:
+            text += f"\n[调用工具 {tc['name']}({json.dumps(tc.get('args', {}), ensure_ascii=False)})]"
+        if text:
+            lines.append(f"{role_map.get(m.type, m.type)}: {text}")
+    return "\n".join(lines)
+
+
+async def summarize(llm, previous_summary: str, messages: list) -> str:
+    """把旧摘要与待折叠的消息合并为新摘要（打上 context_summary 标签，流式接口据此过滤）"""
+    transcript = format_transcript(messages)
+    if previous_summary:
+        transcript = f"【旧摘要】\n{previous_summary}\n\n【新增对话】\n{transcript}"
+    response = await llm.ainvoke(
+        [SystemMessage(content=SUMMARY_PROMPT), HumanMessage(content=transcript)],
+        config={"tags": ["context_summary"]},
+    )
+    return _text_of(response.content)
+
+
+def summary_message(summary: str) -> list:
+    if not summary:
+        return []
+    return [SystemMessage(content=f"【此前对话摘要】\n{summary}")]
+
+
+def removals(messages: list) -> list:
+    return [RemoveMessage(id=m.id) for m in messages if m.id]
@@ -0,0 +1,128 @@
+"""
+定时触发的时间记录：每次投递尝试记录计划触发时间、trigger_agent 开始时间、HTTP 发送时间与 Agent 响应时间。
+
+- 追加写入 JSONL 日志（默认 data/timeset/fires.log），供离线分析；
+- 按分钟聚合延迟（发送时间 - 计划时间，仅首次尝试）与投递耗时（响应时间 - 发送时间）的分位数，
+  供 GET /fires/stats 查询。每分钟最多保留 SAMPLES_PER_MINUTE 个样本（蓄水池抽样），次数与最大值精确统计。
+"""
+import os
+import json
+import random
+import time
+from collections import OrderedDict
+from typing import Optional
+
+SAMPLES_PER_MINUTE = 1000
+PERCENTILES = (50, 90, 99)
+
+
+class _Series:
+    """一分钟内某个指标的样本（蓄水池抽样）"""
+    __slots__ = ("count", "max", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.max = 0.0
+        self.samples = []
+
+    def add(self, value: float):
+        self.count += 1
+        self.max = max(self.max, value)
+        if len(self.samples) < SAMPLES_PER_MINUTE:
+            self.samples.append(value)
+        else:
+            i = random.randrange(self.count)
+            if i < SAMPLES_PER_MINUTE:
+                self.samples[i] = value
+
+    def summary(self) -> Optional[dict]:
+        if not self.count:
+            return None
+        ordered = sorted(self.samples)
+        result = {
+            f"p{p}": round(ordered[min(len(ordered) - 1, len(ordered) * p // 100)], 3) for p in PERCENTILES
+        }
+        result["max"] = round(self.max, 3)
+        return result
+
+
+class _Minute:
+    __slots__ = ("attempts", "errors", "lateness", "delivery")
+
+    def __init__(self):
+        self.attempts = 0
+        self.errors = 0
+        self.lateness = _Series()
+        self.delivery = _Series()
+
+
+class FireRecorder:
+    def __init__(self, path: Optional[str], keep_minutes: int = 1440):
+        self.path = path
+        self.keep_minutes = keep_minutes
+        self._file = None
+        self._minutes: OrderedDict[int, _Minute] = OrderedDict()
+
+    def open(self):
+        if self.path:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def record(self, item: dict, sent_at: float, responded_at: float, status: Optional[int] = None,
+               error: Optional[str] = None):
+        """
+        记录一次投递尝试：item 为 outbox 中的一行（scheduled_at 为计划触发时间，created_at 为 trigger_agent 开始时间），
+        status 为 HTTP 状态码，网络错误时为 None 并给出 error
+        """
+        attempt = item["attempts"] + 1
+        entry = {
+            "task_id": item["task_id"],
+            "user_id": item["user_id"],
+            "outbox_id": item["id"],
+            "attempt": attempt,
+            "scheduled_at": item["scheduled_at"],
+            "fired_at": item["created_at"],
+            "sent_at": sent_at,
+            "responded_at": responded_at,
+            "status": status,
+            "error": error,
+        }
+        if self._file is not None:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+        key = int(sent_at // 60)
+        minute = self._minutes.get(key)
+        if minute is None:
+            minute = self._minutes[key] = _Minute()
+            while len(self._minutes) > self.keep_minutes:
+                self._minutes.popitem(last=False)
+        minute.attempts += 1
+        if error is not None or (status is not None and status >= 400):
+            minute.errors += 1
+        if attempt == 1:
+            minute.lateness.add(max(0.0, sent_at - item["scheduled_at"]))
+        minute.delivery.add(responded_at - sent_at)
+
+    def stats(self, minutes: int = 60) -> list[dict]:
+        """最近 minutes 分钟（按发送时间）的逐分钟统计，只包含有投递的分钟"""
+        since = int(time.time() // 60) - minutes + 1
+        return [
+            {
+                "minute": time.strftime("%Y-%m-%d %H:%M", time.localtime(key * 60)),
+                "attempts": m.attempts,
+                "errors": m.errors,
+                "fires": m.lateness.count,
+                "lateness_seconds": m.lateness.summary(),
+                "delivery_seconds": m.delivery.summary(),
+            }
+            for key, m in self._minutes.items() if key >= since
+        ]
@@ -1,8 +1,11 @@
-from flask import Flask, render_template_string, request, jsonify, session
+from flask import Flask, render_template_string, request, jsonify, session, Response, stream_with_context, g
 import requests
 import os
+import time
 from dotenv import load_dotenv
 
+import metrics
+
 # 加载 .env 配置
 current_dir = os.path.dirname(os.path.abspath(__file__))
 root_dir = os.path.dirname(current_dir)
@@ -14,7 +17,15 @@ app.secret_key = os.urandom(24)
 # --- 配置区 ---
 PORT_AGENT = int(os.getenv("PORT_AGENT", "51200"))
 LOCAL_AGENT_URL = f"http://127.0.0.1:{PORT_AGENT}/ask"
+LOCAL_AGENT_STREAM_URL = f"http://127.0.0.1:{PORT_AGENT}/ask_stream"
 LOCAL_LOGIN_URL = f"http://127.0.0.1:{PORT_AGENT}/login"
+LOCAL_REFRESH_URL = f"http://127.0.0.1:{PORT_AGENT}/refresh"
+LOCAL_LOGOUT_URL = f"http://127.0.0.1:{PORT_AGENT}/logout"
+# 令牌剩余有效期低于该值（秒）时自动续期
+TOKEN_REFRESH_MARGIN = 300
+
+# 代理接口耗时（流式接口统计到流结束为止）
+PROXY_SECONDS = metrics.Histogram("front_proxy_request_seconds", "代理请求耗时", ["endpoint", "status"])
 
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -35,6 +46,7 @@ HTML_TEMPLATE = """
         .markdown-body code { font-family: ui-monospace, SFMono-Regular, Menlo, Monaco, Consolas, monospace; font-size: 0.9em; }
         .message-user { border-radius: 1.25rem 1.25rem 0.2rem 1.25rem; }
         .message-agent { border-radius: 1.25rem 1.25rem 1.25rem 0.2rem; }
+        .tool-status { font-size: 0.75rem; color: #6b7280; font-family: ui-monospace, SFMono-Regular, Menlo, Monaco, Consolas, monospace; }
         .dot { width: 6px; height: 6px; background: #3b82f6; border-radius: 50%; animation: pulse 1.5s infinite; }
         @keyframes pulse { 0%, 100% { opacity: 0.3; transform: scale(0.8); } 50% { opacity: 1; transform: scale(1.2); } }
     </style>
@@ -154,9 +166,8 @@ HTML_TEMPLATE = """
                 }
 
                 currentUserId = name;
-                // 不存储密码明文到 localStorage，存到 sessionStorage
+                // 不存储密码明文，令牌只保存在服务端签名的 Flask Session 中
                 sessionStorage.setItem('userId', name);
-                sessionStorage.setItem('authToken', data.token || '');
 
                 document.getElementById('uid-display').textContent = 'UID: ' + name;
                 document.getElementById('login-screen').style.display = 'none';
@@ -174,7 +185,6 @@ HTML_TEMPLATE = """
         function handleLogout() {
             currentUserId = null;
             sessionStorage.removeItem('userId');
-            sessionStorage.removeItem('authToken');
             fetch("/proxy_logout", { method: 'POST' });
             document.getElementById('chat-screen').style.display = 'none';
             document.getElementById('login-screen').style.display = 'flex';
@@ -246,6 +256,31 @@ HTML_TEMPLATE = """
             chatBox.scrollTop = chatBox.scrollHeight;
         }
 
+        function renderAgent(div, content) {
+            div.innerHTML = marked.parse(content);
+            div.querySelectorAll('pre code').forEach((block) => hljs.highlightElement(block));
+            chatBox.scrollTop = chatBox.scrollHeight;
+        }
+
+        function appendToolStatus(name) {
+            const line = document.createElement('div');
+            line.className = 'tool-status';
+            line.textContent = '🔧 正在调用 ' + name + ' ...';
+            chatBox.appendChild(line);
+            chatBox.scrollTop = chatBox.scrollHeight;
+            return line;
+        }
+
+        // 解析一帧 SSE："event: xxx\\ndata: {...}"
+        function parseSSE(frame) {
+            let event = 'message', data = '';
+            frame.split('\\n').forEach((line) => {
+                if (line.startsWith('event:')) event = line.slice(6).trim();
+                else if (line.startsWith('data:')) data += line.slice(5).trim();
+            });
+            return { event, data: data ? JSON.parse(data) : {} };
+        }
+
         async function handleSend() {
             const text = inputField.value.trim();
             if (!text || sendBtn.disabled) return;
@@ -256,23 +291,63 @@ HTML_TEMPLATE = """
             sendBtn.disabled = true;
             showTyping();
 
+            let agentDiv = null;
+            let agentText = '';
+            const toolLines = {};
+
             try {
-                const response = await fetch("/proxy_ask", {
+                const response = await fetch("/proxy_ask_stream", {
                     method: 'POST',
                     headers: { 'Content-Type': 'application/json' },
                     body: JSON.stringify({ content: text })
                 });
-                const typingIndicator = document.getElementById('typing-indicator');
-                if (typingIndicator) typingIndicator.remove();
                 if (response.status === 401) {
+                    const typingIndicator = document.getElementById('typing-indicator');
+                    if (typingIndicator) typingIndicator.remove();
                     appendMessage("⚠️ 登录已过期，请重新登录", false);
                     handleLogout();
                     return;
                 }
-                if (!response.ok) throw new Error("Agent 响应异常");
-                const data = await response.json();
-                const agentReply = data.response || data.output || JSON.stringify(data);
-                appendMessage(agentReply, false);
+                if (response.status === 429) {
+                    throw new Error("服务繁忙，请 " + (response.headers.get('Retry-After') || '几') + " 秒后重试");
+                }
+                if (!response.ok || !response.body) throw new Error("Agent 响应异常");
+
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    let idx;
+                    while ((idx = buffer.indexOf('\\n\\n')) >= 0) {
+                        const frame = buffer.slice(0, idx);
+                        buffer = buffer.slice(idx + 2);
+                        if (!frame.trim()) continue;
+                        const { event, data } = parseSSE(frame);
+                        const typingIndicator = document.getElementById('typing-indicator');
+                        if (typingIndicator) typingIndicator.remove();
+
+                        if (event === 'token') {
+                            if (!agentDiv) agentDiv = appendMessage('', false);
+                            agentText += data.text;
+                            renderAgent(agentDiv, agentText);
+                        } else if (event === 'tool_start') {
+                            // 工具调用前的文本属于上一轮模型输出，新一轮另起气泡
+                            agentDiv = null;
+                            agentText = '';
+                            toolLines[data.run_id] = appendToolStatus(data.name);
+                        } else if (event === 'tool_end') {
+                            const line = toolLines[data.run_id];
+                            if (line) line.textContent = '✅ ' + data.name + ' 已完成';
+                        } else if (event === 'done') {
+                            if (!agentDiv && data.response) agentDiv = appendMessage(data.response, false);
+                        } else if (event === 'error') {
+                            appendMessage("❌ 错误: " + data.error, false);
+                        }
+                    }
+                }
             } catch (error) {
                 const typingIndicator = document.getElementById('typing-indicator');
                 if (typingIndicator) typingIndicator.remove();
@@ -294,10 +369,49 @@ HTML_TEMPLATE = """
 </html>
 """
 
+@app.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
+
+@app.after_request
+def record_status(response):
+    g.status_code = response.status_code
+    return response
+
+@app.teardown_request
+def observe_latency(exc):
+    # 流式响应在 generate() 结束时自行统计（此处执行时流还没开始发送）
+    endpoint = request.endpoint or ""
+    if endpoint.startswith("proxy_") and "start_time" in g and not g.get("streaming"):
+        status = 500 if exc is not None else g.get("status_code", 500)
+        PROXY_SECONDS.labels(endpoint=endpoint, status=status).observe(time.perf_counter() - g.start_time)
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route("/")
 def index():
     return render_template_string(HTML_TEMPLATE)
 
+def agent_auth_headers():
+    """取出 Session 中的令牌并构造请求头，临近过期时先续期；未登录返回 None"""
+    token = session.get("token")
+    if not token:
+        return None
+    if session.get("expires_at", 0) - time.time() < TOKEN_REFRESH_MARGIN:
+        try:
+            r = requests.post(LOCAL_REFRESH_URL, headers={"Authorization": f"Bearer {token}"}, timeout=10)
+            if r.status_code == 200:
+                data = r.json()
+                token = data["token"]
+                session["token"] = token
+                session["expires_at"] = data["expires_at"]
+        except Exception:
+            # 续期失败时沿用旧令牌，过期后由 Agent 返回 401
+            pass
+    return {"Authorization": f"Bearer {token}"}
+
 @app.route("/proxy_login", methods=["POST"])
 def proxy_login():
     """代理登录请求到后端 Agent"""
@@ -307,10 +421,12 @@ def proxy_login():
     try:
         r = requests.post(LOCAL_LOGIN_URL, json={"user_id": user_id, "password": password}, timeout=10)
         if r.status_code == 200:
-            # 登录成功，在 Flask session 中记录
+            # 登录成功，在 Flask session 中只记录签名令牌，不保存密码
+            data = r.json()
             session["user_id"] = user_id
-            session["password"] = password  # 需要传给后端每次验证
-            return jsonify(r.json())
+            session["token"] = data["token"]
+            session["expires_at"] = data["expires_at"]
+            return jsonify({"status": data["status"], "message": data["message"]})
         else:
             return jsonify(r.json()), r.status_code
     except Exception as e:
@@ -318,31 +434,86 @@ def proxy_login():
 
 @app.route("/proxy_ask", methods=["POST"])
 def proxy_ask():
-    # 从 Flask session 中获取已验证的用户信息
-    user_id = session.get("user_id")
-    password = session.get("password")
-    if not user_id or not password:
+    # 从 Flask session 中获取令牌
+    headers = agent_auth_headers()
+    if headers is None:
         return jsonify({"error": "未登录"}), 401
 
     user_content = request.json.get("content")
     
     payload = {
-        "user_id": user_id,
-        "password": password,
         "text": user_content
     }
     
     try:
-        r = requests.post(LOCAL_AGENT_URL, json=payload, timeout=120)
+        r = requests.post(LOCAL_AGENT_URL, json=payload, headers=headers, timeout=120)
         if r.status_code == 401:
             session.clear()
             return jsonify(r.json()), 401
+        if r.status_code == 429:
+            # Agent 繁忙：透传状态码与 Retry-After
+            return jsonify(r.json()), 429, {"Retry-After": r.headers.get("Retry-After", "5")}
         return jsonify(r.json())
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/proxy_ask_stream", methods=["POST"])
+def proxy_ask_stream():
+    """流式代理：原样转发 Agent 的 SSE 事件，不做缓冲"""
+    headers = agent_auth_headers()
+    if headers is None:
+        return jsonify({"error": "未登录"}), 401
+
+    payload = {
+        "text": request.json.get("content")
+    }
+
+    try:
+        # 读超时按“两次数据块之间的间隔”计算，而不是整轮对话的总耗时
+        r = requests.post(LOCAL_AGENT_STREAM_URL, json=payload, headers=headers, stream=True, timeout=(10, 120))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    if r.status_code != 200:
+        if r.status_code == 401:
+            session.clear()
+        try:
+            body = r.json()
+        except ValueError:
+            # 反向代理 502 页面、uvicorn 崩溃页等非 JSON 错误原样带回
+            body = {"detail": r.text}
+        r.close()
+        if r.status_code == 429:
+            return jsonify(body), 429, {"Retry-After": r.headers.get("Retry-After", "5")}
+        return jsonify(body), r.status_code
+
+    start_time = g.start_time
+    g.streaming = True
+
+    def generate():
+        try:
+            for chunk in r.iter_content(chunk_size=None):
+                if chunk:
+                    yield chunk
+        finally:
+            r.close()
+            PROXY_SECONDS.labels(endpoint="proxy_ask_stream", status=200).observe(time.perf_counter() - start_time)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.route("/proxy_logout", methods=["POST"])
 def proxy_logout():
+    headers = agent_auth_headers()
+    if headers is not None:
+        try:
+            # 吊销令牌，防止 Cookie 泄露后继续使用
+            requests.post(LOCAL_LOGOUT_URL, json={}, headers=headers, timeout=10)
+        except Exception:
+            pass
     session.clear()
     return jsonify({"status": "success"})
 
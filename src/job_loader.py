@@ -0,0 +1,177 @@
+"""
+启动时批量恢复定时任务到 APScheduler。
+
+scheduler.add_job 每次都会用 inspect.signature 校验回调参数、在任务列表中二分插入并派发事件，
+10 万个任务要花数秒。批量恢复时：
+- 相同的 Cron 表达式只解析一次、只计算一次首次触发时间（大量任务共用 "0 9 * * *" 之类的表达式）；
+  一次性 / 固定间隔任务的触发描述是 (类型, run_at, 间隔) 元组，同样按描述缓存；
+- 第一个任务照常通过 add_job 校验，其余任务从它复制（只替换 id / args / trigger / next_run_time）；
+- 全部放入 BulkMemoryJobStore 后整体排序一次；
+- 根据上次保存的下次触发时间找出停机期间错过的触发，按任务的宽限时间与合并策略决定补发哪些；
+- 恢复期间暂停循环垃圾回收（paused_gc），避免十万级对象创建过程中反复触发全量 GC。
+调用前调度器应已 start(paused=True)，恢复完成后再 resume()。
+"""
+import gc
+import math
+from datetime import datetime
+from contextlib import contextmanager
+from collections import deque
+
+from apscheduler.job import Job
+from apscheduler.jobstores.base import ConflictingIdError
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.util import datetime_to_utc_timestamp
+
+@contextmanager
+def paused_gc():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class BulkMemoryJobStore(MemoryJobStore):
+    """支持批量加入 / 移除的内存任务存储"""
+    def add_jobs(self, entries: list):
+        """entries 为 (job, 下次触发时间戳) 列表，时间戳由调用方按表达式缓存，避免逐个换算"""
+        for job, _ in entries:
+            if job.id in self._jobs_index:
+                raise ConflictingIdError(job.id)
+        self._jobs.extend(entries)
+        # 与 MemoryJobStore 相同的顺序：下次触发时间（None 排最后）、任务 ID
+        self._jobs.sort(key=lambda e: (math.inf if e[1] is None else e[1], e[0].id))
+        self._jobs_index.update((job.id, (job, ts)) for job, ts in entries)
+
+    def remove_jobs(self, job_ids):
+        """批量移除（一次重建列表），不存在的 ID 忽略"""
+        ids = {job_id for job_id in job_ids if job_id in self._jobs_index}
+        if not ids:
+            return
+        self._jobs = [entry for entry in self._jobs if entry[0].id not in ids]
+        for job_id in ids:
+            del self._jobs_index[job_id]
+
+
+def job_cloner(template: Job):
+    """
+    返回从 template 复制 Job 的函数：绕过 Job.__init__ 的参数校验，
+    只替换 id / args / trigger / next_run_time 与按任务设置的 misfire_grace_time / coalesce
+    """
+    scheduler, alias, func, func_ref = template._scheduler, template._jobstore_alias, template.func, template.func_ref
+    executor, kwargs, name = template.executor, template.kwargs, template.name
+    max_instances = template.max_instances
+    new = Job.__new__
+
+    def clone(job_id: str, args: tuple, trigger, next_run_time, misfire_grace_time, coalesce: bool) -> Job:
+        job = new(Job)
+        job._scheduler = scheduler
+        job._jobstore_alias = alias
+        job.func = func
+        job.func_ref = func_ref
+        job.executor = executor
+        job.kwargs = kwargs
+        job.name = name
+        job.misfire_grace_time = misfire_grace_time
+        job.coalesce = coalesce
+        job.max_instances = max_instances
+        job.id = job_id
+        job.args = args
+        job.trigger = trigger
+        job.next_run_time = next_run_time
+        return job
+    return clone
+
+
+def missed_fires(trigger, since: datetime, until: datetime, keep: int) -> tuple[int, list[float]]:
+    """停机期间错过的触发：since（上次保存的下次触发时间）起、until 之前的全部触发时间，返回 (总数, 最近 keep 个的时间戳)"""
+    count, latest = 0, deque(maxlen=keep)
+    fire = trigger.get_next_fire_time(None, since)
+    while fire is not None and fire < until:
+        count += 1
+        latest.append(datetime_to_utc_timestamp(fire))
+        fire = trigger.get_next_fire_time(fire, fire)
+    return count, list(latest)
+
+
+def bulk_restore(scheduler, jobstore: BulkMemoryJobStore, func, rows, make_trigger,
+                 misfire_grace_time: int = 0, coalesce: bool = True, max_replay: int = 100) -> dict:
+    """
+    rows 为 (task_id, user_id, 触发描述, text, next_run, misfire_grace_time, coalesce) 序列，
+    任务参数与 time.py 的 schedule() 一致：[user_id, text, task_id]。
+    make_trigger(触发描述) 返回触发器，格式错误抛出 ValueError。
+    行内 misfire_grace_time / coalesce 为 None 时使用参数中的默认值，宽限时间 0 表示不限。
+
+    next_run（上次保存的下次触发时间）早于当前时间的任务在停机期间错过了触发：
+    超过宽限时间的触发丢弃；coalesce 时其余合并为最近的一次，否则最多保留最近 max_replay 次。
+    不再有后续触发的任务（已过期的一次性任务）不加入调度器，其补发标记为 final（送达后删除任务）。
+    返回 {"restored", "failed": [(task_id, 错误)], "next_runs": [(task_id, 时间戳)], "triggers": 不同触发描述数,
+          "missed": [{"task_id", "user_id", "text", "missed", "replay": [计划触发时间戳], "dropped", "final"}]}
+    """
+    now = datetime.now(scheduler.timezone)
+    now_ts = now.timestamp()
+    parsed = {}  # 触发描述 -> (trigger, 首次触发时间, 时间戳) 或解析异常
+    scanned = {}  # (触发描述, next_run) -> missed_fires 结果，共用表达式的任务通常也有相同的 next_run
+    clone = None
+    restored = 0
+    jobs, failed, next_runs, missed = [], [], [], []
+    for task_id, user_id, cron, text, last_next_run, grace, merge in rows:
+        entry = parsed.get(cron)
+        if entry is None:
+            try:
+                trigger = make_trigger(cron)
+                next_run_time = trigger.get_next_fire_time(None, now)
+                if next_run_time is not None and next_run_time < now:
+                    next_run_time = None  # 一次性任务的触发时间已过
+                entry = (trigger, next_run_time, datetime_to_utc_timestamp(next_run_time))
+            except ValueError as e:
+                entry = e
+            parsed[cron] = entry
+        if isinstance(entry, Exception):
+            failed.append((task_id, str(entry)))
+            continue
+        if jobstore.lookup_job(task_id) is not None:
+            continue
+        trigger, next_run_time, ts = entry
+        grace = misfire_grace_time if grace is None else grace
+        merge = coalesce if merge is None else bool(merge)
+        job_grace = grace or None  # APScheduler 中 None 表示不限
+
+        if last_next_run is not None and last_next_run < now_ts:
+            key = (cron, last_next_run)
+            if key not in scanned:
+                scanned[key] = missed_fires(
+                    trigger, datetime.fromtimestamp(last_next_run, scheduler.timezone), now, max_replay
+                )
+            count, latest = scanned[key]
+            if count:
+                replay = [t for t in latest if job_grace is None or now_ts - t <= job_grace]
+                if merge:
+                    replay = replay[-1:]
+                missed.append({
+                    "task_id": task_id, "user_id": user_id, "text": text,
+                    "missed": count, "replay": replay, "dropped": count - len(replay),
+                    "final": next_run_time is None,
+                })
+
+        next_runs.append((task_id, ts))
+        if next_run_time is None:
+            continue
+        restored += 1
+        args = (user_id, text, task_id)
+        if clone is None:
+            template = scheduler.add_job(
+                func, trigger, args=list(args), id=task_id, next_run_time=next_run_time,
+                misfire_grace_time=job_grace, coalesce=merge,
+            )
+            clone = job_cloner(template)
+        else:
+            jobs.append((clone(task_id, args, trigger, next_run_time, job_grace, merge), ts))
+    if jobs:
+        jobstore.add_jobs(jobs)
+    return {
+        "restored": restored, "failed": failed, "next_runs": next_runs,
+        "triggers": len(parsed), "missed": missed,
+    }
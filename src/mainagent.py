@@ -1,13 +1,16 @@
 import os
 import copy
 import json
-import hashlib
+import time
+import signal
 import asyncio
+import functools
 from datetime import datetime
 from typing import Annotated, TypedDict, Optional
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Header
+from fastapi.responses import StreamingResponse, Response
 from pydantic import BaseModel
 import uvicorn
 
@@ -20,11 +23,21 @@ from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from langchain_deepseek import ChatDeepSeek
 from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_core.runnables import RunnableConfig
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain_mcp_adapters.client import MultiServerMCPClient
 from langgraph.prebuilt import ToolNode, tools_condition
 
 from dotenv import load_dotenv
 
+from mcp_pool import MCPSessionPool
+from mcp_local import load_local_tools
+from auth import UserRegistry, TokenManager
+import context_budget
+from checkpoint_retention import init_database, prune_checkpoints, format_stats
+from admission import AdmissionController, AdmissionRejected, ThreadSerializer
+from system_runs import RunStore, SystemRunner, SystemRunRejected
+import metrics
+
 # 1. 获取当前脚本 (src/main.py) 的绝对路径
 current_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -34,38 +47,195 @@ root_dir = os.path.dirname(current_dir)
 # 3. 拼接 env 和 db 的路径
 env_path = os.path.join(root_dir, "config", ".env")
 db_path = os.path.join(root_dir, "data", "agent_memory.db")
+system_runs_path = os.path.join(root_dir, "data", "system_runs.db")
 users_path = os.path.join(root_dir, "config", "users.json")
 
 # 加载配置
 load_dotenv(dotenv_path=env_path)
 
+# MCP 工具执行模式：pooled（常驻会话池）/ stdio（每次调用新起子进程）/ inprocess（进程内直接调用）
+MCP_TOOL_MODE = os.getenv("MCP_TOOL_MODE", "pooled").lower()
+MCP_POOL_SIZE = int(os.getenv("MCP_POOL_SIZE", "1"))
+
+# 对话上下文预算（估算 token 数）：超过 CONTEXT_TOKEN_BUDGET 时，只保留最近约 CONTEXT_KEEP_TOKENS 的原文，
+# 更早的消息折叠为滚动摘要；CONTEXT_TOKEN_BUDGET=0 表示不限制
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "12000"))
+CONTEXT_KEEP_TOKENS = int(os.getenv("CONTEXT_KEEP_TOKENS", "6000"))
+
+# checkpoint 保留策略：每个线程保留最新 N 个，和/或最近 D 天内的全部；后台每隔 INTERVAL 秒清理一次（0 表示不清理）
+CHECKPOINT_KEEP_LAST = int(os.getenv("CHECKPOINT_KEEP_LAST", "20")) or None
+CHECKPOINT_MAX_AGE_DAYS = float(os.getenv("CHECKPOINT_MAX_AGE_DAYS", "0")) or None
+CHECKPOINT_PRUNE_INTERVAL = int(os.getenv("CHECKPOINT_PRUNE_INTERVAL", "3600"))
+CHECKPOINT_VACUUM_PAGES = int(os.getenv("CHECKPOINT_VACUUM_PAGES", "0"))
+
+# 用户对话并发控制：全局最多 AGENT_MAX_CONCURRENT 轮同时执行，最多 AGENT_MAX_QUEUE 个请求排队，超出返回 429
+AGENT_MAX_CONCURRENT = int(os.getenv("AGENT_MAX_CONCURRENT", "8"))
+AGENT_MAX_QUEUE = int(os.getenv("AGENT_MAX_QUEUE", "100"))
+# 同一用户排队中的多条 /ask 消息是否合并为一轮
+ASK_MERGE_QUEUED = os.getenv("ASK_MERGE_QUEUED", "false").lower() in ("1", "true", "yes")
+
+# 系统触发任务执行池：worker 数、队列长度、每用户每分钟最多触发次数、关闭时等待在途任务的秒数
+SYSTEM_RUN_WORKERS = int(os.getenv("SYSTEM_RUN_WORKERS", "4"))
+SYSTEM_RUN_QUEUE = int(os.getenv("SYSTEM_RUN_QUEUE", "1000"))
+SYSTEM_RUN_USER_RATE = int(os.getenv("SYSTEM_RUN_USER_RATE", "10"))
+SYSTEM_RUN_DRAIN_TIMEOUT = float(os.getenv("SYSTEM_RUN_DRAIN_TIMEOUT", "30"))
+
+# MCP 服务名 -> src/ 下的模块名
+MCP_SERVERS = {
+    "scheduler_service": "mcp_scheduler",
+    "search_service": "mcp_search",
+    "file_service": "mcp_filemanager",
+}
+
+
+def build_mcp_connections() -> dict:
+    """stdio 传输的服务器配置：手动指定 python 解释器和脚本路径"""
+    return {
+        name: {
+            "command": "python",
+            "args": [os.path.join(current_dir, f"{module}.py")],
+            "transport": "stdio"
+        }
+        for name, module in MCP_SERVERS.items()
+    }
+
 
-def load_users() -> dict:
-    """加载用户名-密码哈希配置"""
-    if not os.path.exists(users_path):
-        print(f"⚠️ 未找到用户配置文件 {users_path}，请先运行 python tools/gen_password.py 创建用户")
-        return {}
-    with open(users_path, "r", encoding="utf-8") as f:
-        return json.load(f)
+# 用户注册表：常驻内存，users.json 变化（mtime/inode）时自动重载，也可通过 SIGHUP 或 /reload_users 强制重载
+user_registry = UserRegistry(users_path, check_interval=float(os.getenv("USERS_RELOAD_INTERVAL", "1.0")))
 
 
 def verify_password(username: str, password: str) -> bool:
-    """验证用户密码：对输入密码做 sha256 后与配置中的哈希比对"""
-    users = load_users()
-    if username not in users:
-        return False
-    pw_hash = hashlib.sha256(password.encode("utf-8")).hexdigest()
-    return pw_hash == users[username]
+    """验证用户密码：对输入密码做 sha256 后与注册表中的哈希比对"""
+    return user_registry.verify(username, password)
+
+# 会话令牌：/login 签发，后续请求无状态校验（多进程部署需配置相同的 AUTH_TOKEN_SECRET）
+token_manager = TokenManager(
+    os.getenv("AUTH_TOKEN_SECRET"),
+    ttl=int(os.getenv("AUTH_TOKEN_TTL", "3600")),
+    revocation_path=os.path.join(root_dir, "data", "revoked_tokens.json"),
+)
+
+
+def get_token_payload(authorization: Optional[str]) -> dict:
+    """从 Authorization: Bearer <token> 中解析并校验令牌"""
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="缺少令牌")
+    payload = token_manager.decode(authorization[len("Bearer "):])
+    if payload is None:
+        raise HTTPException(status_code=401, detail="令牌无效或已过期")
+    return payload
+
+
+def authenticate(req, authorization: Optional[str]) -> str:
+    """
+    鉴权并返回 user_id：优先校验 Bearer 令牌（不访问用户表）；
+    未携带令牌时回退到请求体中的用户名 + 密码（兼容旧客户端）。
+    """
+    if authorization:
+        return get_token_payload(authorization)["uid"]
+    if req.user_id and req.password and verify_password(req.user_id, req.password):
+        return req.user_id
+    raise HTTPException(status_code=401, detail="用户名或密码错误")
+
+# 同一 thread_id 串行执行 + 全局准入控制
+thread_serializer = ThreadSerializer(merge=ASK_MERGE_QUEUED)
+admission = AdmissionController(AGENT_MAX_CONCURRENT, AGENT_MAX_QUEUE)
+
+
+def too_busy(e: AdmissionRejected) -> HTTPException:
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+# --- 指标（GET /metrics） ---
+GRAPH_NODE_SECONDS = metrics.Histogram("agent_graph_node_seconds", "图节点单次执行耗时", ["node"])
+TOOL_CALL_SECONDS = metrics.Histogram("agent_tool_call_seconds", "单次工具调用耗时", ["tool"])
+TOOL_CALL_ERRORS = metrics.Counter("agent_tool_call_errors_total", "工具调用失败次数", ["tool"])
+LLM_TOKENS = metrics.Counter(
+    "agent_llm_tokens_total", "LLM token 用量（purpose: chat 对话 / summary 上下文摘要）", ["purpose", "kind"]
+)
+CHECKPOINT_SECONDS = metrics.Histogram(
+    "agent_checkpoint_seconds", "checkpoint 读写耗时", ["op"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+metrics.Gauge("agent_turns_active", "正在执行的对话轮数").set_function(lambda: admission.active)
+metrics.Gauge("agent_turns_queued", "等待执行的对话轮数").set_function(lambda: admission.queued)
+metrics.Gauge("agent_system_runs_queued", "排队中的系统触发任务数").set_function(
+    lambda: app.state.system_runner.queue.qsize()
+)
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """挂在编译后的图上，统计每次工具调用的耗时 / 失败，以及 LLM 的 token 用量"""
+    run_inline = True  # 在当前事件循环中直接回调，不走线程池
+
+    def __init__(self):
+        self._tool_runs: dict = {}  # run_id -> (工具名, 开始时间)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        name = kwargs.get("name") or (serialized or {}).get("name", "unknown")
+        self._tool_runs[run_id] = (name, time.perf_counter())
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        name, start = self._tool_runs.pop(run_id, (None, 0.0))
+        if name is None:
+            return
+        TOOL_CALL_SECONDS.labels(tool=name).observe(time.perf_counter() - start)
+        # handle_tool_error 会把异常转成 status="error" 的 ToolMessage，不触发 on_tool_error
+        if getattr(output, "status", None) == "error":
+            TOOL_CALL_ERRORS.labels(tool=name).inc()
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        name, start = self._tool_runs.pop(run_id, (None, 0.0))
+        if name is None:
+            return
+        TOOL_CALL_SECONDS.labels(tool=name).observe(time.perf_counter() - start)
+        TOOL_CALL_ERRORS.labels(tool=name).inc()
+
+    def on_llm_end(self, response, *, run_id, tags=None, **kwargs):
+        purpose = "summary" if "context_summary" in (tags or []) else "chat"
+        for generations in response.generations:
+            for gen in generations:
+                usage = getattr(getattr(gen, "message", None), "usage_metadata", None)
+                if usage:
+                    LLM_TOKENS.labels(purpose=purpose, kind="prompt").inc(usage.get("input_tokens", 0))
+                    LLM_TOKENS.labels(purpose=purpose, kind="completion").inc(usage.get("output_tokens", 0))
+
+
+def timed_node(name: str, node):
+    """给图节点加耗时统计；functools.wraps 保留原签名，LangGraph 仍会按需注入 config"""
+    @functools.wraps(node)
+    async def wrapper(*args, **kwargs):
+        with GRAPH_NODE_SECONDS.labels(node=name).time():
+            return await node(*args, **kwargs)
+    return wrapper
+
+
+class TimedSqliteSaver(AsyncSqliteSaver):
+    """统计 checkpoint 读写耗时的 AsyncSqliteSaver"""
+    async def aget_tuple(self, config):
+        with CHECKPOINT_SECONDS.labels(op="get").time():
+            return await super().aget_tuple(config)
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        with CHECKPOINT_SECONDS.labels(op="put").time():
+            return await super().aput(config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        with CHECKPOINT_SECONDS.labels(op="put_writes").time():
+            return await super().aput_writes(config, writes, task_id, task_path)
 
 # 文件管理工具名称集合（需要自动注入 username 的工具）
 FILE_TOOLS = {"list_files", "read_file", "write_file", "append_file", "delete_file"}
+# 定时任务工具名称集合（需要自动注入 user_id 的工具）
+SCHEDULER_TOOLS = {"add_alarm", "add_alarms", "list_alarms", "delete_alarm", "delete_alarms"}
+# 由系统注入、不应由 LLM 提供的参数名
+INJECTED_ARGS = {"username", "user_id"}
 
 
 class UserAwareToolNode:
     """
     自定义工具节点：从 RunnableConfig 中读取 thread_id，
-    自动注入为文件管理工具的 username 参数。
-    LLM 不需要传 username，由 config.thread_id 自动提供。
+    自动注入为文件管理工具的 username 参数、定时任务工具的 user_id 参数。
+    LLM 不需要传这些参数，由 config.thread_id 自动提供（LLM 传了也会被覆盖）。
     """
     def __init__(self, tools):
         self.tool_node = ToolNode(tools)
@@ -77,11 +247,13 @@ class UserAwareToolNode:
         if not hasattr(last_message, "tool_calls") or not last_message.tool_calls:
             return {"messages": []}
 
-        # 深拷贝并注入 username
+        # 深拷贝并注入用户身份
         modified_message = copy.deepcopy(last_message)
         for tc in modified_message.tool_calls:
             if tc["name"] in FILE_TOOLS:
                 tc["args"]["username"] = thread_id
+            elif tc["name"] in SCHEDULER_TOOLS:
+                tc["args"]["user_id"] = thread_id
 
         modified_state = {**state, "messages": state["messages"][:-1] + [modified_message]}
         return await self.tool_node.ainvoke(modified_state, config)
@@ -93,6 +265,8 @@ class State(TypedDict):
     messages: Annotated[list, add_messages]
     # 标记来源：区分 "user" 或 "system"
     trigger_source: str 
+    # 滚动摘要：被折叠出上下文的早期对话
+    summary: str
 
 # --- 2. 定义节点 (Nodes) ---
 def get_model():
@@ -116,6 +290,8 @@ def get_model():
         timeout=60,
         # 5. 最大重试次数，应对网络波动
         max_retries=2,
+        # 流式输出时也返回 token 用量（/metrics 统计用）
+        stream_usage=True,
         # 6. 如果使用中转 API，取消下面注释
         # api_base="https://your-proxy-url.com/v1"
     )
@@ -137,10 +313,15 @@ async def call_model(state: State):
     base_prompt = (
         "你是一个专业的智能助理，具备以下能力：\n"
         "1. 定时任务管理：可以为用户设置、查看和删除闹钟/定时任务。\n"
-        "2. 联网搜索：当用户询问实时信息、新闻或需要查询资料时，请主动使用搜索工具。\n"
+        "2. 联网搜索：当用户询问实时信息、新闻或需要查询资料时，请主动使用搜索工具；需要搜索多个关键词时，请用 web_search_many 在一次调用中完成，不要连续多次调用 web_search。\n"
         "3. 文件管理：可以为用户创建、读取、追加、删除和列出文件。"
         "调用文件管理工具（list_files, read_file, write_file, append_file, delete_file）时，"
-        "username 参数由系统自动注入，你不需要也不应该提供该参数。\n\n"
+        "username 参数由系统自动注入，你不需要也不应该提供该参数。"
+        "定时任务工具（add_alarm, add_alarms, list_alarms, delete_alarm, delete_alarms）的 user_id 参数"
+        "同样由系统自动注入，且只能查看和删除当前用户自己的任务。"
+        "需要一次设置或删除多个闹钟时，请使用 add_alarms / delete_alarms 在一次调用中完成。"
+        "只需提醒一次的事项（如“明天下午3点提醒我”）请用 run_at 设置一次性任务，不要写成 Cron 表达式。"
+        f"当前时间：{datetime.now():%Y-%m-%d %H:%M}（星期{'一二三四五六日'[datetime.now().weekday()]}）。\n\n"
         "【工具使用规则】\n"
         "- 只有当用户明确要求【测试工具】或【测试tool】时，才对工具进行测试性调用。"
         "日常对话中不要主动测试工具。\n"
@@ -149,11 +330,30 @@ async def call_model(state: State):
         "- 当你需要回忆或查询用户之前记录的长期信息时，请使用文件管理工具读取用户的文件。\n"
     )
     
+    # 上下文预算：超出时把早期消息折叠进滚动摘要
+    messages = state["messages"]
+    summary = state.get("summary", "")
+    removed = []
+    is_system = state.get("trigger_source") == "system"
+    if CONTEXT_TOKEN_BUDGET > 0:
+        total = context_budget.estimate_tokens(base_prompt + summary) + sum(
+            context_budget.message_tokens(m) for m in messages
+        )
+        if total > CONTEXT_TOKEN_BUDGET:
+            cut = context_budget.find_cut(messages, CONTEXT_KEEP_TOKENS)
+            if cut > 0:
+                old, messages = messages[:cut], messages[cut:]
+                # 系统触发不改动数据库状态，只裁剪本次输入
+                if not is_system:
+                    summary = await context_budget.summarize(app.state.summary_llm, summary, old)
+                    removed = context_budget.removals(old)
+    context = [SystemMessage(content=base_prompt)] + context_budget.summary_message(summary)
+
     # 针对系统触发（外部定时）的特殊逻辑
-    if state.get("trigger_source") == "system":
+    if is_system:
         # 构造一个临时的总结指令，不进入历史记录
         summary_prompt = "【系统指令】：请对该用户之前的对话进行核心诉求总结，供管理员参考。"
-        input_messages = [SystemMessage(content=base_prompt), SystemMessage(content=summary_prompt)] + state["messages"]
+        input_messages = context + [SystemMessage(content=summary_prompt)] + messages
         
         response = await llm.ainvoke(input_messages)
         
@@ -163,44 +363,80 @@ async def call_model(state: State):
         return {} 
 
     # 针对用户触发的正常对话逻辑
-    input_messages = [SystemMessage(content=base_prompt)] + state["messages"]
+    input_messages = context + messages
     response = await llm.ainvoke(input_messages)
-    
+
+    if removed:
+        return {"messages": removed + [response], "summary": summary}
     return {"messages": [response]}
 
 
 # --- 4. FastAPI 生命周期管理 ---
 
+async def checkpoint_retention_loop():
+    """后台定期清理旧 checkpoint（在线程中执行，分批删除，不阻塞事件循环）"""
+    max_age = CHECKPOINT_MAX_AGE_DAYS * 86400 if CHECKPOINT_MAX_AGE_DAYS else None
+    while True:
+        await asyncio.sleep(CHECKPOINT_PRUNE_INTERVAL)
+        try:
+            stats = await asyncio.to_thread(
+                prune_checkpoints, db_path,
+                keep_last=CHECKPOINT_KEEP_LAST, max_age=max_age, vacuum_pages=CHECKPOINT_VACUUM_PAGES,
+            )
+            print(f"🧹 checkpoint 清理完成：{format_stats(stats)}")
+        except Exception as e:
+            print(f"⚠️ checkpoint 清理失败: {e}")
+
+
+async def run_system_task(user_id: str, text: str) -> str:
+    """执行一次系统触发任务，返回模型输出（call_model 对 system 触发不写回消息，从事件流中取结果）"""
+    agent_app = app.state.agent_app
+    config = {"configurable": {"thread_id": user_id}}
+    system_input = {
+        "messages": [HumanMessage(content=f"执行指令: {text}")],
+        "trigger_source": "system"
+    }
+    output = ""
+    async with thread_serializer.hold(user_id):
+        async for ev in agent_app.astream_events(system_input, config, version="v2"):
+            if ev["event"] == "on_chat_model_end" and "context_summary" not in ev.get("tags", []):
+                message = ev["data"].get("output")
+                if message is not None:
+                    output = message.content
+    return output
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # 初始化异步数据库连接
-    async with AsyncSqliteSaver.from_conn_string(db_path) as memory:
+    user_registry.reload()
+    if hasattr(signal, "SIGHUP"):
+        # kill -HUP <pid> 强制重载用户表（Windows 无 SIGHUP）
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, user_registry.reload)
+
+    # 初始化异步数据库连接（新库预先开启增量 VACUUM）
+    init_database(db_path)
+    async with TimedSqliteSaver.from_conn_string(db_path) as memory:
         # 编译 Agent
-        # 1. 定义服务器配置
-        # 注意：这里我们手动指定 python 解释器和脚本路径
-        client = MultiServerMCPClient({
-            "scheduler_service": {
-                "command": "python",
-                "args": [os.path.join(current_dir, "mcp_scheduler.py")],
-                "transport": "stdio"
-            },
-            "search_service": {
-                "command": "python",
-                "args": [os.path.join(current_dir, "mcp_search.py")],
-                "transport": "stdio"
-            },
-            "file_service": {
-                "command": "python",
-                "args": [os.path.join(current_dir, "mcp_filemanager.py")],
-                "transport": "stdio"
-            }
-        })
-
-        # 2. 获取工具列表
-        # get_tools() 会自动启动子进程并获取定义的 @mcp.tool()
-        tools = await client.get_tools()
+        # 1. 获取工具列表
+        pool = None
+        if MCP_TOOL_MODE == "inprocess":
+            # 直接导入 MCP 服务模块中的工具函数，在当前事件循环中执行
+            tools = load_local_tools(list(MCP_SERVERS.values()))
+        else:
+            # MCP_TOOL_MODE=pooled：每个服务保持 MCP_POOL_SIZE 条常驻会话，子进程退出时自动重启
+            # MCP_TOOL_MODE=stdio：每次工具调用都新起子进程（原始行为）
+            connections = build_mcp_connections()
+            interceptors = []
+            if MCP_TOOL_MODE == "pooled":
+                pool = MCPSessionPool(connections, size=MCP_POOL_SIZE)
+                await pool.start()
+                interceptors.append(pool)
+            client = MultiServerMCPClient(connections, tool_interceptors=interceptors)
+            # get_tools() 会自动启动子进程并获取定义的 @mcp.tool()
+            tools = await client.get_tools()
         app.state.mcp_tools = tools # 存起来备用
         app.state.sharedllm= get_model().bind_tools(app.state.mcp_tools)
+        app.state.summary_llm = get_model()  # 生成滚动摘要用，不绑定工具
 
 
                 # --- 3. 构建工作流 (Workflow) ---
@@ -209,8 +445,8 @@ async def lifespan(app: FastAPI):
         workflow = StateGraph(State)
 
         # 添加节点
-        workflow.add_node("chatbot", call_model)
-        workflow.add_node("tools", UserAwareToolNode(tools)) # 自动注入 username 的工具节点
+        workflow.add_node("chatbot", timed_node("chatbot", call_model))
+        workflow.add_node("tools", timed_node("tools", UserAwareToolNode(tools))) # 自动注入 username 的工具节点
 
         # 设置起点
         workflow.add_edge(START, "chatbot")
@@ -224,9 +460,31 @@ async def lifespan(app: FastAPI):
 
         # 工具执行完后，必须回到 chatbot 让模型看结果
         workflow.add_edge("tools", "chatbot")
-        app.state.agent_app = workflow.compile(checkpointer=memory)
-        print("--- Agent 服务已启动，外部定时/用户输入双兼容就绪 ---")
-        yield
+        app.state.agent_app = workflow.compile(checkpointer=memory).with_config(
+            {"callbacks": [MetricsCallbackHandler()]}
+        )
+        print(f"--- Agent 服务已启动（工具模式: {MCP_TOOL_MODE}），外部定时/用户输入双兼容就绪 ---")
+        # 系统触发任务执行池
+        run_store = RunStore(system_runs_path)
+        await run_store.open()
+        app.state.system_runner = SystemRunner(
+            run_system_task, run_store,
+            workers=SYSTEM_RUN_WORKERS, queue_size=SYSTEM_RUN_QUEUE, user_rate=SYSTEM_RUN_USER_RATE,
+        )
+        app.state.system_runner.start()
+
+        retention_task = None
+        if CHECKPOINT_PRUNE_INTERVAL > 0 and (CHECKPOINT_KEEP_LAST or CHECKPOINT_MAX_AGE_DAYS):
+            retention_task = asyncio.create_task(checkpoint_retention_loop())
+        try:
+            yield
+        finally:
+            if retention_task is not None:
+                retention_task.cancel()
+            await app.state.system_runner.shutdown(SYSTEM_RUN_DRAIN_TIMEOUT)
+            await run_store.close()
+            if pool is not None:
+                await pool.close()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -237,9 +495,13 @@ class LoginRequest(BaseModel):
     password: str
 
 class UserRequest(BaseModel):
-    user_id: str
-    password: str
     text: str
+    # 携带 Authorization 令牌时可省略
+    user_id: Optional[str] = None
+    password: Optional[str] = None
+
+class LogoutRequest(BaseModel):
+    all: bool = False  # True 时吊销该用户的全部令牌
 
 class SystemTriggerRequest(BaseModel):
     user_id: str
@@ -249,49 +511,156 @@ class SystemTriggerRequest(BaseModel):
 @app.post("/login")
 async def login(req: LoginRequest):
     if verify_password(req.user_id, req.password):
-        return {"status": "success", "message": "登录成功"}
+        token, expires_at = token_manager.issue(req.user_id)
+        return {"status": "success", "message": "登录成功", "token": token, "expires_at": expires_at}
     raise HTTPException(status_code=401, detail="用户名或密码错误")
 
+# 令牌续期：用未过期的令牌换取新令牌
+@app.post("/refresh")
+async def refresh_token(authorization: Optional[str] = Header(None)):
+    payload = get_token_payload(authorization)
+    token, expires_at = token_manager.issue(payload["uid"])
+    return {"status": "success", "token": token, "expires_at": expires_at}
+
+# 注销：吊销当前令牌，或该用户的全部令牌
+@app.post("/logout")
+async def logout(req: LogoutRequest, authorization: Optional[str] = Header(None)):
+    payload = get_token_payload(authorization)
+    if req.all:
+        token_manager.revoke_user(payload["uid"])
+    else:
+        token_manager.revoke(payload)
+    return {"status": "success"}
+
+# 用户表重载接口：仅允许本机调用
+@app.post("/reload_users")
+async def reload_users(request: Request):
+    if request.client is None or request.client.host not in ("127.0.0.1", "::1"):
+        raise HTTPException(status_code=403, detail="仅允许本机调用")
+    return {"status": "success", "users": user_registry.reload()}
+
 # A. 用户输入接口（需要密码验证）
 @app.post("/ask")
-async def ask_agent(req: UserRequest):
-    if not verify_password(req.user_id, req.password):
-        raise HTTPException(status_code=401, detail="用户名或密码错误")
+async def ask_agent(req: UserRequest, authorization: Optional[str] = Header(None)):
+    user_id = authenticate(req, authorization)
+    try:
+        admission.check()
+    except AdmissionRejected as e:
+        raise too_busy(e)
 
     agent_app = app.state.agent_app
-    config = {"configurable": {"thread_id": req.user_id}}
-    
-    user_input = {
-        "messages": [HumanMessage(content=req.text)],
-        "trigger_source": "user"
-    }
-    
-    result = await agent_app.ainvoke(user_input, config)
+    config = {"configurable": {"thread_id": user_id}}
+
+    async def turn(texts: list[str]):
+        # 合并模式下 texts 可能包含排队期间到达的多条消息
+        user_input = {
+            "messages": [HumanMessage(content=t) for t in texts],
+            "trigger_source": "user"
+        }
+        async with admission.slot(user_id):
+            return await agent_app.ainvoke(user_input, config)
+
+    try:
+        result = await thread_serializer.run(user_id, req.text, turn)
+    except AdmissionRejected as e:
+        raise too_busy(e)
     return {
         "status": "success",
         "response": result["messages"][-1].content
     }
 
+def sse_event(event: str, data: dict) -> str:
+    """把一条事件编码为 Server-Sent Events 帧"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# A2. 流式用户输入接口：逐 token / 工具事件推送（SSE）
+@app.post("/ask_stream")
+async def ask_agent_stream(req: UserRequest, authorization: Optional[str] = Header(None)):
+    user_id = authenticate(req, authorization)
+    try:
+        admission.check()
+    except AdmissionRejected as e:
+        raise too_busy(e)
+
+    agent_app = app.state.agent_app
+    config = {"configurable": {"thread_id": user_id}}
+
+    user_input = {
+        "messages": [HumanMessage(content=req.text)],
+        "trigger_source": "user"
+    }
+
+    async def event_stream():
+        # 事件类型：token（LLM 增量输出）、tool_start / tool_end（工具调用）、done、error
+        final_text = ""
+        try:
+            async with thread_serializer.hold(user_id), admission.slot(user_id):
+                async for ev in agent_app.astream_events(user_input, config, version="v2"):
+                    if "context_summary" in ev.get("tags", []):
+                        continue  # 上下文摘要的内部调用不推送给前端
+                    kind = ev["event"]
+                    if kind == "on_chat_model_stream":
+                        chunk = ev["data"]["chunk"]
+                        if isinstance(chunk.content, str) and chunk.content:
+                            yield sse_event("token", {"text": chunk.content})
+                    elif kind == "on_chat_model_end":
+                        output = ev["data"].get("output")
+                        if output is not None and not getattr(output, "tool_calls", None):
+                            final_text = output.content
+                    elif kind == "on_tool_start":
+                        args = ev["data"].get("input") or {}
+                        if isinstance(args, dict):
+                            args = {k: v for k, v in args.items() if k not in INJECTED_ARGS}
+                        yield sse_event("tool_start", {"name": ev["name"], "args": args, "run_id": ev["run_id"]})
+                    elif kind == "on_tool_end":
+                        yield sse_event("tool_end", {"name": ev["name"], "run_id": ev["run_id"]})
+                yield sse_event("done", {"response": final_text})
+        except AdmissionRejected as e:
+            yield sse_event("error", {"error": str(e), "retry_after": e.retry_after})
+        except Exception as e:
+            yield sse_event("error", {"error": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # B. 外部定时器触发接口 (兼容独立进程/Cron任务)
 @app.post("/system_trigger")
 async def system_trigger(req: SystemTriggerRequest):
-    agent_app = app.state.agent_app
-    config = {"configurable": {"thread_id": req.user_id}}
-    
-    # 注意：这里的输入不会被持久化到数据库，因为 call_model 针对 system 触发返回了 {}
-    system_input = {
-        "messages": [HumanMessage(content=f"执行指令: {req.text}")],
-        "trigger_source": "system"
-    }
-    
-    # 异步触发，不需要等待结果返回给外部定时器，或者返回执行成功即可
-    asyncio.create_task(agent_app.ainvoke(system_input, config))
+    # 放入有界队列由 worker 执行，立即返回 run_id；结果可通过 /system_runs 查询
+    try:
+        run_id = await app.state.system_runner.submit(req.user_id, req.text)
+    except SystemRunRejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
 
     return {
         "status": "received",
+        "run_id": run_id,
         "message": f"已经为用户 {req.user_id} 启动外部定时任务"
     }
 
+# C. 系统触发任务执行记录查询
+@app.get("/system_runs")
+async def list_system_runs(user_id: Optional[str] = None, status: Optional[str] = None, limit: int = 50):
+    runner = app.state.system_runner
+    runs = await runner.store.query(user_id=user_id, status=status, limit=min(limit, 500))
+    return {"stats": runner.stats(), "runs": runs}
+
+@app.get("/system_runs/{run_id}")
+async def get_system_run(run_id: str):
+    run = await app.state.system_runner.store.get(run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="未找到执行记录")
+    return run
+
+# D. Prometheus 指标
+@app.get("/metrics")
+async def metrics_endpoint():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 if __name__ == "__main__":
     # 启动命令：python main.py
     uvicorn.run(app, host="127.0.0.1", port=int(os.getenv("PORT_AGENT", "51200")))
\ No newline at end of file
@@ -0,0 +1,38 @@
+"""
+进程内工具加载：直接导入 mcp_*.py 中 @mcp.tool() 注册的函数，包装为 LangChain 工具。
+
+工具名称、描述与参数 schema 均取自 FastMCP 的注册信息，与 stdio 模式下
+MultiServerMCPClient 得到的工具完全一致（UserAwareToolNode 的 username 注入照常生效），
+但调用直接在 Agent 的事件循环中执行，省去子进程与 JSON-RPC 管道开销。
+"""
+import importlib
+
+from langchain_core.tools import StructuredTool, ToolException
+
+
+def _to_langchain_tool(tool) -> StructuredTool:
+    """把 FastMCP 的 Tool 包装成 StructuredTool，参数校验沿用 FastMCP 的 fn_metadata"""
+    async def call_tool(**arguments):
+        try:
+            return await tool.run(arguments)
+        except Exception as e:
+            # 与 MCP 模式的 isError 结果一致：错误信息作为工具输出返回给模型
+            raise ToolException(str(e)) from e
+
+    return StructuredTool(
+        name=tool.name,
+        description=tool.description or "",
+        args_schema=tool.parameters,
+        coroutine=call_tool,
+        handle_tool_error=True,
+    )
+
+
+def load_local_tools(module_names: list[str]) -> list[StructuredTool]:
+    """导入给定的 MCP 服务模块，返回其全部工具"""
+    tools = []
+    for module_name in module_names:
+        module = importlib.import_module(module_name)
+        for tool in module.mcp._tool_manager.list_tools():
+            tools.append(_to_langchain_tool(tool))
+    return tools
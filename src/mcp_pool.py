@@ -0,0 +1,144 @@
+"""
+MCP 会话池：为每个 MCP 服务保持若干条常驻 stdio 会话。
+
+默认的 MultiServerMCPClient 每次工具调用都会重新拉起一个 python 子进程并完成
+MCP 握手；会话池在 Agent 生命周期内复用子进程，子进程退出时自动重启。
+通过 tool_interceptors 接入 MultiServerMCPClient，工具名称与参数 schema 不变。
+
+子进程是否存活在每次调用前检查（子进程退出后其 stdout 关闭，读取流不再有写入端），
+发现已退出就先重启再发送。调用失败时只有"请求尚未写出"的传输错误才自动重试：
+请求一旦发出，服务端可能已经执行（如 add_alarm），重发会重复执行。
+"""
+import asyncio
+from typing import Optional
+
+import anyio
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.stdio import stdio_client
+
+
+class PooledSession:
+    """
+    单条常驻会话。
+    会话由专属的后台任务打开和关闭（stdio 传输基于 anyio，进入与退出必须在同一任务内）。
+    """
+    def __init__(self, server_name: str, connection: dict):
+        self.server_name = server_name
+        self.connection = connection
+        self.session = None
+        self._read = None  # 会话的读取流，用于判断子进程是否仍在输出
+        self.inflight = 0
+        self.restarts = 0
+        self._task: Optional[asyncio.Task] = None
+        self._stop: Optional[asyncio.Event] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def alive(self) -> bool:
+        if self.session is None or self._task is None or self._task.done():
+            return False
+        # 子进程退出后 stdout 读到 EOF，读取流的写入端随之关闭
+        return self._read.statistics().open_send_streams > 0
+
+    def _params(self) -> StdioServerParameters:
+        c = self.connection
+        return StdioServerParameters(
+            command=c["command"], args=c.get("args", []), env=c.get("env"), cwd=c.get("cwd"),
+            encoding=c.get("encoding", "utf-8"), encoding_error_handler=c.get("encoding_error_handler", "strict"),
+        )
+
+    async def _run(self, ready: asyncio.Future):
+        try:
+            async with (
+                stdio_client(self._params()) as (read, write),
+                ClientSession(read, write, **(self.connection.get("session_kwargs") or {})) as session,
+            ):
+                await session.initialize()
+                self._read = read
+                self.session = session
+                ready.set_result(None)
+                await self._stop.wait()
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                print(f"⚠️ MCP 会话 {self.server_name} 异常退出: {e}")
+        finally:
+            self.session = None
+            self._read = None
+
+    async def start(self):
+        ready = asyncio.get_running_loop().create_future()
+        self._stop = asyncio.Event()
+        self._task = asyncio.create_task(self._run(ready))
+        await ready
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stop.set()
+        try:
+            await asyncio.wait_for(self._task, timeout=5)
+        except Exception:
+            self._task.cancel()
+        self._task = None
+        self.session = None
+
+    async def ensure_alive(self, force_restart: bool = False):
+        """会话已断开（子进程退出）或请求未能写出时重启"""
+        async with self._lock:
+            if self.alive and not force_restart:
+                return
+            if self._task is not None:
+                self.restarts += 1
+                print(f"🔄 重启 MCP 会话 {self.server_name}（第 {self.restarts} 次）")
+            await self.stop()
+            await self.start()
+
+
+class MCPSessionPool:
+    """
+    按服务名管理常驻会话，每个服务 size 条。
+    实例本身即是一个 tool interceptor：工具调用被路由到在途请求最少的会话上执行。
+    """
+    def __init__(self, connections: dict, size: int = 1):
+        self.size = max(1, size)
+        self.slots = {
+            name: [PooledSession(name, conn) for _ in range(self.size)]
+            for name, conn in connections.items()
+            if conn.get("transport") == "stdio"
+        }
+
+    async def start(self):
+        await asyncio.gather(*(s.start() for slots in self.slots.values() for s in slots))
+        print(f"🔌 MCP 会话池已就绪：{len(self.slots)} 个服务 × {self.size} 条会话")
+
+    async def close(self):
+        await asyncio.gather(
+            *(s.stop() for slots in self.slots.values() for s in slots),
+            return_exceptions=True,
+        )
+
+    def _pick(self, server_name: str) -> PooledSession:
+        return min(self.slots[server_name], key=lambda s: s.inflight)
+
+    async def call_tool(self, server_name: str, name: str, args: dict):
+        slot = self._pick(server_name)
+        slot.inflight += 1
+        try:
+            await slot.ensure_alive()
+            try:
+                return await slot.session.call_tool(name, args)
+            except (anyio.ClosedResourceError, anyio.BrokenResourceError) as e:
+                # 写入流已关闭：请求没有发出，重启后重试一次是安全的。
+                # 其他错误（如发出后连接断开）不重试，下一次调用前的存活检查会重启会话
+                print(f"⚠️ MCP 会话 {server_name} 调用 {name} 时连接已断开，重启后重试: {type(e).__name__} {e}")
+                await slot.ensure_alive(force_restart=True)
+                return await slot.session.call_tool(name, args)
+        finally:
+            slot.inflight -= 1
+
+    async def __call__(self, request, handler):
+        if request.server_name not in self.slots:
+            return await handler(request)
+        return await self.call_tool(request.server_name, request.name, request.args)
@@ -1,6 +1,7 @@
 from mcp.server.fastmcp import FastMCP
 import httpx
 import os
+from typing import Optional
 from dotenv import load_dotenv
 
 # 初始化 MCP 服务
@@ -14,56 +15,171 @@ load_dotenv(dotenv_path=os.path.join(root_dir, "config", ".env"))
 PORT_SCHEDULER = int(os.getenv("PORT_SCHEDULER", "51201"))
 SCHEDULER_URL = f"http://127.0.0.1:{PORT_SCHEDULER}/tasks"
 
+
+def alarm_payload(user_id: str, text: str, cron: str = "", run_at: str = "", interval_seconds: int = 0) -> dict:
+    """按给出的参数确定触发方式：interval_seconds > 0 为固定间隔，只给 run_at 为一次性，否则为 Cron"""
+    payload = {"user_id": user_id, "text": text}
+    if interval_seconds:
+        payload.update(trigger="interval", interval_seconds=interval_seconds)
+        if run_at:
+            payload["run_at"] = run_at
+    elif run_at and not cron:
+        payload.update(trigger="date", run_at=run_at)
+    else:
+        payload["cron"] = cron
+    return payload
+
+
+def describe_rule(t: dict) -> str:
+    if t.get("trigger") == "date":
+        return f"一次性 {t['run_at']}"
+    if t.get("trigger") == "interval":
+        seconds = t["interval_seconds"]
+        for unit, size in (("天", 86400), ("小时", 3600), ("分钟", 60)):
+            if seconds % size == 0:
+                return f"每 {seconds // size} {unit}"
+        return f"每 {seconds} 秒"
+    return t["cron"]
+
+
 @mcp.tool()
-async def add_alarm(user_id: str, cron: str, text: str) -> str:
+async def add_alarm(user_id: str, text: str, cron: str = "", run_at: str = "", interval_seconds: int = 0,
+                    coalesce: Optional[bool] = None) -> str:
     """
-    为用户设置一个定时任务（闹钟）。
-    :param user_id: 用户唯一标识符
-    :param cron: Cron 表达式 (分 时 日 月 周)，例如 "0 1 * * *" 代表凌晨1点
+    为用户设置一个定时任务（闹钟）。重复的任务用 cron；只提醒一次的（如"明天下午3点提醒我"）用 run_at，
+    送达后自动删除；按固定间隔重复的（如"每 90 分钟提醒喝水"）用 interval_seconds。
+    :param user_id: 用户名（由系统自动注入，无需手动传递）
     :param text: 到点时需要执行的指令内容
+    :param cron: Cron 表达式 (分 时 日 月 周)，例如 "0 1 * * *" 代表每天凌晨1点
+    :param run_at: 一次性任务的触发时间，ISO 格式，例如 "2025-06-01T15:00:00"；与 interval_seconds 同时给出时为首次触发时间
+    :param interval_seconds: 固定间隔（秒，至少 60），不填则不是间隔任务
+    :param coalesce: 服务停机期间错过多次触发时是否只补发一次；每次都必须执行的任务（如服药打卡）设为 false，不填使用默认设置
     """
     async with httpx.AsyncClient() as client:
         try:
-            payload = {"user_id": user_id, "cron": cron, "text": text}
+            payload = alarm_payload(user_id, text, cron, run_at, interval_seconds)
+            if coalesce is not None:
+                payload["coalesce"] = coalesce
             resp = await client.post(SCHEDULER_URL, json=payload, timeout=10.0)
             if resp.status_code == 200:
                 data = resp.json()
+                if data["trigger"] == "date":
+                    return f"✅ 提醒设置成功！任务 ID: {data['task_id']}，将在 {data['run_at']} 提醒一次，送达后自动删除"
                 return f"✅ 闹钟设置成功！任务 ID: {data['task_id']}，下次运行时间: {data.get('next_run')}"
             return f"❌ 设置失败，服务器返回: {resp.text}"
         except Exception as e:
             return f"⚠️ 无法连接到定时服务器: {str(e)}"
 
 @mcp.tool()
-async def list_alarms() -> str:
-    """获取当前所有已设置的定时任务列表。"""
+async def add_alarms(user_id: str, alarms: list[dict]) -> str:
+    """
+    一次为用户设置多个定时任务（例如一周的日程），全部成功或全部不创建。
+    :param user_id: 用户名（由系统自动注入，无需手动传递）
+    :param alarms: 任务列表，每项为 {"cron": "分 时 日 月 周", "text": "到点时需要执行的指令内容"}；
+                   一次性提醒用 "run_at"（ISO 时间）代替 "cron"，固定间隔用 "interval_seconds"；
+                   每次都必须执行的任务（如服药打卡）加 "coalesce": false。各字段含义同 add_alarm
+    """
+    tasks = []
+    for a in alarms:
+        payload = alarm_payload(user_id, a.get("text", ""), a.get("cron", ""), a.get("run_at", ""), a.get("interval_seconds", 0))
+        if a.get("coalesce") is not None:
+            payload["coalesce"] = a["coalesce"]
+        tasks.append(payload)
     async with httpx.AsyncClient() as client:
         try:
-            resp = await client.get(SCHEDULER_URL)
-            tasks = resp.json()
+            resp = await client.post(f"{SCHEDULER_URL}:batch", json={"tasks": tasks}, timeout=30.0)
+        except httpx.HTTPError as e:
+            return f"⚠️ 无法连接到定时服务器: {str(e)}"
+    # 只有 200 与逐条校验失败的 400 是调度中心的 JSON 响应，其他（如代理返回的 502）原样报告
+    if resp.status_code not in (200, 400):
+        return f"❌ 设置失败，服务器返回: {resp.text}"
+    try:
+        data = resp.json()
+    except ValueError:
+        return f"❌ 设置失败，服务器返回: {resp.text}"
+    if resp.status_code == 200:
+        res = f"✅ 已设置 {len(data['tasks'])} 个闹钟:\n"
+        for t in data["tasks"]:
+            res += f"- [ID: {t['task_id']}] 规则: {describe_rule(t)}, 下次运行: {t['next_run']}, 内容: {t['text']}\n"
+        return res
+    detail = data.get("detail")
+    if isinstance(detail, dict) and detail.get("errors"):
+        res = f"❌ {detail['message']}:\n"
+        for e in detail["errors"]:
+            res += f"- 第 {e['index'] + 1} 项（{e['cron'] or e['trigger']}）: {e['error']}\n"
+        return res
+    return f"❌ 设置失败，服务器返回: {resp.text}"
+
+@mcp.tool()
+async def list_alarms(user_id: str, limit: int = 20, cursor: str = "") -> str:
+    """
+    获取当前用户已设置的定时任务列表（分页）。
+    :param user_id: 用户名（由系统自动注入，无需手动传递）
+    :param limit: 每页最多返回的任务数，默认 20
+    :param cursor: 翻页游标，填上一页结果末尾给出的值；查看第一页时留空
+    """
+    async with httpx.AsyncClient() as client:
+        try:
+            params = {"user_id": user_id, "limit": limit}
+            if cursor:
+                params["cursor"] = cursor
+            resp = await client.get(SCHEDULER_URL, params=params, timeout=10.0)
+            data = resp.json()
+            tasks = data["tasks"]
             if not tasks:
-                return "📭 当前没有设定任何闹钟。"
+                return "📭 当前没有设定任何闹钟。" if not cursor else "📭 没有更多闹钟了。"
             
             res = "📅 当前定时任务列表:\n"
             for t in tasks:
-                res += f"- [ID: {t['task_id']}] 规则: {t['cron']}, 内容: {t['text']}\n"
+                res += f"- [ID: {t['task_id']}] 规则: {describe_rule(t)}, 内容: {t['text']}\n"
+                catch_up = t.get("catch_up")
+                if catch_up:
+                    res += f"  （上次服务重启时错过 {catch_up['missed']} 次触发，已补发 {catch_up['replayed']} 次）\n"
+            if data.get("next_cursor"):
+                res += f"（还有更多，传 cursor=\"{data['next_cursor']}\" 查看下一页）\n"
             return res
         except Exception as e:
             return f"⚠️ 读取列表失败: {str(e)}"
 
 @mcp.tool()
-async def delete_alarm(task_id: str) -> str:
+async def delete_alarm(user_id: str, task_id: str) -> str:
     """
-    根据任务 ID 删除指定的定时任务。
+    根据任务 ID 删除当前用户的指定定时任务。
+    :param user_id: 用户名（由系统自动注入，无需手动传递）
     :param task_id: 之前创建任务时分配的 8 位 ID
     """
     async with httpx.AsyncClient() as client:
         try:
-            resp = await client.delete(f"{SCHEDULER_URL}/{task_id}")
+            resp = await client.delete(f"{SCHEDULER_URL}/{task_id}", params={"user_id": user_id}, timeout=10.0)
             if resp.status_code == 200:
                 return f"🗑️ 任务 {task_id} 已成功删除。"
             return f"❌ 删除失败: {resp.text}"
         except Exception as e:
             return f"⚠️ 连接失败: {str(e)}"
 
+@mcp.tool()
+async def delete_alarms(user_id: str, task_ids: list[str]) -> str:
+    """
+    一次删除当前用户的多个定时任务。
+    :param user_id: 用户名（由系统自动注入，无需手动传递）
+    :param task_ids: 要删除的任务 ID 列表
+    """
+    async with httpx.AsyncClient() as client:
+        try:
+            resp = await client.request(
+                "DELETE", f"{SCHEDULER_URL}:batch", json={"task_ids": task_ids, "user_id": user_id}, timeout=30.0
+            )
+            if resp.status_code != 200:
+                return f"❌ 删除失败: {resp.text}"
+            results = resp.json()["results"]
+            deleted = [r["task_id"] for r in results if r["status"] == "deleted"]
+            missing = [r["task_id"] for r in results if r["status"] != "deleted"]
+            res = f"🗑️ 已删除 {len(deleted)} 个任务" + (f": {', '.join(deleted)}" if deleted else "") + "。"
+            if missing:
+                res += f"\n未找到: {', '.join(missing)}"
+            return res
+        except Exception as e:
+            return f"⚠️ 连接失败: {str(e)}"
+
 if __name__ == "__main__":
     mcp.run()
\ No newline at end of file
@@ -1,59 +1,180 @@
+import os
+import math
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
 from mcp.server.fastmcp import FastMCP
 from ddgs import DDGS
+from dotenv import load_dotenv
+
+import search_format
+from search_cache import SearchCache, normalize_query
 
 mcp = FastMCP("WebSearcher")
 
+# 加载 .env 配置
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(current_dir)
+load_dotenv(dotenv_path=os.path.join(root_dir, "config", ".env"))
+
+# --- 搜索结果缓存（见 search_cache.py） ---
+# 网页搜索与新闻结果的缓存时长（秒），0 表示不缓存（并发的相同查询仍只请求一次）
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "1800"))
+NEWS_CACHE_TTL = float(os.getenv("NEWS_CACHE_TTL", "300"))
+# 内存中最多缓存的查询数
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "512"))
+# 磁盘缓存路径（SQLite），重启后仍有效；为空则只缓存在内存中
+SEARCH_CACHE_DB = os.getenv("SEARCH_CACHE_DB", "")
+if SEARCH_CACHE_DB and not os.path.isabs(SEARCH_CACHE_DB):
+    SEARCH_CACHE_DB = os.path.join(root_dir, SEARCH_CACHE_DB)
+
+cache = SearchCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_DB or None)
+
+# --- 上游请求并发与超时 ---
+# DDGS 是同步库，请求放到专用线程池中执行，避免一次慢搜索卡住整个 MCP 服务
+# 本进程同时进行的上游搜索数上限
+SEARCH_MAX_CONCURRENCY = max(1, int(os.getenv("SEARCH_MAX_CONCURRENCY", "4")))
+# 单次搜索的超时（秒），同时作为 DDGS 内部每个 HTTP 请求的超时
+SEARCH_TIMEOUT = float(os.getenv("SEARCH_TIMEOUT", "15"))
+
+# web_search_many 一次最多搜索的关键词数
+MAX_BATCH_QUERIES = 5
+# 每次搜索返回内容的默认 token 预算（见 search_format.py），web_search_many 为其两倍；调用时可用 max_tokens 覆盖
+SEARCH_OUTPUT_TOKENS = int(os.getenv("SEARCH_OUTPUT_TOKENS", "800"))
+
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_MAX_CONCURRENCY, thread_name_prefix="ddgs")
+search_slots = asyncio.Semaphore(SEARCH_MAX_CONCURRENCY)
+
+
+def ddgs_search(tool: str, query: str, max_results: int) -> list[dict]:
+    """在线程池中执行的阻塞调用"""
+    with DDGS(timeout=max(1, math.ceil(SEARCH_TIMEOUT))) as ddgs:
+        return list(getattr(ddgs, tool)(query, max_results=max_results))
+
+
+async def run_blocking(func, *args):
+    """
+    占用一个并发名额，在 search_executor 中执行 func(*args)，最多等待 SEARCH_TIMEOUT 秒。
+    超时或调用方被取消时：尚未开始的调用直接撤销；已在线程中运行的无法中断，
+    名额保留到线程结束才归还（线程内请求受 DDGS 自身超时约束），保证同时进行的上游请求不超过上限。
+    """
+    loop = asyncio.get_running_loop()
+
+    def release(_):
+        try:
+            loop.call_soon_threadsafe(search_slots.release)
+        except RuntimeError:
+            pass  # 事件循环已关闭
+
+    await search_slots.acquire()
+    future = search_executor.submit(func, *args)
+    future.add_done_callback(release)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), SEARCH_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"搜索超时（{SEARCH_TIMEOUT:g} 秒）") from None
+
+
+async def cached_search(tool: str, query: str, max_results: int) -> list[dict]:
+    """tool 为 "text" 或 "news"，返回 DuckDuckGo 的原始结果列表（可能来自缓存）"""
+    async def fetch():
+        return await run_blocking(ddgs_search, tool, query, max_results)
+
+    ttl = NEWS_CACHE_TTL if tool == "news" else SEARCH_CACHE_TTL
+    return await cache.get_or_fetch(cache.key(tool, query, max_results), ttl, fetch)
+
 
 @mcp.tool()
-async def web_search(query: str, max_results: int = 5) -> str:
+async def web_search(query: str, max_results: int = 5, max_tokens: int = 0, output_format: str = "text") -> str:
     """
     使用 DuckDuckGo 进行联网搜索，返回相关网页结果。
     :param query: 搜索关键词
     :param max_results: 返回结果数量，默认 5 条，最多 10 条
+    :param max_tokens: 本次结果的长度上限（token），不填使用默认设置；只需要链接或概览时可以调小
+    :param output_format: "text"（默认，编号列表）或 "json"（紧凑 JSON，便于逐条引用）
     """
     max_results = min(max_results, 10)
     try:
-        with DDGS() as ddgs:
-            results = list(ddgs.text(query, max_results=max_results))
+        results = await cached_search("text", query, max_results)
 
         if not results:
             return f"🔍 未找到与 \"{query}\" 相关的结果。"
 
-        output = f"🔍 搜索 \"{query}\" 的结果：\n\n"
-        for i, r in enumerate(results, 1):
-            title = r.get("title", "无标题")
-            body = r.get("body", "无摘要")
-            href = r.get("href", "")
-            output += f"{i}. **{title}**\n   {body}\n   链接: {href}\n\n"
-        return output
+        items = search_format.dedupe(search_format.normalize(results))
+        return search_format.render(
+            query, items, max_tokens or SEARCH_OUTPUT_TOKENS, output_format, header=f"🔍 搜索 \"{query}\" 的结果："
+        )
     except Exception as e:
         return f"⚠️ 搜索失败: {str(e)}"
 
 
 @mcp.tool()
-async def web_news(query: str, max_results: int = 5) -> str:
+async def web_search_many(queries: list[str], max_results: int = 5, max_tokens: int = 0,
+                          output_format: str = "text") -> str:
+    """
+    同时搜索多个关键词，合并去重后一次返回。需要查询多个方面（如对比几个产品、分别查几个人物或事件）时
+    使用本工具，代替连续多次调用 web_search。
+    :param queries: 搜索关键词列表，最多 5 个
+    :param max_results: 每个关键词返回的结果数量，默认 5 条，最多 10 条
+    :param max_tokens: 本次结果的长度上限（token），不填使用默认设置的两倍
+    :param output_format: "text"（默认，编号列表）或 "json"（紧凑 JSON，便于逐条引用）
+    """
+    max_results = min(max_results, 10)
+    unique = {}
+    for q in queries:
+        if q.strip():
+            unique.setdefault(normalize_query(q), q.strip())
+    queries = list(unique.values())
+    if not queries:
+        return "⚠️ 请至少提供一个搜索关键词。"
+    skipped = queries[MAX_BATCH_QUERIES:]
+    queries = queries[:MAX_BATCH_QUERIES]
+
+    outcomes = await asyncio.gather(
+        *(cached_search("text", q, max_results) for q in queries), return_exceptions=True
+    )
+    failed = [f"{q}（{r}）" for q, r in zip(queries, outcomes) if isinstance(r, Exception)]
+    ranked = [search_format.normalize(r, [i]) if isinstance(r, list) else [] for i, r in enumerate(outcomes, 1)]
+
+    # 按名次轮流取各关键词的结果，每个关键词的靠前结果都排在前面；重复结果合并并记下命中的关键词序号
+    items = search_format.dedupe([
+        results[rank] for rank in range(max_results) for results in ranked if rank < len(results)
+    ])
+    if not items and failed:
+        return "⚠️ 搜索失败: " + "；".join(failed)
+    footer = ""
+    if failed:
+        footer += "⚠️ 以下关键词搜索失败: " + "；".join(failed) + "\n"
+    if skipped:
+        footer += f"（超过 {MAX_BATCH_QUERIES} 个，未搜索: {'、'.join(skipped)}）\n"
+    if not items:
+        footer = "未找到相关结果。\n" + footer
+    header = f"🔍 批量搜索 {len(queries)} 个关键词：" + "  ".join(f"[{i}] {q}" for i, q in enumerate(queries, 1))
+    return search_format.render(
+        " | ".join(queries), items, max_tokens or SEARCH_OUTPUT_TOKENS * 2, output_format, header=header, footer=footer
+    )
+
+
+@mcp.tool()
+async def web_news(query: str, max_results: int = 5, max_tokens: int = 0, output_format: str = "text") -> str:
     """
     使用 DuckDuckGo 搜索最新新闻资讯。
     :param query: 新闻搜索关键词
     :param max_results: 返回结果数量，默认 5 条，最多 10 条
+    :param max_tokens: 本次结果的长度上限（token），不填使用默认设置
+    :param output_format: "text"（默认，编号列表）或 "json"（紧凑 JSON，便于逐条引用）
     """
     max_results = min(max_results, 10)
     try:
-        with DDGS() as ddgs:
-            results = list(ddgs.news(query, max_results=max_results))
+        results = await cached_search("news", query, max_results)
 
         if not results:
             return f"📰 未找到与 \"{query}\" 相关的新闻。"
 
-        output = f"📰 \"{query}\" 相关新闻：\n\n"
-        for i, r in enumerate(results, 1):
-            title = r.get("title", "无标题")
-            body = r.get("body", "无摘要")
-            source = r.get("source", "未知来源")
-            date = r.get("date", "")
-            url = r.get("url", "")
-            output += f"{i}. **{title}** ({source})\n   {body}\n   时间: {date}\n   链接: {url}\n\n"
-        return output
+        items = search_format.dedupe(search_format.normalize(results))
+        return search_format.render(
+            query, items, max_tokens or SEARCH_OUTPUT_TOKENS, output_format, header=f"📰 \"{query}\" 相关新闻："
+        )
     except Exception as e:
         return f"⚠️ 新闻搜索失败: {str(e)}"
 
@@ -0,0 +1,403 @@
+"""
+定时任务触发的投递队列（outbox），与任务表同在 data/timeset/tasks.db。
+
+- 任务到点时先写入 outbox 再投递，Agent 短暂重启期间的触发不会丢失；
+- 投递失败按指数退避重试（429 时遵循 Retry-After），达到次数上限或遇到不可重试的错误（如 4xx）
+  时移入死信，可通过 /outbox/dead 查看并手动重投；
+- 投递中途进程退出的记录会在下次启动时重新投递（至少一次语义）。
+- 一次性任务的触发标记为 final：送达时在同一事务中删除任务本身。
+- 多个调度实例共用同一个 outbox 时（shared=True），认领用单条 UPDATE … RETURNING 完成（需 SQLite 3.35+），
+  每条记录标记认领者；崩溃实例认领后超过 claim_timeout 秒未完成的记录由 requeue_stale() 放回队列。
+  单实例时同样需要定期调用：送达后删除记录失败的，也靠它放回队列（至少一次）。
+- 派发循环、enqueue 与各投递任务共用一个连接，写事务由 _write() 串行化：
+  否则其他协程的 commit 会夹在一个事务的多条语句之间，失败时的 rollback 也会撤销别人尚未提交的写入。
+
+整点集中触发时的平滑策略（都在派发时生效）：
+- 按 task_id 哈希得到固定的抖动偏移（0 ~ jitter 秒），同一任务每次偏移相同；
+- 同时在途的投递数上限（concurrency）；
+- 每秒最多发起 rate 次投递（令牌桶，突发上限为 0.1 秒的配额）。
+每次投递相对计划时间的延迟记录在 scheduler_fire_lateness_seconds 中。
+"""
+import time
+import zlib
+import random
+import asyncio
+import sqlite3
+from typing import Optional
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+import metrics
+
+OUTBOX_BACKLOG = metrics.Gauge("scheduler_outbox_backlog", "等待投递（含投递中）的触发数")
+OUTBOX_DEAD = metrics.Gauge("scheduler_outbox_dead", "死信中的触发数")
+DELIVERY_RETRIES = metrics.Counter("scheduler_delivery_retries_total", "安排重试的投递次数")
+DELIVERY_DEAD = metrics.Counter("scheduler_delivery_dead_total", "移入死信的触发数")
+# 送达后删除记录失败时的重试间隔（秒），None 表示放弃
+ACK_RETRY_DELAYS = (0.5, 2, None)
+
+FIRE_LATENESS = metrics.Histogram(
+    "scheduler_fire_lateness_seconds", "首次投递相对计划触发时间的延迟", ["cause"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+
+
+class DeliveryFailed(Exception):
+    """投递失败；retryable=False 时直接移入死信"""
+    def __init__(self, message: str, retryable: bool = True, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class Outbox:
+    """
+    send(item) 为实际投递的协程函数，item 为 outbox 中的一行（dict），
+    成功返回即视为送达，失败抛出 DeliveryFailed（其他异常按可重试处理）。
+    """
+    def __init__(self, path: str, send=None, concurrency: int = 20, max_attempts: int = 8,
+                 backoff_base: float = 2, backoff_max: float = 300, jitter: float = 0, rate: float = 0,
+                 owner: str = "local", shared: bool = False, claim_timeout: float = 120):
+        self.path = path
+        self.send = send
+        self.owner = owner
+        self.shared = shared
+        self.claim_timeout = claim_timeout
+        self.concurrency = max(1, concurrency)
+        self.jitter = max(0.0, jitter)
+        self.rate = max(0.0, rate)
+        self._burst = max(1.0, self.rate * 0.1)
+        self._tokens = self._burst
+        self._tokens_at = time.monotonic()
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.conn: Optional[aiosqlite.Connection] = None
+        self.backlog = 0
+        self.dead = 0
+        self._inflight: set[asyncio.Task] = set()
+        self._sending_ids: set[int] = set()  # 本进程正在投递的记录，requeue_stale 不会放回
+        self._write_lock: Optional[asyncio.Lock] = None
+        self._wakeup = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+        OUTBOX_BACKLOG.set_function(lambda: self.backlog)
+        OUTBOX_DEAD.set_function(lambda: self.dead)
+
+    async def open(self):
+        # 写事务以 BEGIN IMMEDIATE 开始：多个连接（或实例）同时写时在 busy timeout 内排队等锁，
+        # 而不是先读后写、升级写锁失败后留下持有旧快照的事务（之后每次写都报 database is locked）
+        self.conn = await aiosqlite.connect(self.path, isolation_level="IMMEDIATE")
+        self.conn.row_factory = aiosqlite.Row
+        self._write_lock = asyncio.Lock()  # 随连接创建，绑定当前事件循环
+        await self.conn.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id TEXT,
+                user_id TEXT NOT NULL,
+                text TEXT NOT NULL,
+                scheduled_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                status TEXT NOT NULL,
+                last_error TEXT,
+                claimed_by TEXT,
+                claimed_at REAL,
+                final INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt);
+            """
+        )
+        async with self.conn.execute("PRAGMA table_info(outbox)") as cur:
+            columns = {r["name"] for r in await cur.fetchall()}
+        for column, kind in (("claimed_by", "TEXT"), ("claimed_at", "REAL"), ("final", "INTEGER NOT NULL DEFAULT 0")):
+            if column not in columns:
+                try:
+                    await self.conn.execute(f"ALTER TABLE outbox ADD COLUMN {column} {kind}")
+                except sqlite3.OperationalError as e:
+                    if "duplicate column" not in str(e):
+                        raise
+        # 上次退出时正在投递的记录：结果未知，重新投递（共用时只处理自己的与超时的）
+        if self.shared:
+            await self.conn.execute(
+                "UPDATE outbox SET status = 'pending' WHERE status = 'sending' AND (claimed_by = ? OR claimed_at < ?)",
+                (self.owner, time.time() - self.claim_timeout),
+            )
+        else:
+            await self.conn.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'")
+        await self.conn.commit()
+        await self.refresh_counts()
+
+    @asynccontextmanager
+    async def _write(self):
+        """一个写事务：持锁执行，正常退出提交，出错只回滚自己的语句"""
+        async with self._write_lock:
+            try:
+                yield self.conn
+            except BaseException:
+                await self.conn.rollback()
+                raise
+            await self.conn.commit()
+
+    async def refresh_counts(self):
+        """从数据库重新统计积压与死信数（多实例共用时各实例的内存计数会偏离）"""
+        async with self.conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status") as cur:
+            counts = dict(await cur.fetchall())
+        self.backlog = counts.get("pending", 0) + counts.get("sending", 0)
+        self.dead = counts.get("dead", 0)
+
+    async def requeue_stale(self) -> int:
+        """把认领后超过 claim_timeout 秒仍未完成的记录放回队列（认领它的实例可能已崩溃）"""
+        sending = list(self._sending_ids)
+        async with self._write() as conn:
+            cur = await conn.execute(
+                "UPDATE outbox SET status = 'pending' WHERE status = 'sending' AND claimed_at < ? "
+                f"AND id NOT IN ({','.join('?' * len(sending))})",
+                (time.time() - self.claim_timeout, *sending),
+            )
+        if cur.rowcount:
+            self._wakeup.set()
+        return cur.rowcount
+
+    def start(self):
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def close(self, timeout: float = 5):
+        """停止派发，等待在途投递（最多 timeout 秒），未完成的留到下次启动重投"""
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        if self._inflight:
+            _, pending = await asyncio.wait(self._inflight, timeout=timeout)
+            for t in pending:
+                t.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        if self.conn is not None:
+            async with self._write() as conn:
+                await conn.execute(
+                    "UPDATE outbox SET status = 'pending' WHERE status = 'sending' AND claimed_by = ?", (self.owner,)
+                )
+            await self.conn.close()
+            self.conn = None
+
+    def jitter_for(self, key: str) -> float:
+        """同一 key 的抖动偏移固定不变：把 crc32 映射到 [0, jitter)"""
+        if not self.jitter:
+            return 0.0
+        return (zlib.crc32(key.encode("utf-8")) / 2 ** 32) * self.jitter
+
+    async def enqueue(self, task_id: Optional[str], user_id: str, text: str, scheduled_at: float,
+                      fired_at: Optional[float] = None, next_run: Optional[float] = None, final: bool = False):
+        """
+        scheduled_at 为计划触发时间，fired_at 为实际开始触发的时间（记为 created_at，默认为当前时间）。
+        给出 next_run 时在同一事务中更新任务表的下次触发时间：进程随后崩溃时，
+        接管方（或重启后）计算错过的触发不会把这一次再补发一遍。
+        final 表示一次性任务的最后一次触发：任务表的 next_run 置为 NULL，送达后删除任务
+        """
+        now = time.time()
+        deliver_at = max(now, scheduled_at + self.jitter_for(task_id or user_id))
+        async with self._write() as conn:
+            await conn.execute(
+                "INSERT INTO outbox (task_id, user_id, text, scheduled_at, created_at, next_attempt, status, final) "
+                "VALUES (?, ?, ?, ?, ?, ?, 'pending', ?)",
+                (task_id, user_id, text, scheduled_at, fired_at or now, deliver_at, int(final)),
+            )
+            if task_id is not None and (final or next_run is not None):
+                await conn.execute("UPDATE tasks SET next_run = ? WHERE task_id = ?", (next_run, task_id))
+        self.backlog += 1
+        self._wakeup.set()
+
+    async def enqueue_many(self, items: list[tuple], rate: float):
+        """
+        批量写入（一个事务）：items 为 (task_id, user_id, text, scheduled_at, final)，
+        按顺序每秒最多 rate 条排开投递时间，用于停机后的补发，不与正常触发争抢
+        """
+        if not items:
+            return
+        now = time.time()
+        interval = 1 / rate if rate > 0 else 0
+        async with self._write() as conn:
+            await conn.executemany(
+                "INSERT INTO outbox (task_id, user_id, text, scheduled_at, created_at, next_attempt, status, final) "
+                "VALUES (?, ?, ?, ?, ?, ?, 'pending', ?)",
+                [
+                    (task_id, user_id, text, scheduled_at, now, now + i * interval, int(final))
+                    for i, (task_id, user_id, text, scheduled_at, final) in enumerate(items)
+                ],
+            )
+        self.backlog += len(items)
+        self._wakeup.set()
+
+    async def _claim_due(self, limit: int) -> list[dict]:
+        """认领到期记录：单条语句完成选取与标记，多个实例同时认领也不会拿到同一条"""
+        async with self._write() as conn:
+            now = time.time()
+            async with conn.execute(
+                "UPDATE outbox SET status = 'sending', claimed_by = ?, claimed_at = ? WHERE id IN ("
+                "SELECT id FROM outbox WHERE status = 'pending' AND next_attempt <= ? ORDER BY next_attempt LIMIT ?"
+                ") RETURNING *",
+                (self.owner, now, now, limit),
+            ) as cur:
+                rows = [dict(r) for r in await cur.fetchall()]
+        rows.sort(key=lambda r: r["next_attempt"])
+        return rows
+
+    async def _next_due_in(self) -> Optional[float]:
+        async with self.conn.execute(
+            "SELECT MIN(next_attempt) FROM outbox WHERE status = 'pending'"
+        ) as cur:
+            (next_attempt,) = await cur.fetchone()
+        return None if next_attempt is None else max(0.0, next_attempt - time.time())
+
+    def _available_tokens(self) -> int:
+        if self.rate <= 0:
+            return self.concurrency
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._tokens_at) * self.rate)
+        self._tokens_at = now
+        return int(self._tokens)
+
+    async def _dispatch_loop(self):
+        while True:
+            self._wakeup.clear()
+            free = self.concurrency - len(self._inflight)
+            tokens = self._available_tokens()
+            if free > 0 and tokens > 0:
+                limit = min(free, tokens)
+                try:
+                    rows = await self._claim_due(limit)
+                except Exception as e:
+                    print(f"⚠️ 读取投递队列失败: {e}")
+                    rows = []
+                if self.rate > 0:
+                    self._tokens -= len(rows)
+                for row in rows:
+                    self._sending_ids.add(row["id"])
+                    task = asyncio.create_task(self._deliver(row))
+                    self._inflight.add(task)
+                    task.add_done_callback(self._on_done)
+                if rows and len(rows) == limit:
+                    continue
+                timeout = await self._next_due_in()
+            elif free > 0:
+                # 令牌用完：等到下一个令牌生成
+                timeout = (1 - self._tokens) / self.rate
+            else:
+                timeout = None  # 等在途投递完成（_on_done 会唤醒）
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _on_done(self, task: asyncio.Task):
+        self._inflight.discard(task)
+        self._wakeup.set()
+
+    def _backoff(self, attempts: int, retry_after: Optional[float]) -> float:
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+        # 随机打散，避免同时失败的一批投递在同一时刻重试
+        delay *= random.uniform(0.5, 1.0)
+        return max(delay, retry_after or 0)
+
+    async def _deliver(self, row: dict):
+        try:
+            await self._attempt(row)
+        finally:
+            self._sending_ids.discard(row["id"])
+
+    async def _attempt(self, row: dict):
+        if row["attempts"] == 0:
+            # 延迟分解：jitter 为按任务固定的抖动偏移，其余为限流/并发上限造成的排队
+            row["lateness"] = time.time() - row["scheduled_at"]
+            jitter = self.jitter_for(row["task_id"] or row["user_id"])
+            FIRE_LATENESS.labels(cause="total").observe(row["lateness"])
+            FIRE_LATENESS.labels(cause="queue").observe(max(0.0, row["lateness"] - jitter))
+        try:
+            await self.send(row)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            retryable = getattr(e, "retryable", True)
+            retry_after = getattr(e, "retry_after", None)
+            await self._failed(row, str(e) or type(e).__name__, retryable, retry_after)
+            return
+        for delay in ACK_RETRY_DELAYS:
+            try:
+                async with self._write() as conn:
+                    await conn.execute("DELETE FROM outbox WHERE id = ?", (row["id"],))
+                    if row["final"]:
+                        # 一次性任务已送达：任务本身不再需要保留
+                        await conn.execute(
+                            "DELETE FROM tasks WHERE task_id = ? AND next_run IS NULL", (row["task_id"],)
+                        )
+                break
+            except Exception as e:
+                if delay is None:
+                    # 记录仍为 sending，超过 claim_timeout 后由 requeue_stale 放回队列（会再投递一次）
+                    print(f"⚠️ 已送达但删除投递记录失败（用户 {row['user_id']}，记录 {row['id']}）: {e}")
+                    return
+                await asyncio.sleep(delay)
+        self.backlog -= 1
+
+    async def _failed(self, row: dict, error: str, retryable: bool, retry_after: Optional[float]):
+        attempts = row["attempts"] + 1
+        if retryable and attempts < self.max_attempts:
+            delay = self._backoff(attempts, retry_after)
+            async with self._write() as conn:
+                await conn.execute(
+                    "UPDATE outbox SET status = 'pending', attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?",
+                    (attempts, time.time() + delay, error, row["id"]),
+                )
+            DELIVERY_RETRIES.inc()
+            print(f"⚠️ 投递失败（用户 {row['user_id']}，第 {attempts} 次），{delay:.1f} 秒后重试: {error}")
+            return
+        async with self._write() as conn:
+            await conn.execute(
+                "UPDATE outbox SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?",
+                (attempts, error, row["id"]),
+            )
+        self.backlog -= 1
+        self.dead += 1
+        DELIVERY_DEAD.inc()
+        print(f"☠️ 投递失败已移入死信（用户 {row['user_id']}，共 {attempts} 次）: {error}")
+
+    def stats(self) -> dict:
+        return {
+            "backlog": self.backlog,
+            "inflight": len(self._inflight),
+            "dead": self.dead,
+            "max_inflight": self.concurrency,
+            "rate_per_second": self.rate,
+            "jitter_seconds": self.jitter,
+        }
+
+    async def list_dead(self, limit: int = 50) -> list[dict]:
+        async with self.conn.execute(
+            "SELECT * FROM outbox WHERE status = 'dead' ORDER BY id DESC LIMIT ?", (limit,)
+        ) as cur:
+            return [dict(r) for r in await cur.fetchall()]
+
+    async def retry_dead(self, item_id: int) -> bool:
+        """把一条死信放回队列立即重投（重置重试次数）"""
+        async with self._write() as conn:
+            cur = await conn.execute(
+                "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt = ? WHERE id = ? AND status = 'dead'",
+                (time.time(), item_id),
+            )
+        if cur.rowcount:
+            self.dead -= 1
+            self.backlog += 1
+            self._wakeup.set()
+        return cur.rowcount > 0
+
+    async def delete_dead(self, item_id: int) -> bool:
+        async with self._write() as conn:
+            cur = await conn.execute("DELETE FROM outbox WHERE id = ? AND status = 'dead'", (item_id,))
+        if cur.rowcount:
+            self.dead -= 1
+        return cur.rowcount > 0
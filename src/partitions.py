@@ -0,0 +1,136 @@
+"""
+多实例调度：任务按 user_id 哈希分到 N 个分区，各调度进程通过 tasks.db 中可续期的租约（leases 表）
+认领分区，只调度自己持有的分区中的任务。
+
+- 每个实例每隔 interval 秒心跳并续期自己的租约，租约有效期为 ttl 秒；
+- 目标持有数为 ceil(分区数 / 存活实例数)：多出的分区主动释放，不足时认领无主或已过期的分区，
+  新实例加入或实例退出后自动均衡；
+- 实例崩溃后其租约最迟 ttl 秒后过期，由其他实例在下一次续期时接管（接管时按错过触发策略补发）；
+- 续期落后时本地按 expires_at - margin 判断租约失效，失效的分区不再触发，避免与接管方重复触发。
+所有实例须运行在同一台机器上（共用时钟与 SQLite 文件锁），且分区数配置相同。
+"""
+import os
+import math
+import time
+import zlib
+import socket
+from typing import Optional
+
+import aiosqlite
+
+
+def partition_of(user_id: str, count: int) -> int:
+    return zlib.crc32(user_id.encode("utf-8")) % count
+
+
+class LeaseManager:
+    def __init__(self, path: str, partitions: int, ttl: float = 10, instance_id: Optional[str] = None,
+                 margin: Optional[float] = None):
+        self.path = path
+        self.partitions = partitions
+        self.ttl = ttl
+        # 本地判断租约失效时预留的余量，覆盖续期写入与触发之间的时间差
+        self.margin = ttl / 5 if margin is None else margin
+        self.instance_id = instance_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.conn: Optional[aiosqlite.Connection] = None
+        self.owned: dict[int, float] = {}  # 分区 -> 租约到期时间
+
+    async def open(self):
+        self.conn = await aiosqlite.connect(self.path, isolation_level=None)
+        await self.conn.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS leases (
+                partition INTEGER PRIMARY KEY,
+                owner TEXT,
+                expires_at REAL NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS scheduler_instances (
+                instance_id TEXT PRIMARY KEY,
+                heartbeat_at REAL NOT NULL
+            );
+            """
+        )
+        await self.conn.executemany(
+            "INSERT OR IGNORE INTO leases (partition) VALUES (?)", [(p,) for p in range(self.partitions)]
+        )
+
+    async def close(self):
+        """正常退出：释放全部租约并注销，其他实例下一次续期即可接管"""
+        if self.conn is None:
+            return
+        await self.conn.execute("BEGIN IMMEDIATE")
+        await self.conn.execute("UPDATE leases SET owner = NULL, expires_at = 0 WHERE owner = ?", (self.instance_id,))
+        await self.conn.execute("DELETE FROM scheduler_instances WHERE instance_id = ?", (self.instance_id,))
+        await self.conn.execute("COMMIT")
+        self.owned.clear()
+        await self.conn.close()
+        self.conn = None
+
+    def valid(self, partition: int, now: Optional[float] = None) -> bool:
+        expires = self.owned.get(partition)
+        return expires is not None and (now or time.time()) < expires - self.margin
+
+    def partition_of(self, user_id: str) -> int:
+        return partition_of(user_id, self.partitions)
+
+    async def renew(self) -> tuple[set, set, set]:
+        """
+        心跳、续期并认领分区（一个写事务），返回 (新认领, 已丢失, 超出份额待释放)。
+        待释放的分区仍由本实例持有，调用方停止其中的任务后再调用 release()。
+        """
+        now = time.time()
+        expires = now + self.ttl
+        me = self.instance_id
+        await self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            await self.conn.execute(
+                "INSERT OR REPLACE INTO scheduler_instances (instance_id, heartbeat_at) VALUES (?, ?)", (me, now)
+            )
+            await self.conn.execute("DELETE FROM scheduler_instances WHERE heartbeat_at < ?", (now - self.ttl,))
+            await self.conn.execute(
+                "UPDATE leases SET expires_at = ? WHERE owner = ? AND expires_at >= ?", (expires, me, now)
+            )
+            async with self.conn.execute("SELECT COUNT(*) FROM scheduler_instances") as cur:
+                (alive,) = await cur.fetchone()
+            async with self.conn.execute(
+                "SELECT partition, owner, expires_at FROM leases WHERE partition < ? ORDER BY partition",
+                (self.partitions,),
+            ) as cur:
+                rows = await cur.fetchall()
+            mine = [p for p, owner, exp in rows if owner == me and exp >= now]
+            free = [p for p, owner, exp in rows if owner is None or exp < now]
+            share = math.ceil(self.partitions / max(1, alive))
+            surplus = set(mine[share:])
+            take = free[:max(0, share - len(mine))]
+            if take:
+                marks = ",".join("?" * len(take))
+                await self.conn.execute(
+                    f"UPDATE leases SET owner = ?, expires_at = ? WHERE partition IN ({marks})", (me, expires, *take)
+                )
+            await self.conn.execute("COMMIT")
+        except BaseException:
+            await self.conn.execute("ROLLBACK")
+            raise
+        # 本实例续期过晚、租约已过期后重新认领的分区同时出现在"丢失"与"新认领"中：
+        # 过期期间的触发已被跳过，调用方先卸载再重新加载，按错过触发策略补发
+        lost = set(self.owned) - set(mine)
+        # 以相同 instance_id 重启时，数据库中仍属于本实例、但本进程尚未加载的分区也算新认领
+        gained = set(take) | (set(mine) - set(self.owned))
+        self.owned = {p: expires for p in (*mine, *take)}
+        return gained, lost, surplus
+
+    async def release(self, partitions: set):
+        if not partitions:
+            return
+        marks = ",".join("?" * len(partitions))
+        await self.conn.execute(
+            f"UPDATE leases SET owner = NULL, expires_at = 0 WHERE owner = ? AND partition IN ({marks})",
+            (self.instance_id, *partitions),
+        )
+        for p in partitions:
+            self.owned.pop(p, None)
+
+    async def table(self) -> list[dict]:
+        async with self.conn.execute("SELECT partition, owner, expires_at FROM leases ORDER BY partition") as cur:
+            return [{"partition": p, "owner": o, "expires_at": e} for p, o, e in await cur.fetchall()]
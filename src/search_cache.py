@@ -0,0 +1,157 @@
+"""
+联网搜索结果缓存（mcp_search.py 使用）。
+
+- 按 (工具, 规范化后的查询, max_results) 缓存 DuckDuckGo 返回的原始结果列表，TTL 由调用方按工具给出
+  （新闻比网页搜索过期得快）；
+- 内存层为有大小上限的 LRU；可选的 SQLite 层（path）在重启后仍然有效，
+  也让 pooled 模式下的多个 MCP 子进程共享结果；
+- 相同查询并发到达时只发起一次上游请求，其余调用等待同一个结果；全部等待者都放弃（被取消）时取消上游请求。
+上游请求失败不缓存，异常原样抛给每个等待者。
+
+注意：MCP 服务以 stdio 子进程运行时 stdout 是协议通道，这里不打印任何内容。
+"""
+import json
+import time
+import asyncio
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+import aiosqlite
+
+# 每写入多少条清理一次 SQLite 中的过期记录
+PRUNE_EVERY = 200
+
+
+def normalize_query(query: str) -> str:
+    """全角转半角、统一大小写并合并空白，使 "Python  教程" 与 "python 教程" 命中同一条缓存"""
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+
+class SearchCache:
+    def __init__(self, max_entries: int = 512, path: Optional[str] = None):
+        self.max_entries = max(0, max_entries)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._memory: OrderedDict[str, tuple[float, list]] = OrderedDict()  # key -> (过期时间, 结果)
+        self._inflight: dict[str, list] = {}  # key -> [上游请求 Task, 等待者数]
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._open_lock = asyncio.Lock()
+        self._writes = 0
+
+    @staticmethod
+    def key(tool: str, query: str, max_results: int) -> str:
+        return json.dumps([tool, normalize_query(query), max_results], ensure_ascii=False)
+
+    async def _db(self) -> Optional[aiosqlite.Connection]:
+        """首次使用时打开 SQLite 层（工具函数没有生命周期钩子）"""
+        if not self.path:
+            return None
+        if self._conn is None:
+            async with self._open_lock:
+                if self._conn is None:
+                    conn = await aiosqlite.connect(self.path, isolation_level="IMMEDIATE")
+                    await conn.executescript(
+                        """
+                        PRAGMA journal_mode=WAL;
+                        PRAGMA synchronous=NORMAL;
+                        CREATE TABLE IF NOT EXISTS search_cache (
+                            key TEXT PRIMARY KEY,
+                            results TEXT NOT NULL,
+                            expires_at REAL NOT NULL
+                        );
+                        """
+                    )
+                    await conn.execute("DELETE FROM search_cache WHERE expires_at < ?", (time.time(),))
+                    await conn.commit()
+                    self._conn = conn
+        return self._conn
+
+    async def close(self):
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    def _remember(self, key: str, expires_at: float, results: list):
+        if not self.max_entries:
+            return
+        self._memory[key] = (expires_at, results)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[list]:
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self._memory.move_to_end(key)
+                return entry[1]
+            del self._memory[key]
+        conn = await self._db()
+        if conn is None:
+            return None
+        async with conn.execute(
+            "SELECT results, expires_at FROM search_cache WHERE key = ? AND expires_at > ?", (key, now)
+        ) as cur:
+            row = await cur.fetchone()
+        if row is None:
+            return None
+        results = json.loads(row[0])
+        self._remember(key, row[1], results)
+        return results
+
+    async def put(self, key: str, results: list, ttl: float):
+        expires_at = time.time() + ttl
+        self._remember(key, expires_at, results)
+        conn = await self._db()
+        if conn is None:
+            return
+        await conn.execute(
+            "INSERT OR REPLACE INTO search_cache (key, results, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(results, ensure_ascii=False), expires_at),
+        )
+        self._writes += 1
+        if self._writes % PRUNE_EVERY == 0:
+            await conn.execute("DELETE FROM search_cache WHERE expires_at < ?", (time.time(),))
+        await conn.commit()
+
+    async def _fetch_and_store(self, key: str, ttl: float, fetch: Callable[[], Awaitable[list]]) -> list:
+        results = await fetch()
+        try:
+            await self.put(key, results, ttl)
+        except Exception:
+            pass  # 写缓存失败（如磁盘层被锁）不影响本次结果
+        return results
+
+    async def get_or_fetch(self, key: str, ttl: float, fetch: Callable[[], Awaitable[list]]) -> list:
+        """命中缓存直接返回；否则调用 fetch()，相同 key 的并发调用共用一次 fetch"""
+        if ttl > 0:
+            try:
+                cached = await self.get(key)
+            except Exception:
+                cached = None  # 磁盘层不可用时退化为直接请求
+            if cached is not None:
+                self.hits += 1
+                return cached
+        self.misses += 1
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(self._fetch_and_store(key, ttl, fetch) if ttl > 0 else fetch())
+            entry = self._inflight[key] = [task, 0]
+
+            def done(t: asyncio.Task, entry=entry):
+                if self._inflight.get(key) is entry:
+                    del self._inflight[key]
+                if not t.cancelled():
+                    t.exception()  # 等待者已全部离开时避免 "exception was never retrieved" 警告
+            task.add_done_callback(done)
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():
+                task.cancel()  # 所有等待者都已放弃
@@ -0,0 +1,199 @@
+"""
+联网搜索结果的精简与格式化（mcp_search.py 使用）。
+
+搜索结果作为工具消息写入 checkpoint，之后每一轮对话都会重新发给 LLM。返回之前先做以下处理：
+- 去掉摘要中的样板文字（开头的日期、结尾的省略号与"阅读全文"等），以及标题末尾与域名或来源重复的站点名；
+- 去掉 URL 中的跟踪参数（utm_*、fbclid 等）与 # 片段，并展开搜索引擎的跳转链接；
+- 合并 URL 相同或摘要几乎相同的结果（同一篇稿件被多家转载）；
+- 按 token 预算（估算方式同 context_budget.estimate_tokens）截断摘要，预算不足时省略排在后面的结果；
+- 可选输出紧凑 JSON，替代文本列表。
+"""
+import re
+import json
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from context_budget import estimate_tokens
+
+# 摘要至少保留的 token 数，预算连这些都放不下时省略该结果
+MIN_SNIPPET_TOKENS = 20
+# 两条摘要的字符 3-gram Jaccard 相似度达到该值视为重复；短于 NEAR_DUPLICATE_MIN_CHARS 的摘要不参与比较
+NEAR_DUPLICATE = 0.8
+NEAR_DUPLICATE_MIN_CHARS = 30
+
+TRACKING_PARAMS = {
+    "fbclid", "gclid", "dclid", "msclkid", "yclid", "igshid", "mc_cid", "mc_eid",
+    "spm", "scm", "ref_src", "share_source", "share_medium", "vd_source",
+}
+TRACKING_PREFIXES = ("utm_",)
+# 搜索引擎跳转链接：(域名后缀, 路径, 真实地址所在参数)
+REDIRECTS = (
+    ("duckduckgo.com", "/l/", "uddg"),
+    ("google.com", "/url", "q"),
+    ("google.com", "/url", "url"),
+)
+
+_LEADING_DATE = re.compile(
+    r"^(?:\d{4}[-/.年]\d{1,2}[-/.月]\d{1,2}日?"
+    r"|[A-Z][a-z]{2,8}\.? \d{1,2}, \d{4}"
+    r"|\d{1,2} [A-Z][a-z]{2,8}\.? \d{4}"
+    r"|\d+ (?:seconds?|minutes?|hours?|days?|weeks?|months?) ago"
+    r"|\d+ ?(?:秒|分钟|小时|天|周|个月)前)"
+    r" ?[·—–:：-] ?"
+)
+_TRAILING = re.compile(r"(?: ?(?:\.{3}|…|Read more|阅读全文|展开全文|查看更多|更多>*))+$", re.IGNORECASE)
+_LEADING_ELLIPSIS = re.compile(r"^(?:\.{3}|…) ?")
+_TITLE_SUFFIX = re.compile(r"^(.{6,}?) [-|_–—] ([^-|_–—]{1,30})$")
+_NON_WORD = re.compile(r"\W+")
+# 判断标题后缀是否为站点名时忽略的域名片段
+_GENERIC_LABELS = {"www", "m", "en", "zh", "com", "net", "org", "edu", "gov", "co", "cn", "io"}
+
+
+def clean_url(url: str) -> str:
+    """展开跳转链接，去掉跟踪参数与 # 片段"""
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    for domain, path, param in REDIRECTS:
+        if host.endswith(domain) and parts.path.startswith(path):
+            target = dict(parse_qsl(parts.query)).get(param)
+            if target and target.startswith("http"):
+                return clean_url(target)
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k.lower() not in TRACKING_PARAMS and not k.lower().startswith(TRACKING_PREFIXES)
+    ]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ""))
+
+
+def url_key(url: str) -> str:
+    """判断重复的 URL：忽略协议、www. 前缀、末尾斜杠"""
+    parts = urlsplit(clean_url(url))
+    host = parts.netloc.lower().removeprefix("www.")
+    return host + parts.path.rstrip("/") + (f"?{parts.query}" if parts.query else "")
+
+
+def clean_title(title: str, url: str = "", source: str = "") -> str:
+    """去掉标题末尾的站点名（"… - 维基百科"），只在它与域名或来源一致时去掉"""
+    title = " ".join(title.split())
+    m = _TITLE_SUFFIX.match(title)
+    if not m:
+        return title
+    suffix = m.group(2).casefold().replace(" ", "")
+    host = urlsplit(url).netloc.lower()
+    labels = [label for label in host.split(".") if len(label) > 3 or label not in _GENERIC_LABELS]
+    if (source and suffix == source.casefold().replace(" ", "")) or any(label in suffix for label in labels):
+        return m.group(1)
+    return title
+
+
+def clean_snippet(text: str) -> str:
+    text = " ".join(text.split())
+    text = _LEADING_DATE.sub("", text)
+    text = _LEADING_ELLIPSIS.sub("", text)
+    return _TRAILING.sub("", text).strip()
+
+
+def _shingles(text: str) -> set:
+    text = _NON_WORD.sub("", text.casefold())
+    return {text[i:i + 3] for i in range(max(1, len(text) - 2))}
+
+
+def normalize(results: list[dict], queries: list[int] = None) -> list[dict]:
+    """
+    把 DuckDuckGo 的原始结果（text 为 title/body/href，news 另有 url/source/date）转为
+    {"title", "url", "snippet", ["source", "date"], ["queries"]}；queries 为 web_search_many 中命中的关键词序号
+    """
+    items = []
+    for r in results:
+        url = clean_url(r.get("href") or r.get("url") or "")
+        source = r.get("source") or ""
+        item = {
+            "title": clean_title(r.get("title") or "无标题", url, source),
+            "url": url,
+            "snippet": clean_snippet(r.get("body") or ""),
+        }
+        if source:
+            item["source"] = source
+        if r.get("date"):
+            item["date"] = str(r["date"])[:10]  # ISO 时间只保留日期
+        if queries is not None:
+            item["queries"] = list(queries)
+        items.append(item)
+    return items
+
+
+def dedupe(items: list[dict]) -> list[dict]:
+    """URL 相同或摘要几乎相同的结果只保留第一条，命中的关键词序号合并到保留的那条上"""
+    kept, keys, shingles = [], {}, []
+    for item in items:
+        key = url_key(item["url"]) if item["url"] else item["title"]
+        twin = keys.get(key)
+        if twin is None and len(item["snippet"]) >= NEAR_DUPLICATE_MIN_CHARS:
+            s = _shingles(item["snippet"])
+            for other, t in shingles:
+                if len(s & t) >= NEAR_DUPLICATE * len(s | t):
+                    twin = other
+                    break
+            else:
+                shingles.append((item, s))
+        if twin is None:
+            keys[key] = item
+            kept.append(item)
+        elif "queries" in item:
+            twin["queries"] += [q for q in item["queries"] if q not in twin["queries"]]
+    return kept
+
+
+def truncate(text: str, tokens: int) -> str:
+    if estimate_tokens(text) <= tokens:
+        return text
+    cut = int(len(text) * tokens / estimate_tokens(text))
+    while cut > 0 and estimate_tokens(text[:cut]) + 1 > tokens:
+        cut -= max(1, cut // 10)
+    return text[:cut].rstrip() + "…"
+
+
+def _text_line(n: int, item: dict, snippet: str) -> str:
+    meta = " ".join(item[k] for k in ("source", "date") if item.get(k))
+    line = f"{n}. {item['title']}" + (f"（{meta}）" if meta else "")
+    if item.get("queries"):
+        line += f" [{','.join(map(str, item['queries']))}]"
+    if snippet:
+        line += f"\n   {snippet}"
+    return line + f"\n   {item['url']}\n"
+
+
+def _json_item(n: int, item: dict, snippet: str) -> str:
+    return json.dumps({**item, "snippet": snippet}, ensure_ascii=False, separators=(",", ":"))
+
+
+def render(query: str, items: list[dict], budget: int, output_format: str = "text",
+           header: str = "", footer: str = "") -> str:
+    """
+    按 token 预算输出：每条结果按剩余预算平分摘要长度（前面用不完的留给后面），
+    放不下标题与最短摘要时省略其余结果。第一条结果总会输出。
+    文本格式为 header、编号列表、footer；output_format 为 "json" 时返回
+    {"query", "results", "omitted", "note"} 的紧凑 JSON，footer 放在 note 中。
+    """
+    as_json = output_format == "json"
+    line = _json_item if as_json else _text_line
+    remaining = budget - estimate_tokens((query if as_json else header) + footer)
+    lines = []
+    for i, item in enumerate(items):
+        base = estimate_tokens(line(i + 1, item, ""))
+        share = remaining // (len(items) - i) - base
+        if lines and base + MIN_SNIPPET_TOKENS > remaining:
+            break
+        entry = line(i + 1, item, truncate(item["snippet"], max(MIN_SNIPPET_TOKENS, share)))
+        remaining -= estimate_tokens(entry)
+        lines.append(entry)
+    omitted = len(items) - len(lines)
+
+    if as_json:
+        data = {"query": query, "results": [json.loads(entry) for entry in lines], "omitted": omitted}
+        if footer:
+            data["note"] = footer
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    output = header + "\n" + "".join(lines)
+    if omitted:
+        output += f"（另有 {omitted} 条结果因长度限制省略）\n"
+    return output + footer
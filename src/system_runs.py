@@ -0,0 +1,202 @@
+"""
+系统触发任务（/system_trigger）的执行子系统。
+
+- 有界队列 + 固定数量的 worker：定时任务集中触发时排队执行，而不是同时发起成百上千个 LLM 调用；
+- 按用户的滑动窗口限流；
+- 每次执行的状态、耗时与输出写入 SQLite（data/system_runs.db），可通过 /system_runs 查询；
+- 关闭时停止接收新任务，等待在途任务完成（超时后取消并标记）。
+"""
+import time
+import uuid
+import asyncio
+from collections import deque
+from typing import Optional
+
+import aiosqlite
+
+
+class SystemRunRejected(Exception):
+    """队列已满或用户触发过于频繁"""
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RunStore:
+    """执行结果存储：status 取值 queued / running / success / failed / cancelled"""
+    def __init__(self, path: str):
+        self.path = path
+        self.conn: Optional[aiosqlite.Connection] = None
+
+    async def open(self, retention_days: float = 7):
+        self.conn = await aiosqlite.connect(self.path)
+        self.conn.row_factory = aiosqlite.Row
+        await self.conn.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS system_runs (
+                run_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                text TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                output TEXT,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_system_runs_user ON system_runs (user_id, created_at);
+            CREATE INDEX IF NOT EXISTS idx_system_runs_created ON system_runs (created_at);
+            """
+        )
+        # 上次异常退出时遗留的未完成记录
+        await self.conn.execute(
+            "UPDATE system_runs SET status = 'cancelled', error = '服务重启' WHERE status IN ('queued', 'running')"
+        )
+        await self.conn.execute("DELETE FROM system_runs WHERE created_at < ?", (time.time() - retention_days * 86400,))
+        await self.conn.commit()
+
+    async def close(self):
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+
+    async def insert(self, run_id: str, user_id: str, text: str, created_at: float):
+        await self.conn.execute(
+            "INSERT INTO system_runs (run_id, user_id, text, status, created_at) VALUES (?, ?, ?, 'queued', ?)",
+            (run_id, user_id, text, created_at),
+        )
+        await self.conn.commit()
+
+    async def update(self, run_id: str, **fields):
+        cols = ", ".join(f"{k} = ?" for k in fields)
+        await self.conn.execute(f"UPDATE system_runs SET {cols} WHERE run_id = ?", (*fields.values(), run_id))
+        await self.conn.commit()
+
+    async def query(self, user_id: Optional[str] = None, status: Optional[str] = None, limit: int = 50) -> list[dict]:
+        sql = "SELECT * FROM system_runs"
+        where, params = [], []
+        if user_id:
+            where.append("user_id = ?")
+            params.append(user_id)
+        if status:
+            where.append("status = ?")
+            params.append(status)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY created_at DESC LIMIT ?"
+        params.append(limit)
+        async with self.conn.execute(sql, params) as cur:
+            return [_row_to_dict(r) for r in await cur.fetchall()]
+
+    async def get(self, run_id: str) -> Optional[dict]:
+        async with self.conn.execute("SELECT * FROM system_runs WHERE run_id = ?", (run_id,)) as cur:
+            row = await cur.fetchone()
+        return _row_to_dict(row) if row else None
+
+
+def _row_to_dict(row) -> dict:
+    d = dict(row)
+    d["queue_seconds"] = d["started_at"] - d["created_at"] if d["started_at"] else None
+    d["run_seconds"] = d["finished_at"] - d["started_at"] if d["finished_at"] and d["started_at"] else None
+    return d
+
+
+class SystemRunner:
+    """
+    run_fn(user_id, text) -> str 为实际执行的协程函数，返回值作为输出保存。
+    """
+    def __init__(self, run_fn, store: RunStore, workers: int = 4, queue_size: int = 1000,
+                 user_rate: int = 10, rate_window: float = 60):
+        self.run_fn = run_fn
+        self.store = store
+        self.worker_count = max(1, workers)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.user_rate = user_rate
+        self.rate_window = rate_window
+        self._recent: dict[str, deque] = {}  # 只保留窗口内有触发的用户
+        self._pruned_at = 0.0
+        self._workers: list[asyncio.Task] = []
+        self._closing = False
+        # 已通过检查、正在写入执行记录的提交数：队列名额在 await 之前预留，避免并发提交在写库期间把队列占满
+        self._reserved = 0
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    def _check_rate(self, user_id: str, now: float):
+        if self.user_rate <= 0:
+            return
+        # 每个窗口清理一次不再触发的用户，_recent 只含最近两个窗口内的活跃用户
+        if now - self._pruned_at > self.rate_window:
+            self._pruned_at = now
+            for uid in [uid for uid, r in self._recent.items() if now - r[-1] > self.rate_window]:
+                del self._recent[uid]
+        recent = self._recent.setdefault(user_id, deque())
+        while recent and now - recent[0] > self.rate_window:
+            recent.popleft()
+        if len(recent) >= self.user_rate:
+            raise SystemRunRejected(
+                f"用户 {user_id} 触发过于频繁（{self.rate_window:.0f} 秒内最多 {self.user_rate} 次）",
+                retry_after=max(1, int(self.rate_window - (now - recent[0])) + 1),
+            )
+        recent.append(now)
+
+    async def submit(self, user_id: str, text: str) -> str:
+        if self._closing:
+            raise SystemRunRejected("服务正在关闭", retry_after=30)
+        if 0 < self.queue.maxsize <= self.queue.qsize() + self._reserved:
+            raise SystemRunRejected("系统任务队列已满", retry_after=max(1, self.queue.qsize() // self.worker_count))
+        now = time.time()
+        self._check_rate(user_id, now)
+        self._reserved += 1
+        run_id = uuid.uuid4().hex[:12]
+        try:
+            await self.store.insert(run_id, user_id, text, now)
+        except BaseException:
+            # 记录未写入：归还队列名额与限流计数
+            recent = self._recent.get(user_id)
+            if recent is not None and now in recent:
+                recent.remove(now)
+                if not recent:
+                    del self._recent[user_id]
+            raise
+        else:
+            self.queue.put_nowait((run_id, user_id, text))
+        finally:
+            self._reserved -= 1
+        return run_id
+
+    async def _worker(self):
+        while True:
+            run_id, user_id, text = await self.queue.get()
+            try:
+                await self.store.update(run_id, status="running", started_at=time.time())
+                try:
+                    output = await self.run_fn(user_id, text)
+                    await self.store.update(run_id, status="success", finished_at=time.time(), output=output)
+                except asyncio.CancelledError:
+                    await self.store.update(run_id, status="cancelled", finished_at=time.time(), error="服务关闭")
+                    raise
+                except Exception as e:
+                    print(f"⚠️ 系统任务 {run_id}（用户 {user_id}）执行失败: {e}")
+                    await self.store.update(run_id, status="failed", finished_at=time.time(), error=str(e))
+            finally:
+                self.queue.task_done()
+
+    def stats(self) -> dict:
+        return {"queued": self.queue.qsize(), "workers": self.worker_count, "closing": self._closing}
+
+    async def shutdown(self, timeout: float = 30):
+        """停止接收新任务，等待队列清空（最多 timeout 秒），超时后取消剩余任务"""
+        self._closing = True
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ 系统任务未在 {timeout:.0f} 秒内完成，剩余 {self.queue.qsize()} 个排队任务将被取消")
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        while not self.queue.empty():
+            run_id, _, _ = self.queue.get_nowait()
+            await self.store.update(run_id, status="cancelled", error="服务关闭")
@@ -0,0 +1,303 @@
+"""
+定时任务存储（data/timeset/tasks.db，SQLite WAL 模式）。
+
+替代原先每次增删都整体重写的 tasks.json：单个任务的增删是一次小事务，与任务总数无关；
+按 user_id 与下次触发时间（next_run，Unix 时间戳）建索引。
+首次启动时自动从旧的 tasks.json 迁移，迁移后原文件重命名为 tasks.json.migrated。
+多实例模式（track_changes=True）下增删同时写入 task_changes 表，其他实例据此同步自己分区内的任务。
+
+触发方式（trigger_type）：NULL 为 Cron（cron 列为五段式表达式），date 为一次性任务（run_at 触发一次），
+interval 为固定间隔（从 run_at 起每 interval_seconds 秒）。非 Cron 任务的 cron 列为空字符串。
+一次性任务触发后 next_run 置为 NULL，最后一次触发送达后由 outbox 删除；未能送达的由 sweep_one_shots() 清理。
+API 请求、恢复与同步循环共用一个连接，写事务由 _write() 串行化（同 outbox.py）。
+"""
+import os
+import json
+import time
+import sqlite3
+import asyncio
+from typing import Optional
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+from partitions import partition_of
+
+
+# 仍需调度的任务：已触发的一次性任务（next_run 为 NULL）除外
+_ACTIVE = "NOT (trigger_type = 'date' AND next_run IS NULL)"
+
+
+class TaskExists(Exception):
+    """task_id 已存在"""
+
+
+class TaskStore:
+    def __init__(self, path: str, track_changes: bool = False):
+        self.path = path
+        self.track_changes = track_changes
+        self.conn: Optional[aiosqlite.Connection] = None
+        self._write_lock: Optional[asyncio.Lock] = None
+
+    async def open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # 写事务以 BEGIN IMMEDIATE 开始，与 outbox 连接及其他实例并发写时排队等锁（见 outbox.py）
+        self.conn = await aiosqlite.connect(self.path, isolation_level="IMMEDIATE")
+        self.conn.row_factory = aiosqlite.Row
+        self._write_lock = asyncio.Lock()  # 随连接创建，绑定当前事件循环
+        await self.conn.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                cron TEXT NOT NULL,
+                text TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                next_run REAL,
+                misfire_grace_time INTEGER,
+                coalesce INTEGER,
+                trigger_type TEXT,
+                run_at REAL,
+                interval_seconds INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS idx_tasks_user ON tasks (user_id, task_id);
+            CREATE INDEX IF NOT EXISTS idx_tasks_next_run ON tasks (next_run);
+            CREATE TABLE IF NOT EXISTS task_changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                op TEXT NOT NULL,
+                at REAL NOT NULL
+            );
+            """
+        )
+        await self.conn.create_function("user_partition", 2, partition_of, deterministic=True)
+        # 旧版数据库补充按任务的错过触发策略列（NULL 表示使用全局默认值）与触发方式列（NULL 表示 Cron）
+        async with self.conn.execute("PRAGMA table_info(tasks)") as cur:
+            columns = {r["name"] for r in await cur.fetchall()}
+        for column, kind in (("misfire_grace_time", "INTEGER"), ("coalesce", "INTEGER"), ("trigger_type", "TEXT"),
+                             ("run_at", "REAL"), ("interval_seconds", "INTEGER")):
+            if column not in columns:
+                try:
+                    await self.conn.execute(f"ALTER TABLE tasks ADD COLUMN {column} {kind}")
+                except sqlite3.OperationalError as e:
+                    # 多个实例同时启动时可能已被其他实例添加
+                    if "duplicate column" not in str(e):
+                        raise
+        await self.conn.commit()
+
+    async def close(self):
+        if self.conn is not None:
+            async with self._write_lock:
+                await self.conn.close()
+            self.conn = None
+
+    @asynccontextmanager
+    async def _write(self):
+        """一个写事务：持锁执行，正常退出提交，出错只回滚自己的语句"""
+        async with self._write_lock:
+            try:
+                yield self.conn
+            except BaseException:
+                await self.conn.rollback()
+                raise
+            await self.conn.commit()
+
+    async def migrate_json(self, json_path: str) -> int:
+        """一次性导入旧的 tasks.json（已存在的 task_id 跳过），返回导入的任务数"""
+        if not os.path.exists(json_path):
+            return 0
+        try:
+            with open(json_path, "r", encoding="utf-8") as f:
+                tasks = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 读取 {json_path} 失败，跳过迁移: {e}")
+            return 0
+        rows = [
+            (task_id, info["user_id"], info["cron"], info["text"], info.get("created_at", ""))
+            for task_id, info in tasks.items()
+        ]
+        async with self._write() as conn:
+            cur = await conn.executemany(
+                "INSERT OR IGNORE INTO tasks (task_id, user_id, cron, text, created_at) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+        os.replace(json_path, json_path + ".migrated")
+        return cur.rowcount
+
+    async def add(self, task: dict):
+        await self.add_many([task])
+
+    async def add_many(self, tasks: list[dict]):
+        """在一个事务中插入多个任务；任一 task_id 已存在时整体回滚并抛出 TaskExists"""
+        rows = [
+            (t["task_id"], t["user_id"], t["cron"], t["text"], t["created_at"], t.get("next_run"),
+             t.get("misfire_grace_time"), t.get("coalesce"), t.get("trigger_type"), t.get("run_at"),
+             t.get("interval_seconds"))
+            for t in tasks
+        ]
+        try:
+            async with self._write() as conn:
+                await conn.executemany(
+                    "INSERT INTO tasks (task_id, user_id, cron, text, created_at, next_run, misfire_grace_time, "
+                    "coalesce, trigger_type, run_at, interval_seconds) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                await self._log_changes([(t["task_id"], t["user_id"]) for t in tasks], "add")
+        except sqlite3.IntegrityError as e:
+            raise TaskExists(str(e))
+
+    async def delete(self, task_id: str, user_id: Optional[str] = None) -> bool:
+        """删除任务；指定 user_id 时只删除属于该用户的任务"""
+        return bool(await self.delete_many([task_id], user_id=user_id))
+
+    async def delete_many(self, task_ids: list[str], user_id: Optional[str] = None) -> list[str]:
+        """在一个事务中删除多个任务，返回实际删除的 task_id（不存在或不属于 user_id 的跳过）"""
+        if not task_ids:
+            return []
+        marks = ",".join("?" * len(task_ids))
+        where = f"task_id IN ({marks})"
+        params = list(task_ids)
+        if user_id is not None:
+            where += " AND user_id = ?"
+            params.append(user_id)
+        async with self._write() as conn:
+            async with conn.execute(f"SELECT task_id, user_id FROM tasks WHERE {where}", params) as cur:
+                found = [tuple(r) for r in await cur.fetchall()]
+            await conn.execute(f"DELETE FROM tasks WHERE {where}", params)
+            await self._log_changes(found, "delete")
+        return [task_id for task_id, _ in found]
+
+    async def sweep_one_shots(self) -> list[str]:
+        """
+        删除已触发（next_run 为 NULL）且投递队列中没有待投递记录的一次性任务，返回删除的 task_id。
+        正常送达的一次性任务已由 outbox 删除，这里清理的是超过宽限时间被跳过、或投递进入死信的
+        """
+        async with self._write() as conn:
+            async with conn.execute(
+                "DELETE FROM tasks WHERE trigger_type = 'date' AND next_run IS NULL AND task_id NOT IN ("
+                "SELECT task_id FROM outbox WHERE task_id IS NOT NULL AND status IN ('pending', 'sending')"
+                ") RETURNING task_id, user_id"
+            ) as cur:
+                cur.row_factory = None
+                found = await cur.fetchall()
+            await self._log_changes(found, "delete")
+        return [task_id for task_id, _ in found]
+
+    async def _log_changes(self, items: list[tuple[str, str]], op: str):
+        """items 为 (task_id, user_id)，在调用方的 _write() 事务中与增删一起写入"""
+        if self.track_changes and items:
+            now = time.time()
+            await self.conn.executemany(
+                "INSERT INTO task_changes (task_id, user_id, op, at) VALUES (?, ?, ?, ?)",
+                [(task_id, user_id, op, now) for task_id, user_id in items],
+            )
+
+    async def last_change(self) -> int:
+        async with self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM task_changes") as cur:
+            (seq,) = await cur.fetchone()
+        return seq
+
+    async def changes_since(self, seq: int, limit: int = 10000) -> list[tuple[int, str, str, str]]:
+        """seq 之后的增删记录 (seq, task_id, user_id, op)，按顺序"""
+        async with self.conn.execute(
+            "SELECT seq, task_id, user_id, op FROM task_changes WHERE seq > ? ORDER BY seq LIMIT ?", (seq, limit)
+        ) as cur:
+            cur.row_factory = None
+            return await cur.fetchall()
+
+    async def prune_changes(self, before: float):
+        async with self._write() as conn:
+            await conn.execute("DELETE FROM task_changes WHERE at < ?", (before,))
+
+    async def get(self, task_id: str) -> Optional[dict]:
+        async with self.conn.execute("SELECT * FROM tasks WHERE task_id = ?", (task_id,)) as cur:
+            row = await cur.fetchone()
+        return dict(row) if row else None
+
+    async def page(self, user_id: Optional[str] = None, limit: int = 50,
+                   cursor: Optional[str] = None) -> tuple[list[dict], Optional[str]]:
+        """
+        按 task_id 顺序分页（键集分页，走 (user_id, task_id) 索引），返回 (本页任务, 下一页游标)。
+        cursor 为上一页最后一个 task_id，没有下一页时游标为 None。
+        """
+        where, params = [], []
+        if user_id is not None:
+            where.append("user_id = ?")
+            params.append(user_id)
+        if cursor:
+            where.append("task_id > ?")
+            params.append(cursor)
+        sql = "SELECT * FROM tasks"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY task_id LIMIT ?"
+        params.append(limit + 1)
+        async with self.conn.execute(sql, params) as cur:
+            rows = [dict(r) for r in await cur.fetchall()]
+        if len(rows) > limit:
+            return rows[:limit], rows[limit - 1]["task_id"]
+        return rows, None
+
+    async def restore_rows(self, partitions: Optional[set] = None, partition_count: int = 0,
+                           task_ids: Optional[list[str]] = None) -> list[tuple]:
+        """
+        启动恢复用：取 (task_id, user_id, 触发描述, text, next_run, misfire_grace_time, coalesce) 元组，
+        不经过 Row / dict 转换。触发描述对 Cron 任务为表达式，其他为 (trigger_type, run_at, interval_seconds)；
+        已触发的一次性任务不恢复。可只取指定分区（按 user_id 哈希，共 partition_count 个）或指定 task_id 的任务
+        """
+        where, params = [], []
+        if partitions is not None:
+            where.append(f"user_partition(user_id, ?) IN ({','.join('?' * len(partitions))})")
+            params += [partition_count, *partitions]
+        if task_ids is not None:
+            where.append(f"task_id IN ({','.join('?' * len(task_ids))})")
+            params += task_ids
+        scope = "".join(f" AND {w}" for w in where)
+        async with self.conn.execute(
+            "SELECT task_id, user_id, cron, text, next_run, misfire_grace_time, coalesce FROM tasks "
+            f"WHERE trigger_type IS NULL{scope}", params
+        ) as cur:
+            cur.row_factory = None
+            rows = await cur.fetchall()
+        async with self.conn.execute(
+            "SELECT task_id, user_id, trigger_type, run_at, interval_seconds, text, next_run, misfire_grace_time, "
+            f"coalesce FROM tasks WHERE trigger_type IS NOT NULL AND {_ACTIVE}{scope}", params
+        ) as cur:
+            cur.row_factory = None
+            rows += [(t, u, (kind, run_at, every), *rest) for t, u, kind, run_at, every, *rest in await cur.fetchall()]
+        return rows
+
+    async def trigger_user_counts(self) -> list[tuple]:
+        """
+        按 (触发描述, user_id) 聚合的任务数，用于触发时间线统计；
+        触发描述与 restore_rows 相同（Cron 表达式或 (trigger_type, run_at, interval_seconds)）
+        """
+        async with self.conn.execute(
+            "SELECT cron, user_id, COUNT(*) FROM tasks WHERE trigger_type IS NULL GROUP BY cron, user_id"
+        ) as cur:
+            cur.row_factory = None
+            rows = await cur.fetchall()
+        async with self.conn.execute(
+            "SELECT trigger_type, run_at, interval_seconds, user_id, COUNT(*) FROM tasks "
+            f"WHERE trigger_type IS NOT NULL AND {_ACTIVE} GROUP BY trigger_type, run_at, interval_seconds, user_id"
+        ) as cur:
+            cur.row_factory = None
+            rows += [((kind, run_at, every), u, n) for kind, run_at, every, u, n in await cur.fetchall()]
+        return rows
+
+    async def all(self) -> list[dict]:
+        async with self.conn.execute("SELECT * FROM tasks") as cur:
+            return [dict(r) for r in await cur.fetchall()]
+
+    async def set_next_runs(self, items: list[tuple[str, Optional[float]]]):
+        """批量更新下次触发时间：items 为 (task_id, next_run) 列表，一次事务提交"""
+        if not items:
+            return
+        async with self._write() as conn:
+            await conn.executemany(
+                "UPDATE tasks SET next_run = ? WHERE task_id = ?",
+                [(next_run, task_id) for task_id, next_run in items],
+            )
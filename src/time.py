@@ -3,157 +3,837 @@
 
 import os
 import uuid
-import json
-from typing import List, Optional
+import logging
+import time
+import asyncio
+from typing import List, Literal, Optional, Union
+from collections import deque
 from datetime import datetime
 from contextlib import asynccontextmanager
 
 import httpx
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import Response
 from pydantic import BaseModel
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
 import uvicorn
 from dotenv import load_dotenv
 
+import metrics
+from task_store import TaskStore, TaskExists
+from job_loader import BulkMemoryJobStore, bulk_restore, paused_gc
+from outbox import Outbox, DeliveryFailed
+from timeline import fire_timeline
+from fire_log import FireRecorder
+from partitions import LeaseManager, partition_of
+
 # --- 路径配置 ---
 current_dir = os.path.dirname(os.path.abspath(__file__))
 root_dir = os.path.dirname(current_dir)
-TASKS_FILE = os.path.join(root_dir, "data", "timeset", "tasks.json")
+# 旧版的 JSON 任务文件，启动时自动迁移到 TASKS_DB
+LEGACY_TASKS_FILE = os.path.join(root_dir, "data", "timeset", "tasks.json")
 
 # 加载 .env 配置
 load_dotenv(dotenv_path=os.path.join(root_dir, "config", ".env"))
 
-# 确保目录存在
-os.makedirs(os.path.dirname(TASKS_FILE), exist_ok=True)
+# 相对路径按项目根目录解析，与启动时的工作目录无关（多实例须打开同一个文件）
+TASKS_DB = os.getenv("SCHEDULER_DB") or os.path.join("data", "timeset", "tasks.db")
+if not os.path.isabs(TASKS_DB):
+    TASKS_DB = os.path.join(root_dir, TASKS_DB)
+
+# --- 多实例（分区租约，见 partitions.py） ---
+# 分区数，0 表示单实例模式（调度全部任务）；多个实例须配置相同的分区数并共用 SCHEDULER_DB
+SCHEDULER_PARTITIONS = int(os.getenv("SCHEDULER_PARTITIONS", "0"))
+# 租约有效期与续期间隔（秒）：实例崩溃后其分区最迟约 LEASE_TTL + LEASE_RENEW_INTERVAL 秒后被接管
+LEASE_TTL = float(os.getenv("LEASE_TTL", "10"))
+LEASE_RENEW_INTERVAL = float(os.getenv("LEASE_RENEW_INTERVAL", "2"))
+leases = LeaseManager(
+    TASKS_DB, SCHEDULER_PARTITIONS, ttl=LEASE_TTL, instance_id=os.getenv("SCHEDULER_INSTANCE_ID") or None
+) if SCHEDULER_PARTITIONS > 0 else None
+# task_changes 的保留时长（秒），实例据此同步其他实例收到的增删
+TASK_CHANGES_RETENTION = 3600
 
-# --- JSON 持久化 ---
-def load_tasks() -> dict:
-    """从 JSON 文件加载任务配置"""
-    if os.path.exists(TASKS_FILE):
-        with open(TASKS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
+# 每次投递尝试的时间记录（JSONL，追加写入），设为空则不写文件
+FIRE_LOG = os.getenv("FIRE_LOG", os.path.join(root_dir, "data", "timeset", "fires.log"))
+fire_recorder = FireRecorder(FIRE_LOG or None)
 
-def save_tasks(tasks: dict):
-    """保存任务配置到 JSON 文件"""
-    with open(TASKS_FILE, "w", encoding="utf-8") as f:
-        json.dump(tasks, f, ensure_ascii=False, indent=4)
+# --- 任务持久化（SQLite） ---
+task_store = TaskStore(TASKS_DB, track_changes=leases is not None)
+# 已触发任务的下次触发时间，定期批量写回存储（避免整点集中触发时逐条提交）
+NEXT_RUN_FLUSH_INTERVAL = 5
+# 清理已触发但未能送达（超过宽限被跳过或进入死信）的一次性任务的间隔（秒）
+ONE_SHOT_SWEEP_INTERVAL = 60
+# 固定间隔任务的最小间隔（秒）
+MIN_INTERVAL_SECONDS = 60
 
 # --- 数据模型 ---
 class CronTask(BaseModel):
     user_id: str
-    cron: str  # 格式: "分 时 日 月 周"
     text: str
+    # 触发方式：cron 按五段式表达式；date 在 run_at 触发一次，送达后自动删除；
+    # interval 从 run_at（默认为一个间隔之后）起每 interval_seconds 秒触发
+    trigger: Literal["cron", "date", "interval"] = "cron"
+    cron: str = ""  # 格式: "分 时 日 月 周"
+    run_at: Optional[Union[float, str]] = None  # Unix 时间戳或 ISO 8601 时间（不带时区时按调度器时区）
+    interval_seconds: Optional[int] = None
+    # 错过触发的处理（不填使用全局默认值）：超过宽限秒数的触发丢弃（0 表示不限），
+    # coalesce 为真时错过的多次触发只补发一次
+    misfire_grace_time: Optional[int] = None
+    coalesce: Optional[bool] = None
 
 class TaskResponse(BaseModel):
     task_id: str
     user_id: str
+    trigger: str
     cron: str
+    run_at: Optional[str]
+    interval_seconds: Optional[int]
     text: str
     next_run: Optional[str]
+    misfire_grace_time: int
+    coalesce: bool
+
+class BatchCreateRequest(BaseModel):
+    tasks: List[CronTask]
+
+class BatchDeleteRequest(BaseModel):
+    task_ids: List[str]
+    # 指定时只删除属于该用户的任务
+    user_id: Optional[str] = None
+
+# 单次批量操作的任务数上限
+MAX_BATCH_SIZE = 500
+# 触发时间线的窗口与桶数上限
+TIMELINE_MAX_DAYS = 31
+TIMELINE_MAX_BUCKETS = 50000
 
 # --- 全局调度器 ---
-scheduler = AsyncIOScheduler()
+jobstore = BulkMemoryJobStore()
+scheduler = AsyncIOScheduler(jobstores={"default": jobstore})
 PORT_AGENT = int(os.getenv("PORT_AGENT", "51200"))
 AGENT_URL = f"http://127.0.0.1:{PORT_AGENT}/system_trigger"
 
-async def trigger_agent(user_id: str, text: str):
-    """到达定时时间，向 Agent 发送 HTTP 请求"""
-    async with httpx.AsyncClient() as client:
+# --- 投递配置 ---
+# 到 Agent 的连接池大小（同时也是最大并发投递数）与单次请求超时（秒）
+DELIVERY_MAX_CONNECTIONS = int(os.getenv("DELIVERY_MAX_CONNECTIONS", "20"))
+DELIVERY_TIMEOUT = float(os.getenv("DELIVERY_TIMEOUT", "10"))
+# 失败重试：最多尝试次数，退避基数与上限（秒），第 n 次失败后约等待 base * 2^(n-1) 秒
+DELIVERY_MAX_ATTEMPTS = int(os.getenv("DELIVERY_MAX_ATTEMPTS", "8"))
+DELIVERY_BACKOFF_BASE = float(os.getenv("DELIVERY_BACKOFF_BASE", "2"))
+DELIVERY_BACKOFF_MAX = float(os.getenv("DELIVERY_BACKOFF_MAX", "300"))
+# 整点集中触发的平滑：按任务固定的抖动窗口（秒）、同时在途的投递数上限、每秒最多投递数（0 表示不限）
+FIRE_JITTER_SECONDS = float(os.getenv("FIRE_JITTER_SECONDS", "0"))
+FIRE_MAX_INFLIGHT = int(os.getenv("FIRE_MAX_INFLIGHT", str(DELIVERY_MAX_CONNECTIONS)))
+FIRE_RATE_PER_SECOND = float(os.getenv("FIRE_RATE_PER_SECOND", "0"))
+
+# --- 错过触发与补发策略 ---
+# 默认宽限时间（秒，0 表示不限）：晚于计划时间超过该值的触发丢弃；任务可单独设置
+MISFIRE_GRACE_TIME = int(os.getenv("MISFIRE_GRACE_TIME", "3600"))
+# 默认是否合并错过的多次触发为一次；任务可单独设置
+TASK_COALESCE = os.getenv("TASK_COALESCE", "true").lower() in ("1", "true", "yes")
+# 重启时是否补发停机期间错过的触发，以及补发的速率（每秒条数）
+MISFIRE_CATCH_UP = os.getenv("MISFIRE_CATCH_UP", "true").lower() in ("1", "true", "yes")
+CATCH_UP_RATE_PER_SECOND = float(os.getenv("CATCH_UP_RATE_PER_SECOND", "2"))
+# 不合并的任务每个最多补发的次数
+MAX_REPLAY_PER_TASK = 100
+
+# --- 指标（GET /metrics） ---
+JOBS_FIRED = metrics.Counter("scheduler_jobs_fired_total", "已触发的定时任务次数")
+FIRES_FENCED = metrics.Counter("scheduler_fires_fenced_total", "因分区租约失效而未触发的次数（多实例模式）")
+JOBS_MISSED = metrics.Counter(
+    "scheduler_jobs_missed_total", "错过的触发次数（replayed 为补发，dropped 为超过宽限或被合并而丢弃）", ["outcome"]
+)
+JOBS_FAILED = metrics.Counter("scheduler_jobs_failed_total", "投递失败的次数（网络错误或非 2xx，每次重试都计入）")
+DELIVERY_SECONDS = metrics.Histogram("scheduler_delivery_seconds", "向 Agent 投递一次触发的耗时")
+DELIVERIES_INFLIGHT = metrics.Gauge("scheduler_deliveries_inflight", "正在投递中的触发数")
+metrics.Gauge("scheduler_jobs", "调度器中的定时任务数").set_function(lambda: len(scheduler.get_jobs()))
+
+
+def _retry_after(resp) -> Optional[float]:
+    try:
+        return float(resp.headers.get("Retry-After", ""))
+    except ValueError:
+        return None
+
+
+async def send_to_agent(item: dict):
+    """把 outbox 中的一条触发投递给 Agent，失败时抛出 DeliveryFailed 交给 outbox 重试"""
+    DELIVERIES_INFLIGHT.inc()
+    start = time.perf_counter()
+    sent_at = time.time()
+    try:
+        resp = await app.state.http_client.post(AGENT_URL, json={"user_id": item["user_id"], "text": item["text"]})
+    except httpx.HTTPError as e:
+        JOBS_FAILED.inc()
+        error = f"{type(e).__name__}: {e}"
+        fire_recorder.record(item, sent_at, time.time(), error=error)
+        raise DeliveryFailed(error)
+    finally:
+        DELIVERY_SECONDS.observe(time.perf_counter() - start)
+        DELIVERIES_INFLIGHT.dec()
+    fire_recorder.record(item, sent_at, time.time(), status=resp.status_code)
+    late = f", 延迟={item['lateness']:.1f}s" if "lateness" in item else ""
+    print(f"[{datetime.now()}] 任务触发：用户={item['user_id']}, 状态码={resp.status_code}{late}")
+    if resp.status_code >= 400:
+        JOBS_FAILED.inc()
+        # 429 与 5xx 可重试；其他 4xx（如请求格式错误）重试也不会成功，直接进死信
+        raise DeliveryFailed(
+            f"HTTP {resp.status_code}: {resp.text[:200]}",
+            retryable=resp.status_code == 429 or resp.status_code >= 500,
+            retry_after=_retry_after(resp),
+        )
+
+
+outbox = Outbox(
+    TASKS_DB, send_to_agent,
+    concurrency=FIRE_MAX_INFLIGHT, max_attempts=DELIVERY_MAX_ATTEMPTS,
+    backoff_base=DELIVERY_BACKOFF_BASE, backoff_max=DELIVERY_BACKOFF_MAX,
+    jitter=FIRE_JITTER_SECONDS, rate=FIRE_RATE_PER_SECOND,
+    owner=leases.instance_id if leases else "local", shared=leases is not None,
+    claim_timeout=max(120.0, DELIVERY_TIMEOUT * 4),
+)
+
+
+# APScheduler 提交任务时的计划触发时间：task_id -> 待执行的计划时间队列（由 on_job_submitted 写入）
+_scheduled_runs: dict[str, deque] = {}
+
+
+def on_job_submitted(event):
+    """任务提交给执行器时记录计划触发时间，trigger_agent 开始执行时取出"""
+    _scheduled_runs.setdefault(event.job_id, deque()).extend(event.scheduled_run_times)
+
+
+def pop_scheduled_time(task_id: str, job, now: float) -> Optional[float]:
+    """
+    取出本次执行对应的计划触发时间。同一次提交的多个计划时间中，超过宽限时间的会被 APScheduler
+    跳过而不执行 trigger_agent，这里同样跳过
+    """
+    runs = _scheduled_runs.get(task_id)
+    if not runs:
+        return None
+    grace = job.misfire_grace_time if job else None
+    scheduled = None
+    while runs:
+        scheduled = runs.popleft().timestamp()
+        if grace is None or now - scheduled <= grace:
+            break
+    if not runs:
+        del _scheduled_runs[task_id]
+    return scheduled
+
+
+# 因租约临近失效而跳过触发的分区，下一次续期后重新加载（按错过触发策略补发）
+_fenced_partitions: set[int] = set()
+
+
+async def trigger_agent(user_id: str, text: str, task_id: Optional[str] = None):
+    """到达定时时间：先写入 outbox，再由后台投递给 Agent（失败自动重试）"""
+    fired_at = time.time()
+    job = scheduler.get_job(task_id) if task_id else None
+    scheduled_at = (pop_scheduled_time(task_id, job, fired_at) if task_id else None) or fired_at
+    if leases is not None:
+        partition = leases.partition_of(user_id)
+        if not leases.valid(partition, fired_at):
+            # 租约可能已被其他实例接管：不触发，也不推进任务表中的下次触发时间
+            FIRES_FENCED.inc()
+            _fenced_partitions.add(partition)
+            return
+    JOBS_FIRED.inc()
+    # APScheduler 在执行回调前已把 next_run_time 推进到下一次；没有下一次的任务（一次性任务）已被移出调度器，
+    # 这次触发为最后一次，送达后删除任务
+    await outbox.enqueue(
+        task_id, user_id, text, scheduled_at=scheduled_at, fired_at=fired_at,
+        next_run=next_run_ts(job) if job else None, final=task_id is not None and job is None,
+    )
+
+def cron_trigger(cron: str) -> CronTrigger:
+    """把 "分 时 日 月 周" 五段式表达式解析为触发器，格式错误抛出 ValueError"""
+    c = cron.split()
+    if len(c) != 5:
+        raise ValueError(f"需要 5 段（分 时 日 月 周），实际为 {len(c)} 段")
+    return CronTrigger(minute=c[0], hour=c[1], day=c[2], month=c[3], day_of_week=c[4])
+
+
+def task_trigger(spec):
+    """
+    按触发描述创建触发器：spec 为 Cron 表达式，或 (trigger_type, run_at, interval_seconds)（与任务表的列对应），
+    格式错误抛出 ValueError
+    """
+    if isinstance(spec, str):
+        return cron_trigger(spec)
+    kind, run_at, interval = spec
+    start = datetime.fromtimestamp(run_at, scheduler.timezone)
+    if kind == "date":
+        return DateTrigger(run_date=start)
+    if kind == "interval":
+        return IntervalTrigger(seconds=interval, start_date=start, timezone=scheduler.timezone)
+    raise ValueError(f"未知的触发方式: {kind}")
+
+
+def to_timestamp(value: Union[float, str]) -> float:
+    """Unix 时间戳或 ISO 8601 时间（不带时区时按调度器时区），无法解析时抛出 ValueError"""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"无法解析时间: {value}")
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=scheduler.timezone)
+    return dt.timestamp()
+
+
+def parse_task(task: CronTask):
+    """校验新任务的触发设置，返回 (触发描述, 触发器)；有误时抛出 ValueError"""
+    if task.trigger == "cron":
+        return task.cron, cron_trigger(task.cron)
+    now = time.time()
+    if task.trigger == "date":
+        if task.run_at is None:
+            raise ValueError("一次性任务需要 run_at")
+        run_at = to_timestamp(task.run_at)
+        if run_at <= now:
+            raise ValueError("run_at 已经过去")
+        spec = ("date", run_at, None)
+    else:
+        interval = task.interval_seconds
+        if interval is None or interval < MIN_INTERVAL_SECONDS:
+            raise ValueError(f"interval_seconds 不能小于 {MIN_INTERVAL_SECONDS}")
+        run_at = to_timestamp(task.run_at) if task.run_at is not None else now + interval
+        spec = ("interval", run_at, interval)
+    return spec, task_trigger(spec)
+
+
+def next_run_ts(job) -> Optional[float]:
+    return job.next_run_time.timestamp() if job.next_run_time else None
+
+
+def task_policy(record: dict) -> tuple[int, bool]:
+    """任务生效的 (宽限秒数, 是否合并)，未单独设置时取全局默认值"""
+    grace = record.get("misfire_grace_time")
+    coalesce = record.get("coalesce")
+    return (
+        MISFIRE_GRACE_TIME if grace is None else grace,
+        TASK_COALESCE if coalesce is None else bool(coalesce),
+    )
+
+
+# 后台任务的引用（防止被垃圾回收）
+_background_tasks: set = set()
+# 最近一次启动时各任务错过触发的处理结果：task_id -> {"missed", "replayed", "dropped"}
+catch_up_report: dict[str, dict] = {}
+
+
+async def catch_up(missed: list[dict]) -> tuple[int, int]:
+    """按策略补发停机期间错过的触发（按计划时间先后、限速写入 outbox），返回 (补发数, 丢弃数)"""
+    items, dropped = [], 0
+    for m in missed:
+        replay = m["replay"] if MISFIRE_CATCH_UP else []
+        for i, ts in enumerate(replay, 1):
+            planned = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M")
+            text = f"（补发：原定 {planned} 的定时任务）{m['text']}"
+            # 已过期的一次性任务：最后一条补发送达后删除任务
+            items.append((m["task_id"], m["user_id"], text, ts, m["final"] and i == len(replay)))
+        catch_up_report[m["task_id"]] = {
+            "missed": m["missed"], "replayed": len(replay), "dropped": m["missed"] - len(replay),
+        }
+        dropped += m["missed"] - len(replay)
+    items.sort(key=lambda item: item[3])
+    await outbox.enqueue_many(items, CATCH_UP_RATE_PER_SECOND)
+    JOBS_MISSED.labels(outcome="replayed").inc(len(items))
+    JOBS_MISSED.labels(outcome="dropped").inc(dropped)
+    return len(items), dropped
+
+
+async def restore_tasks(partitions: Optional[set] = None, task_ids: Optional[list[str]] = None):
+    """
+    从任务存储批量恢复定时任务，最后只输出一行汇总。启动时在调度器暂停状态下调用；
+    多实例模式下只恢复 partitions 中的任务（新认领的分区），或 task_ids 指定的任务（其他实例新建的）
+    """
+    start = time.perf_counter()
+    # 恢复期间屏蔽 APScheduler 逐个任务的 "Added job" 日志
+    aps_logger = logging.getLogger("apscheduler")
+    level = aps_logger.level
+    aps_logger.setLevel(logging.WARNING)
+    try:
+        with paused_gc():
+            rows = await task_store.restore_rows(
+                partitions=partitions, partition_count=SCHEDULER_PARTITIONS, task_ids=task_ids
+            )
+            stats = bulk_restore(
+                scheduler, jobstore, trigger_agent, rows, task_trigger,
+                misfire_grace_time=MISFIRE_GRACE_TIME, coalesce=TASK_COALESCE, max_replay=MAX_REPLAY_PER_TASK,
+            )
+    finally:
+        aps_logger.setLevel(level)
+    if not rows:
+        if task_ids is None:
+            print("📭 无已保存的定时任务")
+        return
+    scheduler.wakeup()
+    # 先把补发写入 outbox，再写回新的下次触发时间：中途退出时下次启动会重新计算错过的触发
+    replayed, dropped = await catch_up(stats["missed"])
+    # 下次触发时间的写回不阻塞启动
+    writer = asyncio.create_task(task_store.set_next_runs(stats["next_runs"]))
+    _background_tasks.add(writer)
+    writer.add_done_callback(_background_tasks.discard)
+
+    scope = f"分区 {sorted(partitions)} 的" if partitions is not None else ""
+    if task_ids is None:
+        print(
+            f"✅ 已从 {TASKS_DB} 恢复{scope} {stats['restored']} 个定时任务"
+            f"（{stats['triggers']} 种触发规则），耗时 {time.perf_counter() - start:.2f}s"
+        )
+    if stats["missed"]:
+        rate = f"，按每秒 {CATCH_UP_RATE_PER_SECOND:g} 条补发" if replayed else ""
+        print(f"   ⏰ {len(stats['missed'])} 个任务在停机期间错过触发：补发 {replayed} 次，丢弃 {dropped} 次{rate}")
+    if stats["failed"]:
+        sample = "; ".join(f"{task_id}: {err}" for task_id, err in stats["failed"][:5])
+        print(f"   ⚠️ {len(stats['failed'])} 个任务恢复失败（触发设置错误），例如 {sample}")
+
+
+def unload_partitions(partitions: set) -> int:
+    """停止调度这些分区中的任务（释放或丢失租约时），返回移除的任务数"""
+    ids = [job.id for job in jobstore.get_all_jobs() if partition_of(job.args[0], SCHEDULER_PARTITIONS) in partitions]
+    jobstore.remove_jobs(ids)
+    for task_id in ids:
+        _scheduled_runs.pop(task_id, None)
+        catch_up_report.pop(task_id, None)
+    return len(ids)
+
+
+def owns(user_id: str) -> bool:
+    """本实例是否负责调度该用户的任务（单实例模式下总是）"""
+    return leases is None or leases.partition_of(user_id) in leases.owned
+
+
+async def rebalance():
+    """续期租约并按结果加载 / 卸载分区"""
+    gained, lost, surplus = await leases.renew()
+    # 本实例曾跳过触发的分区：卸载后重新加载，由错过触发策略补发
+    refenced = _fenced_partitions & set(leases.owned)
+    _fenced_partitions.clear()
+    if lost:
+        print(f"⚠️ 分区租约已失效: {sorted(lost)}，停止调度 {unload_partitions(lost)} 个任务")
+    if surplus:
+        # 先停止调度并写回下次触发时间，再释放，接管方据此计算错过的触发
+        count = unload_partitions(surplus)
+        await flush_next_runs()
+        await leases.release(surplus)
+        print(f"🔀 释放分区 {sorted(surplus)}（{count} 个任务）给其他实例")
+    reload = (gained | refenced) - surplus
+    if refenced - gained:
+        unload_partitions(refenced - gained)
+    if reload:
+        await restore_tasks(partitions=reload)
+
+
+async def sync_changes():
+    """同步其他实例收到的增删：新任务属于本实例的分区则加载，已删除的任务停止调度"""
+    changes = await task_store.changes_since(app.state.change_seq)
+    if not changes:
+        return
+    app.state.change_seq = changes[-1][0]
+    added, removed = {}, []
+    for _, task_id, user_id, op in changes:
+        if op == "add":
+            added[task_id] = user_id
+        else:
+            added.pop(task_id, None)
+            removed.append(task_id)
+    jobstore.remove_jobs([t for t in removed if jobstore.lookup_job(t) is not None])
+    new = [t for t, user_id in added.items() if owns(user_id) and jobstore.lookup_job(t) is None]
+    if new:
+        await restore_tasks(task_ids=new)
+
+
+async def partition_loop():
+    last_prune = 0.0
+    while True:
+        await asyncio.sleep(LEASE_RENEW_INTERVAL)
         try:
-            resp = await client.post(AGENT_URL, json={"user_id": user_id, "text": text}, timeout=10.0)
-            print(f"[{datetime.now()}] 任务触发：用户={user_id}, 状态码={resp.status_code}")
+            await rebalance()
+            await sync_changes()
+            await outbox.requeue_stale()
+            await outbox.refresh_counts()
+            if time.time() - last_prune > 60:
+                await task_store.prune_changes(time.time() - TASK_CHANGES_RETENTION)
+                last_prune = time.time()
         except Exception as e:
-            print(f"[{datetime.now()}] 任务触发失败: {e}")
+            print(f"⚠️ 分区续期 / 同步失败: {e}")
+
+
+_dirty_next_runs: dict[str, Optional[float]] = {}
+
 
-def restore_tasks():
-    """从 JSON 文件恢复所有定时任务到调度器"""
-    tasks = load_tasks()
-    if not tasks:
-        print("📭 无已保存的定时任务")
+def on_job_event(event):
+    """任务执行后记录新的下次触发时间，由 flush_next_runs_loop 批量写回"""
+    if event.code == EVENT_JOB_MISSED:
+        # 运行期间（如事件循环阻塞）晚于宽限时间的触发，由 APScheduler 跳过
+        JOBS_MISSED.labels(outcome="dropped").inc()
+    job = scheduler.get_job(event.job_id)
+    if job is not None:
+        _dirty_next_runs[event.job_id] = next_run_ts(job)
+    elif event.code == EVENT_JOB_MISSED:
+        # 一次性任务被跳过后已移出调度器：标记为已触发，由 sweep_loop 清理
+        _dirty_next_runs[event.job_id] = None
+
+
+async def flush_next_runs():
+    if not _dirty_next_runs:
         return
-    
-    restored = 0
-    for task_id, info in tasks.items():
+    items = list(_dirty_next_runs.items())
+    _dirty_next_runs.clear()
+    try:
+        await task_store.set_next_runs(items)
+    except Exception as e:
+        print(f"⚠️ 写回下次触发时间失败: {e}")
+
+
+async def flush_next_runs_loop():
+    while True:
+        await asyncio.sleep(NEXT_RUN_FLUSH_INTERVAL)
+        await flush_next_runs()
+        fire_recorder.flush()
+
+
+async def sweep_once():
+    if leases is None:
         try:
-            c = info["cron"].split()
-            scheduler.add_job(
-                trigger_agent,
-                'cron',
-                minute=c[0], hour=c[1], day=c[2], month=c[3], day_of_week=c[4],
-                args=[info["user_id"], info["text"]],
-                id=task_id,
-                replace_existing=True
-            )
-            restored += 1
-            print(f"   - [ID: {task_id}] 用户: {info['user_id']}, cron: {info['cron']}, 内容: {info['text']}")
+            await outbox.requeue_stale()
         except Exception as e:
-            print(f"   ⚠️ 恢复任务 {task_id} 失败: {e}")
-    
-    print(f"✅ 已从 {TASKS_FILE} 恢复 {restored} 个定时任务")
+            print(f"⚠️ 回收超时的投递记录失败: {e}")
+    try:
+        removed = await task_store.sweep_one_shots()
+    except Exception as e:
+        print(f"⚠️ 清理一次性任务失败: {e}")
+        return
+    for task_id in removed:
+        catch_up_report.pop(task_id, None)
+    if removed:
+        print(f"🧹 已清理 {len(removed)} 个已过期的一次性任务")
+
+
+async def sweep_loop():
+    """
+    定期删除已触发但不会再送达的一次性任务（正常送达的已由 outbox 删除）；
+    单实例时顺带把卡在 sending 的投递记录放回队列（多实例时由 partition_loop 负责）。
+    关闭时不打断进行中的清理：写事务被取消后会一直持有写锁，关闭 outbox 时报 database is locked
+    """
+    while True:
+        await asyncio.sleep(ONE_SHOT_SWEEP_INTERVAL)
+        await asyncio.shield(sweep_once())
 
 # --- 生命周期 ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("定时调度中心启动...")
-    scheduler.start()
-    restore_tasks()
+    await task_store.open()
+    migrated = await task_store.migrate_json(LEGACY_TASKS_FILE)
+    if migrated:
+        print(f"📦 已从 {LEGACY_TASKS_FILE} 迁移 {migrated} 个任务到 {TASKS_DB}")
+    # 到 Agent 的长连接池，所有投递共用
+    app.state.http_client = httpx.AsyncClient(
+        timeout=DELIVERY_TIMEOUT,
+        limits=httpx.Limits(max_connections=DELIVERY_MAX_CONNECTIONS, max_keepalive_connections=DELIVERY_MAX_CONNECTIONS),
+    )
+    await outbox.open()
+    outbox.start()
+    if outbox.backlog or outbox.dead:
+        print(f"📮 投递队列：待投递 {outbox.backlog} 条，死信 {outbox.dead} 条")
+    scheduler.add_listener(on_job_event, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+    scheduler.add_listener(on_job_submitted, EVENT_JOB_SUBMITTED)
+    fire_recorder.open()
+    # 暂停状态下批量恢复，完成后再开始调度
+    scheduler.start(paused=True)
+    partition_task = None
+    if leases is None:
+        await restore_tasks()
+    else:
+        await leases.open()
+        app.state.change_seq = await task_store.last_change()
+        print(f"🧩 多实例模式：实例 {leases.instance_id}，共 {SCHEDULER_PARTITIONS} 个分区")
+        await rebalance()
+        if not leases.owned:
+            print("📭 暂未分到分区，等待其他实例释放")
+        partition_task = asyncio.create_task(partition_loop())
+    scheduler.resume()
+    flush_task = asyncio.create_task(flush_next_runs_loop())
+    sweep_task = asyncio.create_task(sweep_loop())
     yield
     print("定时调度中心关闭...")
+    background = [t for t in (flush_task, sweep_task, partition_task) if t is not None]
+    for t in background:
+        t.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
     scheduler.shutdown()
+    await outbox.close()
+    await app.state.http_client.aclose()
+    fire_recorder.close()
+    await flush_next_runs()
+    if leases is not None:
+        await leases.close()
+    await task_store.close()
 
 app = FastAPI(title="Xavier Scheduler", lifespan=lifespan)
 
+def new_record(task: CronTask, spec, trigger) -> dict:
+    first_run = trigger.get_next_fire_time(None, datetime.now(scheduler.timezone))
+    kind, run_at, interval = spec if isinstance(spec, tuple) else (None, None, None)
+    return {
+        "user_id": task.user_id,
+        "cron": spec if kind is None else "",
+        "text": task.text,
+        "misfire_grace_time": task.misfire_grace_time,
+        "coalesce": task.coalesce,
+        "trigger_type": kind,
+        "run_at": run_at,
+        "interval_seconds": interval,
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "next_run": first_run.timestamp() if first_run else None,
+    }
+
+
+async def persist_new(records: list[dict]):
+    """分配 task_id 并在一个事务中写入；8 位 ID 在任务量大时可能碰撞，冲突时整批重新生成"""
+    for _ in range(5):
+        ids = set()
+        for record in records:
+            task_id = str(uuid.uuid4())[:8]
+            while task_id in ids:
+                task_id = str(uuid.uuid4())[:8]
+            ids.add(task_id)
+            record["task_id"] = task_id
+        try:
+            await task_store.add_many(records)
+            return
+        except TaskExists:
+            continue
+    raise HTTPException(status_code=500, detail="生成任务 ID 失败")
+
+
+def schedule(record: dict, trigger):
+    """加入调度器；多实例模式下不属于本实例分区的任务返回 None，由持有该分区的实例同步加载"""
+    if not owns(record["user_id"]):
+        return None
+    grace, coalesce = task_policy(record)
+    return scheduler.add_job(
+        trigger_agent,
+        trigger,
+        args=[record["user_id"], record["text"], record["task_id"]],
+        id=record["task_id"],
+        misfire_grace_time=grace or None,
+        coalesce=coalesce,
+        replace_existing=True
+    )
+
+
+def next_run_str(record: dict, job) -> Optional[str]:
+    """本实例调度的任务取调度器中的下次触发时间，其他实例的任务取任务表中保存的"""
+    if job is not None:
+        return str(job.next_run_time)
+    if record.get("next_run") is not None:
+        return str(datetime.fromtimestamp(record["next_run"], scheduler.timezone))
+    return None
+
+
+def trigger_fields(record: dict) -> dict:
+    run_at = record.get("run_at")
+    return {
+        "trigger": record.get("trigger_type") or "cron",
+        "cron": record["cron"],
+        "run_at": str(datetime.fromtimestamp(run_at, scheduler.timezone)) if run_at is not None else None,
+        "interval_seconds": record.get("interval_seconds"),
+    }
+
+
+def task_response(record: dict, job) -> dict:
+    grace, coalesce = task_policy(record)
+    return {
+        "task_id": record["task_id"],
+        "user_id": record["user_id"],
+        **trigger_fields(record),
+        "text": record["text"],
+        "next_run": next_run_str(record, job),
+        "misfire_grace_time": grace,
+        "coalesce": coalesce,
+    }
+
+
 @app.post("/tasks", response_model=TaskResponse)
 async def add_task(task: CronTask):
-    task_id = str(uuid.uuid4())[:8]
     try:
-        c = task.cron.split()
-        scheduler.add_job(
-            trigger_agent,
-            'cron',
-            minute=c[0], hour=c[1], day=c[2], month=c[3], day_of_week=c[4],
-            args=[task.user_id, task.text],
-            id=task_id,
-            replace_existing=True
-        )
-        # 持久化到 JSON
-        tasks = load_tasks()
-        tasks[task_id] = {
-            "user_id": task.user_id,
-            "cron": task.cron,
-            "text": task.text,
-            "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
-        save_tasks(tasks)
+        spec, trigger = parse_task(task)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"触发设置错误: {e}")
 
-        return {**task.model_dump(), "task_id": task_id, "next_run": "已激活"}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Cron 格式错误: {e}")
+    record = new_record(task, spec, trigger)
+    await persist_new([record])
+    return task_response(record, schedule(record, trigger))
+
+@app.post("/tasks:batch")
+async def add_tasks_batch(req: BatchCreateRequest):
+    """批量创建：先校验全部触发设置，任一有误则不创建任何任务并逐条返回错误；否则一个事务写入"""
+    if not req.tasks:
+        raise HTTPException(status_code=400, detail="任务列表为空")
+    if len(req.tasks) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"单次最多 {MAX_BATCH_SIZE} 个任务")
+
+    parsed, errors = [], []
+    for i, task in enumerate(req.tasks):
+        try:
+            parsed.append(parse_task(task))
+        except ValueError as e:
+            errors.append({"index": i, "trigger": task.trigger, "cron": task.cron, "error": str(e)})
+    if errors:
+        raise HTTPException(status_code=400, detail={"message": "触发设置有误，未创建任何任务", "errors": errors})
+
+    records = [new_record(task, spec, trigger) for task, (spec, trigger) in zip(req.tasks, parsed)]
+    await persist_new(records)
+    return {
+        "status": "created",
+        "tasks": [task_response(r, schedule(r, trigger)) for r, (_, trigger) in zip(records, parsed)],
+    }
+
+@app.delete("/tasks:batch")
+async def delete_tasks_batch(req: BatchDeleteRequest):
+    """批量删除：一个事务完成，逐条返回 deleted / not_found"""
+    if len(req.task_ids) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"单次最多 {MAX_BATCH_SIZE} 个任务")
+    deleted = set(await task_store.delete_many(req.task_ids, user_id=req.user_id))
+    for task_id in deleted:
+        catch_up_report.pop(task_id, None)
+        if scheduler.get_job(task_id):
+            scheduler.remove_job(task_id)
+    return {
+        "deleted": len(deleted),
+        "results": [
+            {"task_id": t, "status": "deleted" if t in deleted else "not_found"} for t in req.task_ids
+        ],
+    }
 
 @app.get("/tasks")
-async def list_tasks():
-    tasks = load_tasks()
-    return [
-        {
-            "task_id": j.id, 
-            "user_id": j.args[0], 
-            "text": j.args[1], 
-            "cron": tasks.get(j.id, {}).get("cron", str(j.trigger)),
-            "next_run": str(j.next_run_time)
-        } for j in scheduler.get_jobs()
-    ]
+async def list_tasks(user_id: Optional[str] = None, limit: int = 50, cursor: Optional[str] = None):
+    """按用户分页列出任务：cursor 传上一页返回的 next_cursor"""
+    limit = max(1, min(limit, 500))
+    tasks, next_cursor = await task_store.page(user_id=user_id, limit=limit, cursor=cursor)
+    result = []
+    for t in tasks:
+        job = scheduler.get_job(t["task_id"])
+        grace, coalesce = task_policy(t)
+        result.append({
+            "task_id": t["task_id"],
+            "user_id": t["user_id"],
+            "text": t["text"],
+            **trigger_fields(t),
+            "next_run": next_run_str(t, job) if job or leases is not None else None,
+            "misfire_grace_time": grace,
+            "coalesce": coalesce,
+            # 最近一次重启时停机期间错过的触发：总数、补发数、丢弃数
+            "catch_up": catch_up_report.get(t["task_id"]),
+        })
+    return {"tasks": result, "next_cursor": next_cursor}
+
+def parse_time(value: str) -> float:
+    """Unix 时间戳或 ISO 8601 时间（不带时区时按调度器时区）"""
+    try:
+        return to_timestamp(value)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def parse_duration(value: str) -> int:
+    """"60s" / "5m" / "1h" / "1d" 或秒数"""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    try:
+        if value and value[-1] in units:
+            return int(value[:-1]) * units[value[-1]]
+        return int(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"无法解析时长: {value}")
+
+
+@app.get("/tasks/timeline")
+async def tasks_timeline(start: Optional[str] = Query(None, alias="from"), end: Optional[str] = Query(None, alias="to"),
+                         bucket: str = "60s", top: int = 5):
+    """
+    展开 [from, to) 内全部任务的计划触发，按 bucket 统计触发数与 Top 用户（只返回有触发的桶），
+    默认从现在起 24 小时。不含补发与重试，只反映任务计划本身的负载。
+    """
+    start_ts = parse_time(start) if start else time.time()
+    end_ts = parse_time(end) if end else start_ts + 86400
+    bucket_seconds = parse_duration(bucket)
+    if end_ts <= start_ts:
+        raise HTTPException(status_code=400, detail="to 必须晚于 from")
+    if end_ts - start_ts > TIMELINE_MAX_DAYS * 86400:
+        raise HTTPException(status_code=400, detail=f"时间窗口最长 {TIMELINE_MAX_DAYS} 天")
+    if bucket_seconds <= 0 or (end_ts - start_ts) / bucket_seconds > TIMELINE_MAX_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"bucket 须为正数且桶数不超过 {TIMELINE_MAX_BUCKETS}")
+    groups = await task_store.trigger_user_counts()
+    # 展开与统计是纯 CPU 计算，放到线程中避免阻塞调度
+    return await asyncio.to_thread(
+        fire_timeline, groups, start_ts, end_ts, bucket_seconds, scheduler.timezone, max(1, min(top, 50))
+    )
 
 @app.delete("/tasks/{task_id}")
-async def delete_task(task_id: str):
-    if scheduler.get_job(task_id):
-        scheduler.remove_job(task_id)
-        # 从 JSON 中删除
-        tasks = load_tasks()
-        tasks.pop(task_id, None)
-        save_tasks(tasks)
+async def delete_task(task_id: str, user_id: Optional[str] = None):
+    # 指定 user_id 时只能删除自己的任务，他人的任务同样返回 404
+    if await task_store.delete(task_id, user_id=user_id):
+        catch_up_report.pop(task_id, None)
+        if scheduler.get_job(task_id):
+            scheduler.remove_job(task_id)
         return {"status": "deleted"}
     raise HTTPException(status_code=404, detail="未找到任务")
 
+# --- 投递队列与死信 ---
+@app.get("/outbox")
+async def outbox_stats():
+    return outbox.stats()
+
+@app.get("/outbox/dead")
+async def list_dead_letters(limit: int = 50):
+    return await outbox.list_dead(min(limit, 500))
+
+@app.post("/outbox/dead/{item_id}/retry")
+async def retry_dead_letter(item_id: int):
+    if await outbox.retry_dead(item_id):
+        return {"status": "requeued"}
+    raise HTTPException(status_code=404, detail="未找到死信")
+
+@app.delete("/outbox/dead/{item_id}")
+async def delete_dead_letter(item_id: int):
+    if await outbox.delete_dead(item_id):
+        return {"status": "deleted"}
+    raise HTTPException(status_code=404, detail="未找到死信")
+
+@app.get("/fires/stats")
+async def fire_stats(minutes: int = 60):
+    """最近 minutes 分钟每分钟的投递次数、失败数，以及延迟与投递耗时的 p50 / p90 / p99 / max（秒）"""
+    return {"minutes": fire_recorder.stats(max(1, min(minutes, fire_recorder.keep_minutes)))}
+
+@app.get("/partitions")
+async def partition_status():
+    """多实例模式下各分区的租约持有情况"""
+    if leases is None:
+        return {"mode": "single"}
+    return {
+        "mode": "partitioned",
+        "instance_id": leases.instance_id,
+        "partitions": SCHEDULER_PARTITIONS,
+        "owned": sorted(leases.owned),
+        "jobs": len(jobstore.get_all_jobs()),
+        "leases": await leases.table(),
+    }
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 if __name__ == "__main__":
     uvicorn.run(app, host="127.0.0.1", port=int(os.getenv("PORT_SCHEDULER", "51201")))
\ No newline at end of file
@@ -0,0 +1,199 @@
+"""
+定时任务触发时间线：在给定时间窗口内展开全部任务的 Cron 表达式，按时间桶统计触发数与触发最多的用户，
+用于对照 LLM 限流做容量规划（GET /tasks/timeline）。
+
+不对每个任务逐次调用 trigger.get_next_fire_time：
+- 任务先在数据库中按 (cron, user_id) 聚合计数，每种表达式只展开一次，再乘以任务数；
+- 表达式拆成"一天中的时刻"（分、时）与"日期"（日、月、周）两部分分别展开并缓存，
+  触发时间为两者的组合（如 2000 种 "m h * * *" 共用同一份日期展开），夏令时切换当天单独逐次计算；
+- 每个时间桶的 Top 用户按"桶内有哪些表达式、各触发几次"去重计算，
+  且不合并用户最多的那个表达式（如 "* * * * *"）的完整用户表。
+一次性（date）与固定间隔（interval）任务的触发描述为 (类型, run_at, 间隔秒数)，直接按时间算术展开。
+"""
+import heapq
+import math
+from functools import lru_cache
+from datetime import datetime, date, time, timedelta, timezone
+from collections import defaultdict
+
+from apscheduler.triggers.cron import CronTrigger
+
+# 用 UTC 展开两部分，避免本地时区的夏令时干扰；组合时再按调度器时区换算
+_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+
+@lru_cache(maxsize=4096)
+def _times_of_day(minute: str, hour: str) -> tuple[int, ...]:
+    """一天中的触发时刻（距零点的秒数）"""
+    trigger = CronTrigger(minute=minute, hour=hour, timezone=timezone.utc)
+    end = _EPOCH + timedelta(days=1)
+    result = []
+    fire = trigger.get_next_fire_time(None, _EPOCH)
+    while fire is not None and fire < end:
+        result.append(int((fire - _EPOCH).total_seconds()))
+        fire = trigger.get_next_fire_time(fire, fire)
+    return tuple(result)
+
+
+def _dates(day: str, month: str, day_of_week: str, first: date, last: date) -> list[date]:
+    """[first, last] 之间日、月、周都匹配的日期"""
+    trigger = CronTrigger(day=day, month=month, day_of_week=day_of_week, hour=0, minute=0, timezone=timezone.utc)
+    fire = trigger.get_next_fire_time(None, datetime.combine(first, time(), timezone.utc))
+    result = []
+    while fire is not None and fire.date() <= last:
+        result.append(fire.date())
+        fire = trigger.get_next_fire_time(fire, fire)
+    return result
+
+
+class _Expander:
+    """在 [start, end) 内展开 Cron 表达式，返回 Unix 时间戳列表；日期部分与每日零点时间戳在一次请求内缓存"""
+    def __init__(self, start: float, end: float, tz):
+        self.start, self.end, self.tz = start, end, tz
+        self.first = datetime.fromtimestamp(start, tz).date() - timedelta(days=1)
+        self.last = datetime.fromtimestamp(end, tz).date()
+        self._dates = {}
+        self._days = {}
+
+    def _day(self, d: date) -> tuple[float, bool]:
+        """(当地零点的时间戳, 当天 UTC 偏移是否不变)"""
+        info = self._days.get(d)
+        if info is None:
+            midnight = datetime.combine(d, time(), self.tz)
+            next_midnight = datetime.combine(d + timedelta(days=1), time(), self.tz)
+            info = (midnight.timestamp(), midnight.utcoffset() == next_midnight.utcoffset())
+            self._days[d] = info
+        return info
+
+    def expand(self, cron) -> list[float]:
+        """cron 为五段式表达式或 (类型, run_at, 间隔秒数)，格式错误抛出 ValueError"""
+        if isinstance(cron, tuple):
+            return self._expand_simple(*cron)
+        c = cron.split()
+        if len(c) != 5:
+            raise ValueError(f"需要 5 段（分 时 日 月 周），实际为 {len(c)} 段")
+        seconds = _times_of_day(c[0], c[1])
+        key = (c[2], c[3], c[4])
+        dates = self._dates.get(key)
+        if dates is None:
+            dates = self._dates[key] = _dates(c[2], c[3], c[4], self.first, self.last)
+        start, end = self.start, self.end
+        fires = []
+        for d in dates:
+            midnight, steady = self._day(d)
+            if steady:
+                fires.extend(ts for ts in (midnight + s for s in seconds) if start <= ts < end)
+            else:
+                fires.extend(ts for ts in self._transition_day(c[0], c[1], d) if start <= ts < end)
+        return fires
+
+    def _expand_simple(self, kind: str, run_at: float, interval) -> list[float]:
+        start, end = self.start, self.end
+        if kind == "date":
+            return [run_at] if start <= run_at < end else []
+        if kind == "interval" and interval and interval > 0:
+            first = run_at if run_at >= start else run_at + math.ceil((start - run_at) / interval) * interval
+            return [first + k * interval for k in range(max(0, math.ceil((end - first) / interval)))]
+        raise ValueError(f"未知的触发方式: {kind}")
+
+    def _transition_day(self, minute: str, hour: str, d: date) -> list[float]:
+        """夏令时切换当天按调度器时区逐次计算（与 APScheduler 一致：跳过的时刻不触发，重复的时刻触发两次）"""
+        key = (minute, hour, d)
+        fires = self._days.get(key)
+        if fires is None:
+            trigger = CronTrigger(minute=minute, hour=hour, timezone=self.tz)
+            end = datetime.combine(d + timedelta(days=1), time(), self.tz)
+            fires = []
+            fire = trigger.get_next_fire_time(None, datetime.combine(d, time(), self.tz))
+            while fire is not None and fire < end:
+                fires.append(fire.timestamp())
+                fire = trigger.get_next_fire_time(fire, fire)
+            self._days[key] = fires
+        return fires
+
+
+def _top_users(parts: list[tuple[int, list, dict]], k: int) -> list[tuple[str, int]]:
+    """
+    parts 为 [(桶内触发次数, 按任务数降序的 [(user_id, 任务数)], {user_id: 任务数})]，返回触发数最多的 k 个用户。
+    用户最多的表达式不整体合并：其余表达式的用户逐个算出总数，只出现在最大表达式中的用户
+    按其已排好的顺序取前 k 个即可。
+    """
+    parts = sorted(parts, key=lambda p: -len(p[1]))
+    big_mult, big_ranked, big_counts = parts[0]
+    scores = {}
+    for mult, ranked, _ in parts[1:]:
+        for user, n in ranked:
+            scores[user] = scores.get(user, 0) + n * mult
+    for user in scores:
+        scores[user] += big_mult * big_counts.get(user, 0)
+    only_big = []
+    for user, n in big_ranked:
+        if len(only_big) >= k:
+            break
+        if user not in scores:
+            only_big.append((user, n * big_mult))
+    return heapq.nlargest(k, [*scores.items(), *only_big], key=lambda item: item[1])
+
+
+def fire_timeline(groups: list[tuple[str, str, int]], start: float, end: float, bucket: int,
+                  tz, top: int = 5) -> dict:
+    """
+    groups 为 (触发描述, user_id, 任务数) 列表（见 task_store.trigger_user_counts），
+    统计 [start, end) 内每 bucket 秒的触发数与 Top 用户。
+    只返回有触发的桶。
+    """
+    by_cron = defaultdict(dict)
+    for cron, user_id, n in groups:
+        by_cron[cron][user_id] = n
+
+    expander = _Expander(start, end, tz)
+    buckets = defaultdict(dict)  # 桶序号 -> {cron: 桶内触发次数}
+    invalid = 0
+    for cron, users in by_cron.items():
+        try:
+            fires = expander.expand(cron)
+        except ValueError:
+            invalid += sum(users.values())
+            continue
+        for ts in fires:
+            slot = buckets[int((ts - start) // bucket)]
+            slot[cron] = slot.get(cron, 0) + 1
+
+    ranked = {}
+    totals = {cron: sum(users.values()) for cron, users in by_cron.items()}
+    top_cache = {}  # 桶内表达式组成相同的桶 Top 用户相同
+    result, total = [], 0
+    for index in sorted(buckets):
+        slot = buckets[index]
+        fires = sum(totals[cron] * mult for cron, mult in slot.items())
+        total += fires
+        signature = tuple(sorted(slot.items(), key=str))
+        top_users = top_cache.get(signature)
+        if top_users is None:
+            parts = []
+            for cron, mult in signature:
+                if cron not in ranked:
+                    ranked[cron] = sorted(by_cron[cron].items(), key=lambda item: -item[1])
+                parts.append((mult, ranked[cron], by_cron[cron]))
+            top_users = top_cache[signature] = [
+                {"user_id": user, "fires": n} for user, n in _top_users(parts, top)
+            ]
+        result.append({
+            "start": datetime.fromtimestamp(start + index * bucket, tz).isoformat(),
+            "fires": fires,
+            "top_users": top_users,
+        })
+
+    peak = max(result, key=lambda b: b["fires"], default=None)
+    return {
+        "from": datetime.fromtimestamp(start, tz).isoformat(),
+        "to": datetime.fromtimestamp(end, tz).isoformat(),
+        "bucket_seconds": bucket,
+        "tasks": sum(totals.values()) - invalid,
+        "invalid_tasks": invalid,
+        "total_fires": total,
+        "peak": None if peak is None else {
+            "start": peak["start"], "fires": peak["fires"], "per_second": round(peak["fires"] / bucket, 3),
+        },
+        "buckets": result,
+    }
@@ -0,0 +1,103 @@
+"""
+调度中心启动恢复耗时基准：在临时 tasks.db 中生成 N 个任务，测量从读库到全部任务进入调度器的时间。
+用法: python test/bench_restore.py [--sizes 1000,10000,100000] [--distinct 2000]
+任务的 Cron 表达式约七成取自少量常见写法（如 "0 9 * * *"），其余为随机的 "分 时 * * *"，
+--distinct 控制随机表达式的种类上限。对比项 add_job 为逐个调用 scheduler.add_job 的原始方式。
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import importlib.util
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from task_store import TaskStore
+from job_loader import BulkMemoryJobStore, bulk_restore, paused_gc
+
+# src/time.py 与标准库同名，按文件路径加载
+_spec = importlib.util.spec_from_file_location("scheduler_service", os.path.join(SRC_DIR, "time.py"))
+scheduler_service = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(scheduler_service)
+
+COMMON_CRONS = ["0 9 * * *", "30 8 * * 1-5", "0 */2 * * *", "0 22 * * *", "0 12 * * 6", "*/30 * * * *"]
+
+
+def make_tasks(n: int, distinct: int) -> list[dict]:
+    rnd = random.Random(n)
+    random_crons = [f"{rnd.randint(0, 59)} {rnd.randint(0, 23)} * * *" for _ in range(distinct)]
+    return [
+        {
+            "task_id": f"{i:08x}",
+            "user_id": f"user{rnd.randint(0, n // 10)}",
+            "cron": rnd.choice(COMMON_CRONS) if rnd.random() < 0.7 else rnd.choice(random_crons),
+            "text": "提醒我喝水",
+            "created_at": "2025-01-01 00:00:00",
+        }
+        for i in range(n)
+    ]
+
+
+async def bench(n: int, distinct: int, baseline: bool) -> dict:
+    result = {}
+    with tempfile.TemporaryDirectory() as d:
+        store = TaskStore(os.path.join(d, "tasks.db"))
+        await store.open()
+        await store.add_many(make_tasks(n, distinct))
+
+        jobstore = BulkMemoryJobStore()
+        scheduler = AsyncIOScheduler(jobstores={"default": jobstore})
+        scheduler.start(paused=True)
+        # 与 time.py 的 restore_tasks 相同的步骤
+        start = time.perf_counter()
+        with paused_gc():
+            rows = await store.restore_rows()
+            result["load"] = time.perf_counter() - start
+            stats = bulk_restore(
+                scheduler, jobstore, scheduler_service.trigger_agent, rows, scheduler_service.task_trigger
+            )
+        result["total"] = time.perf_counter() - start
+        assert stats["restored"] == n and len(scheduler.get_jobs()) == n
+        scheduler.shutdown(wait=False)
+
+        if baseline:
+            scheduler = AsyncIOScheduler()
+            scheduler.start(paused=True)
+            start = time.perf_counter()
+            for task_id, user_id, cron, text, *_ in await store.restore_rows():
+                scheduler.add_job(
+                    scheduler_service.trigger_agent, scheduler_service.task_trigger(cron),
+                    args=[user_id, text, task_id], id=task_id,
+                )
+            result["add_job"] = time.perf_counter() - start
+            scheduler.shutdown(wait=False)
+        await store.close()
+    return result
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="调度中心启动恢复耗时基准")
+    parser.add_argument("--sizes", type=str, default="1000,10000,100000", help="任务数，逗号分隔")
+    parser.add_argument("--distinct", type=int, default=2000, help="随机 Cron 表达式的种类上限")
+    parser.add_argument("--no-baseline", action="store_true", help="不测逐个 add_job 的对比项（10 万任务时较慢）")
+    args = parser.parse_args()
+
+    logging.getLogger("apscheduler").setLevel(logging.WARNING)
+    print(f"{'任务数':>8} {'读库(s)':>9} {'批量恢复(s)':>12} {'add_job(s)':>11}")
+    for n in (int(x) for x in args.sizes.split(",")):
+        r = await bench(n, args.distinct, baseline=not args.no_baseline)
+        add_job = f"{r['add_job']:.2f}" if "add_job" in r else "-"
+        flag = "" if r["total"] < 1 else "  ⚠️ 超过 1 秒"
+        print(f"{n:>8} {r['load']:>9.3f} {r['total']:>12.3f} {add_job:>11}{flag}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+"""
+对比并发搜索在两种实现下的总耗时与事件循环卡顿：
+  阻塞：在协程内直接调用同步的 DDGS（旧实现，一次搜索期间整个 MCP 服务无法处理其他请求）
+  线程池：web_search 经 run_blocking 在有界线程池中执行（受 SEARCH_MAX_CONCURRENCY 限制）
+用法: python test/bench_search_concurrency.py [--queries N] [--latency 秒] [--concurrency 上限] [--live]
+默认用 time.sleep 模拟每次 DuckDuckGo 请求的网络耗时，不访问外网；--live 则发起真实搜索。
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+
+class SlowDDGS:
+    """模拟 DDGS：每次搜索阻塞 latency 秒"""
+    latency = 1.0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def text(self, query, max_results=5):
+        time.sleep(self.latency)
+        return [{"title": query, "body": "", "href": f"https://example.com/{i}"} for i in range(max_results)]
+
+
+async def measure(label: str, make_calls, expected: float):
+    """并发执行 make_calls() 返回的协程，同时用 10ms 的心跳任务测量事件循环最长卡顿"""
+    stall = 0.0
+    stop = asyncio.Event()
+
+    async def heartbeat():
+        nonlocal stall
+        while not stop.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            stall = max(stall, time.perf_counter() - start - 0.01)
+
+    beat = asyncio.create_task(heartbeat())
+    await asyncio.sleep(0.02)
+    start = time.perf_counter()
+    results = await asyncio.gather(*make_calls(), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await beat
+    errors = sum(isinstance(r, Exception) or str(r).startswith("⚠️") for r in results)
+    hint = f"{expected:>10.2f}" if expected else f"{'-':>10}"
+    print(f"{label:<10}{len(results):>6}{elapsed:>10.2f}{hint}{stall * 1000:>14.0f}{errors:>6}")
+
+
+async def async_main(args):
+    import mcp_search
+
+    if not args.live:
+        SlowDDGS.latency = args.latency
+        mcp_search.DDGS = SlowDDGS
+    queries = [f"mini timebot benchmark {i}" for i in range(args.queries)]
+    latency = 0 if args.live else args.latency
+
+    async def blocking(query):
+        # 旧实现：同步调用直接写在协程里
+        return mcp_search.ddgs_search("text", query, 5)
+
+    print(f"并发上限 SEARCH_MAX_CONCURRENCY={mcp_search.SEARCH_MAX_CONCURRENCY}，超时 {mcp_search.SEARCH_TIMEOUT:g} 秒")
+    print(f"{'实现':<10}{'查询数':>6}{'耗时(s)':>10}{'理论(s)':>10}{'最长卡顿(ms)':>14}{'失败':>6}")
+    await measure("阻塞", lambda: [blocking(q) for q in queries], latency * len(queries))
+    waves = -(-len(queries) // mcp_search.SEARCH_MAX_CONCURRENCY)
+    await measure("线程池", lambda: [mcp_search.web_search(q) for q in queries], latency * waves)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对比并发搜索在阻塞调用与线程池下的耗时")
+    parser.add_argument("--queries", type=int, default=8, help="同时发起的搜索数（默认 8）")
+    parser.add_argument("--latency", type=float, default=1.0, help="模拟的单次搜索耗时，秒（默认 1.0）")
+    parser.add_argument("--concurrency", type=int, default=0, help="覆盖 SEARCH_MAX_CONCURRENCY（默认使用配置值）")
+    parser.add_argument("--live", action="store_true", help="发起真实的 DuckDuckGo 搜索")
+    args = parser.parse_args()
+    # 查询各不相同，关闭缓存只是为了多次运行时结果一致
+    os.environ["SEARCH_CACHE_TTL"] = "0"
+    os.environ["SEARCH_CACHE_DB"] = ""
+    if args.concurrency:
+        os.environ["SEARCH_MAX_CONCURRENCY"] = str(args.concurrency)
+    asyncio.run(async_main(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+对比三种工具执行模式的单次调用延迟：stdio（每次调用新起子进程）、pooled（常驻会话池）、inprocess（进程内直接调用）
+用法: python test/bench_tool_modes.py [--calls N] [--modes stdio,pooled,inprocess]
+默认调用 list_files（几乎没有业务开销），测得的即为各模式自身的固定成本。
+"""
+
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from langchain_mcp_adapters.client import MultiServerMCPClient
+
+from mainagent import MCP_SERVERS, build_mcp_connections
+from mcp_pool import MCPSessionPool
+from mcp_local import load_local_tools
+from mcp_filemanager import BASE_DIR
+
+BENCH_USER = "__bench_tool_modes"
+
+
+async def load_tools(mode: str):
+    """按模式加载工具，返回 (工具字典, 会话池或 None)"""
+    if mode == "inprocess":
+        return {t.name: t for t in load_local_tools(list(MCP_SERVERS.values()))}, None
+
+    connections = build_mcp_connections()
+    # 与 Agent 子进程保持同一解释器
+    for conn in connections.values():
+        conn["command"] = sys.executable
+    pool = None
+    interceptors = []
+    if mode == "pooled":
+        pool = MCPSessionPool(connections, size=1)
+        await pool.start()
+        interceptors.append(pool)
+    client = MultiServerMCPClient(connections, tool_interceptors=interceptors)
+    return {t.name: t for t in await client.get_tools()}, pool
+
+
+async def bench_mode(mode: str, calls: int) -> list[float]:
+    tools, pool = await load_tools(mode)
+    tool = tools["list_files"]
+    try:
+        # 预热一次，排除首次导入等一次性开销
+        await tool.ainvoke({"username": BENCH_USER})
+        latencies = []
+        for _ in range(calls):
+            start = time.perf_counter()
+            await tool.ainvoke({"username": BENCH_USER})
+            latencies.append((time.perf_counter() - start) * 1000)
+        return latencies
+    finally:
+        if pool is not None:
+            await pool.close()
+
+
+def percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+async def async_main(args):
+    print(f"{'模式':<12}{'次数':>6}{'平均(ms)':>12}{'P50(ms)':>12}{'P95(ms)':>12}")
+    for mode in args.modes.split(","):
+        latencies = await bench_mode(mode.strip(), args.calls)
+        print(
+            f"{mode:<12}{len(latencies):>6}{statistics.mean(latencies):>12.2f}"
+            f"{percentile(latencies, 0.5):>12.2f}{percentile(latencies, 0.95):>12.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对比 MCP 工具执行模式的单次调用延迟")
+    parser.add_argument("--calls", type=int, default=20, help="每种模式的调用次数（默认 20）")
+    parser.add_argument("--modes", type=str, default="stdio,pooled,inprocess", help="要测试的模式，逗号分隔")
+    args = parser.parse_args()
+    try:
+        asyncio.run(async_main(args))
+    finally:
+        shutil.rmtree(os.path.join(BASE_DIR, BENCH_USER), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,22 @@
 import requests
 import json
+import getpass
 
-def send_message(user_id, text):
+def login(user_id, password):
+    """登录并返回签名令牌"""
+    url = "http://127.0.0.1:51200/login"
+    response = requests.post(url, json={"user_id": user_id, "password": password})
+    response.raise_for_status()
+    return response.json()["token"]
+
+def send_message(token, text):
     url = "http://127.0.0.1:51200/ask"
     payload = {
-        "user_id": user_id,
         "text": text
     }
     headers = {
-        "Content-Type": "application/json"
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {token}"
     }
 
     try:
@@ -27,6 +35,7 @@ if __name__ == "__main__":
     print("(输入 'exit' 退出对话)")
     
     uid = "Xavier_01"
+    token = login(uid, getpass.getpass(f"[{uid}] 密码: "))
     
     while True:
         user_input = input("\n[You]: ")
@@ -35,7 +44,7 @@ if __name__ == "__main__":
         if not user_input.strip():
             continue
             
-        send_message(uid, user_input)
+        send_message(token, user_input)
 # import httpx
 # import asyncio
 # import json
@@ -0,0 +1,170 @@
+"""
+多实例调度验证：在本机启动 N 个 time.py 实例（共用临时 tasks.db，按分区租约分工），创建一批每分钟触发的任务，
+期间可强杀其中一个实例，最后检查每个任务的每一次计划触发是否恰好送达一次。
+用法: python test/check_partitions.py [--instances 3] [--partitions 8] [--tasks 200] [--minutes 3] [--kill]
+Agent 由脚本内的假服务代替（只记录收到的触发），不需要启动 mainagent.py。
+--kill 会在第一分钟后 SIGKILL 第二个实例，其分区应在 LEASE_TTL + LEASE_RENEW_INTERVAL 秒内被接管，
+期间错过的触发由接管方补发（补发内容带"原定 … 的定时任务"前缀，按原定时间计入）。
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+PLANNED = re.compile(r"原定 (\d{4}-\d{2}-\d{2} \d{2}:\d{2}) 的定时任务）(.*)")
+
+received = []  # (收到时间, user_id, text)
+received_lock = threading.Lock()
+
+
+class FakeAgent(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 保持连接，与调度器的 httpx 连接池配合
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with received_lock:
+            received.append((time.time(), body["user_id"], body["text"]))
+        self.send_response(200)
+        reply = b'{"status": "queued"}'
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, *args):
+        pass
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_instance(i: int, args, db: str, agent_port: int, workdir: str):
+    port = free_port()
+    env = {
+        **os.environ,
+        "SCHEDULER_DB": db,
+        "PORT_SCHEDULER": str(port),
+        "PORT_AGENT": str(agent_port),
+        "SCHEDULER_PARTITIONS": str(args.partitions),
+        "SCHEDULER_INSTANCE_ID": f"check-{i}",
+        "LEASE_TTL": str(args.lease_ttl),
+        "LEASE_RENEW_INTERVAL": "1",
+        "FIRE_LOG": os.path.join(workdir, f"fires-{i}.log"),
+        # 每次错过的触发都补发，才能按"每个计划时间恰好一次"检查
+        "TASK_COALESCE": "false",
+        "MISFIRE_GRACE_TIME": "0",
+        "CATCH_UP_RATE_PER_SECOND": "100",
+    }
+    log = open(os.path.join(workdir, f"instance-{i}.out"), "w")
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(SRC_DIR, "time.py")], env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    return proc, port
+
+
+def wait_ready(port: int, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/partitions", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"实例 {port} 未能启动")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多实例调度恰好一次验证")
+    parser.add_argument("--instances", type=int, default=3)
+    parser.add_argument("--partitions", type=int, default=8)
+    parser.add_argument("--tasks", type=int, default=200)
+    parser.add_argument("--minutes", type=int, default=3, help="检查的完整分钟数")
+    parser.add_argument("--lease-ttl", type=float, default=6)
+    parser.add_argument("--kill", action="store_true", help="第一分钟后强杀第二个实例")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="check_partitions_")
+    db = os.path.join(workdir, "tasks.db")
+    agent_port = free_port()
+    server = ThreadingHTTPServer(("127.0.0.1", agent_port), FakeAgent)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    instances = [start_instance(i, args, db, agent_port, workdir) for i in range(args.instances)]
+    for _, port in instances:
+        wait_ready(port)
+    time.sleep(3)  # 等待分区均衡
+    status = [httpx.get(f"http://127.0.0.1:{port}/partitions").json() for _, port in instances]
+    print("分区分配:", {s["instance_id"]: s["owned"] for s in status})
+
+    # 任务创建请求分散发给各实例，由分区所属实例负责调度
+    texts = {}
+    for i in range(args.tasks):
+        _, port = instances[i % len(instances)]
+        text = f"check-task-{i}"
+        resp = httpx.post(f"http://127.0.0.1:{port}/tasks", json={"user_id": f"user{i}", "cron": "* * * * *", "text": text})
+        resp.raise_for_status()
+        texts[text] = f"user{i}"
+
+    first = (int(time.time()) // 60 + 1) * 60  # 第一个完整分钟
+    last = first + (args.minutes - 1) * 60
+    print(f"已创建 {args.tasks} 个任务，检查 {datetime.fromtimestamp(first):%H:%M} ~ {datetime.fromtimestamp(last):%H:%M} 的触发")
+    if args.kill and len(instances) > 1:
+        time.sleep(max(0, first + 20 - time.time()))
+        instances[1][0].send_signal(signal.SIGKILL)
+        print(f"已强杀实例 check-1（{datetime.now():%H:%M:%S}）")
+    time.sleep(max(0, last + 15 - time.time()))
+    time.sleep(args.lease_ttl + 5)  # 等待接管与补发送达
+
+    for proc, _ in instances:
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGTERM)
+    for proc, _ in instances:
+        proc.wait(timeout=30)
+    server.shutdown()
+
+    # 按 (任务, 计划分钟) 统计送达次数
+    counts = Counter()
+    for at, user_id, text in received:
+        m = PLANNED.search(text)
+        if m:
+            planned, text = m.group(1), m.group(2)
+        else:
+            planned = datetime.fromtimestamp(at).strftime("%Y-%m-%d %H:%M")
+        if texts.get(text) == user_id:
+            counts[(text, planned)] += 1
+    minutes = [datetime.fromtimestamp(first + k * 60).strftime("%Y-%m-%d %H:%M") for k in range(args.minutes)]
+    expected = [(text, minute) for text in texts for minute in minutes]
+    missing = [key for key in expected if counts[key] == 0]
+    duplicated = {key: n for key, n in counts.items() if n > 1}
+
+    print(f"应送达 {len(expected)} 次，实际 {sum(counts[key] for key in expected)} 次；"
+          f"缺失 {len(missing)}，重复 {len(duplicated)}")
+    for key in missing[:5]:
+        print("   缺失:", key)
+    for key, n in list(duplicated.items())[:5]:
+        print(f"   重复 {n} 次:", key)
+    print(f"实例日志: {workdir}")
+    print("✅ 每次触发恰好送达一次" if not missing and not duplicated else "❌ 检查未通过")
+    sys.exit(0 if not missing and not duplicated else 1)
+
+
+if __name__ == "__main__":
+    main()
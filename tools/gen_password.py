@@ -22,7 +22,7 @@ def main():
     if os.path.exists(CONFIG_PATH):
         with open(CONFIG_PATH, "r", encoding="utf-8") as f:
             users = json.load(f)
-        print(f"已加载 {len(users)} 个用户: {', '.join(users.keys())}")
+        print(f"已加载 {len(users)} 个用户")
     else:
         print("未检测到 users.json，将创建新文件。")
 
@@ -45,8 +45,11 @@ def main():
     pw_hash = hash_password(password)
     users[username] = pw_hash
 
-    with open(CONFIG_PATH, "w", encoding="utf-8") as f:
+    # 先写临时文件再原子替换：运行中的 Agent 按 mtime/inode 变化自动重载，不会读到写了一半的文件
+    tmp_path = CONFIG_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(users, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, CONFIG_PATH)
 
     print(f"\n✅ 用户 '{username}' 已保存到 {CONFIG_PATH}")
     print(f"   哈希: {pw_hash}")